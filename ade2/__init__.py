@@ -0,0 +1,33 @@
+"""
+Single entry point for the scripts in this directory.
+
+    python3 -m ade2 <command> [command options]
+
+Each command runs one of the scripts exactly as if it was started directly
+(same options, same output). The script is only loaded when its command is
+used, so listing the commands (python3 -m ade2 --help) does not import any
+of the heavy modules (pyepics, numpy, matplotlib).
+
+The pipe command chains stages built from the script functions, passing
+the records between them as Python objects (see ade2/pipeline.py).
+"""
+import os
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Command name -> (script relative to ROOT_DIRECTORY, description)
+COMMANDS = {
+    'alarms': ('check_alarms.py', 'check the alarms of a list of records (pyepics)'),
+    'sweep': ('sweep_alarms.py', 'sharded alarm check using several worker processes'),
+    'capture': ('process_alarms.py', 'report the alarms in a capture_alarms.csh output file'),
+    'history': ('alarm_history.py', 'alarm history queries'),
+    'coma': ('process_coma_data.py', 'convert a coma log to csv'),
+    'wfs': ('analayze_ag_wfs.py', 'plot and analyze the A&G WFS logs'),
+    'anomalies': ('detect_anomalies.py', 'look for anomalies in the WFS and coma logs'),
+    'deps': ('pkgdeps.py', 'package dependencies and build order'),
+    'catalog': ('catalog.py', 'channel catalog'),
+    'channels': (os.path.join('ag', 'process_channels.py'), 'external references in the A&G database set'),
+    'alarm-config': (os.path.join('ag', 'check_alarm_config.py'), 'offline alarm configuration analysis'),
+    'resolve': (os.path.join('ag', 'resolve_references.py'), 'check the external references (live or catalog)'),
+    'db-diff': (os.path.join('ag', 'diff_databases.py'), 'compare two versions of a database set'),
+}
@@ -0,0 +1,48 @@
+"""
+Dispatch a command to its script (see COMMANDS)
+"""
+import os
+import sys
+import runpy
+from ade2 import ROOT_DIRECTORY, COMMANDS
+
+
+def print_commands():
+    """
+    Print the list of commands
+    """
+    print('usage: python3 -m ade2 <command> [options]\n')
+    print('commands:')
+    for name, (script, description) in COMMANDS.items():
+        print(f'  {name:16}{description}')
+    print(f'  {"pipe":16}run a pipeline of stages, e.g. "db-index | gen-sweep-list | sweep | diff | report"')
+    print('\nUse python3 -m ade2 <command> --help for the options of each command')
+
+
+def run_command(name: str, argv: list):
+    """
+    Run the script of a command as __main__, with its directory in the module search path
+    :param name: command name
+    :param argv: command arguments
+    """
+    script = os.path.join(ROOT_DIRECTORY, COMMANDS[name][0])
+    for directory in (ROOT_DIRECTORY, os.path.dirname(script)):
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+    sys.argv = [script] + argv
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print_commands()
+        exit(0)
+    if sys.argv[1] == 'pipe':
+        from ade2.pipeline import main
+        main(sys.argv[2:])
+        exit(0)
+    if sys.argv[1] not in COMMANDS:
+        print(f'unknown command {sys.argv[1]}')
+        print_commands()
+        exit(1)
+    run_command(sys.argv[1], sys.argv[2:])
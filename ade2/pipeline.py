@@ -0,0 +1,295 @@
+"""
+Streaming pipelines built from the script functions.
+
+    python3 -m ade2 pipe "db-index | gen-sweep-list | sweep -j 4 | diff | report"
+
+Stages are separated by '|' (quote the pipeline, or quote each '|', in the shell).
+Each stage has its own options (python3 -m ade2 pipe "<stage> --help").
+Stages are generators: the items produced by a stage are passed to the next one
+as Python objects, without writing or parsing intermediate files.
+
+Items:
+* records   (record name, record type, field dictionary)   db-index
+* names     record name                                    gen-sweep-list, read
+* alarms    (record name, alarm dictionary or None)        sweep, capture, diff
+
+Each stage takes the items produced by the previous one (see STAGES). The first
+stage has to be a source (db-index, read or capture). If the last stage is not
+a sink, report (alarms) or write to the standard output (records, names) is added.
+"""
+import os
+import sys
+import shlex
+import argparse
+from typing import Iterator
+from contextlib import redirect_stdout
+from ade2 import ROOT_DIRECTORY
+
+AG_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'ag')
+for _directory in (ROOT_DIRECTORY, AG_DIRECTORY):
+    if _directory not in sys.path:
+        sys.path.append(_directory)
+
+SOURCE = 'source'
+FILTER = 'filter'
+SINK = 'sink'
+
+RECORDS = 'records'
+NAMES = 'names'
+ALARMS = 'alarms'
+
+
+def db_index(upstream: Iterator, args: argparse.Namespace) -> Iterator:
+    """
+    Records in the database files (parsed with the process_channels index)
+    """
+    from process_channels import FILE_LIST, INDEX_FILE, load_database_index
+    file_list = args.files if args.files else [os.path.join(AG_DIRECTORY, _) for _ in FILE_LIST]
+    index_file = args.index if args.index is not None else os.path.join(AG_DIRECTORY, INDEX_FILE)
+    for records in load_database_index(file_list, index_file=index_file).values():
+        for record_name, (record_type, fields) in records.items():
+            yield record_name, record_type, fields
+
+
+def gen_sweep_list(upstream: Iterator, args: argparse.Namespace) -> Iterator:
+    """
+    Names of the records that can raise alarms (see ag/check_alarm_config.py)
+    """
+    from check_alarm_config import analyze_record
+    for record_name, record_type, fields in upstream:
+        if args.all or analyze_record(fields)[0]:
+            yield record_name
+
+
+def read_names(upstream: Iterator, args: argparse.Namespace) -> Iterator:
+    """
+    Record names read from a file (one per line)
+    """
+    with open(args.input_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+def sweep(upstream: Iterator, args: argparse.Namespace) -> Iterator:
+    """
+    Read the alarm fields of the records.
+    With one worker the records are checked one at a time as they arrive; with more
+    workers all the names are collected and checked in shards (see sweep_alarms.py).
+    """
+    if args.workers <= 1:
+        import check_alarms
+        check_alarms.GET_TIMEOUT = args.timeout
+        msg_flag = True
+        for record_name in upstream:
+            # The check_alarms messages go to the standard error (only while the record is read,
+            # the other stages run while the generator is suspended)
+            with redirect_stdout(sys.stderr):
+                d, msg_flag = check_alarms.get_record_alarms(record_name, msg_flag=msg_flag, use_pv=args.pv)
+            yield record_name, d
+        return
+
+    import sweep_alarms
+    state_file = args.state if args.state is not None else sweep_alarms.DEFAULT_STATE_FILE
+    record_names = list(upstream)
+    problems = set(sweep_alarms.load_state(state_file)) if state_file else set()
+    results = sweep_alarms.sweep(record_names, ['local'] * args.workers,
+                                 sweep_alarms.SHARDS_PER_WORKER * args.workers, problems,
+                                 use_pv=args.pv, timeout=args.timeout)
+    if state_file:
+        sweep_alarms.save_state(state_file, sweep_alarms.timeouts_by_prefix(results))
+    for record_name in record_names:
+        if record_name in results:
+            yield record_name, results[record_name]
+
+
+def capture(upstream: Iterator, args: argparse.Namespace) -> Iterator:
+    """
+    Alarm states in a capture_alarms.csh output file, returned as they are parsed
+    """
+    from log_reader import iter_lines
+    from process_alarms import merge_records, parse_alarm_lines
+    yield from merge_records(iter_lines(args.input_file, parse_alarm_lines))
+
+
+def diff(upstream: Iterator, args: argparse.Namespace) -> Iterator:
+    """
+    Records whose alarm state changed since their last sweep in the alarm history.
+    With --save, the states are added to the history when the upstream stages are done.
+    """
+    from alarm_history import HISTORY_FILE, last_states, encode_state, add_sweep
+    file_name = args.history if args.history else HISTORY_FILE
+    last = last_states(file_name=file_name)
+    states = {}
+    for record_name, d in upstream:
+        if args.save:
+            states[record_name] = d
+        if last.get(record_name) != encode_state(d):
+            yield record_name, d
+    if args.save and states:
+        add_sweep(states, source='ade2 pipe', file_name=file_name)
+
+
+def report(upstream: Iterator, args: argparse.Namespace):
+    """
+    Print the records with alarms as check_alarms.py does.
+    With --all, print every record (e.g. the records that went back to NO_ALARM after diff).
+    """
+    from common import print_title, print_line, ignore_alarms
+    print_title(csv_output=args.csv)
+    for record_name, d in upstream:
+        if d is None:
+            print(f'connection timeout {record_name}')
+        elif args.all or not ignore_alarms(d, include_udf=args.include_udf):
+            print_line(record_name, d, csv_output=args.csv)
+
+
+def write(upstream: Iterator, args: argparse.Namespace):
+    """
+    Write the record names to a file (e.g. the input of capture_alarms.csh) or the standard output
+    """
+    if args.output_file == '-':
+        for item in upstream:
+            print(item if isinstance(item, str) else item[0])
+        return
+    with open(args.output_file, 'w') as f:
+        for item in upstream:
+            f.write(f'{item if isinstance(item, str) else item[0]}\n')
+
+
+def stage_parser(name: str) -> argparse.ArgumentParser:
+    """
+    Return the parser with the options of a stage
+    :param name: stage name
+    :return: argument parser
+    """
+    parser = argparse.ArgumentParser(prog=name, description=STAGES[name][0].__doc__)
+    if name == 'db-index':
+        parser.add_argument('files', nargs='*', help='database files (default is the A&G database set)')
+        parser.add_argument('--index', action='store', default=None,
+                            help='parsed database cache (use an empty string to disable it)')
+    elif name == 'gen-sweep-list':
+        parser.add_argument('--all', action='store_true', default=False, help='include all the records')
+    elif name in ('read', 'capture'):
+        parser.add_argument('input_file', help='input file')
+    elif name == 'sweep':
+        parser.add_argument('-j', '--workers', action='store', type=int, default=1, help='worker processes')
+        parser.add_argument('--pv', action='store_true', default=False, help='use the PV interface')
+        parser.add_argument('--timeout', action='store', type=float, default=5.0,
+                            help='channel access timeout (seconds)')
+        parser.add_argument('--state', action='store', default=None,
+                            help='problem IOC state file used with -j > 1 (use an empty string to disable it)')
+    elif name == 'diff':
+        parser.add_argument('--history', action='store', default='', help='alarm history file')
+        parser.add_argument('--save', action='store_true', default=False, help='add the states to the history')
+    elif name == 'report':
+        parser.add_argument('--csv', action='store_true', default=False, help='format output as csv')
+        parser.add_argument('--udf', action='store_true', dest='include_udf', default=False,
+                            help='include undefined records in the report (UDF)')
+        parser.add_argument('--all', action='store_true', default=False, help='print all the records')
+    elif name == 'write':
+        parser.add_argument('output_file', nargs='?', default='-', help='output file (default is the standard output)')
+    return parser
+
+
+# Stage name -> (function, items taken, items produced)
+STAGES = {
+    'db-index': (db_index, (), RECORDS),
+    'read': (read_names, (), NAMES),
+    'capture': (capture, (), ALARMS),
+    'gen-sweep-list': (gen_sweep_list, (RECORDS,), NAMES),
+    'sweep': (sweep, (NAMES,), ALARMS),
+    'diff': (diff, (ALARMS,), ALARMS),
+    'report': (report, (ALARMS,), None),
+    'write': (write, (RECORDS, NAMES, ALARMS), None),
+}
+
+
+def stage_kind(name: str) -> str:
+    """
+    :param name: stage name
+    :return: SOURCE, FILTER or SINK
+    """
+    function, inputs, output = STAGES[name]
+    if not inputs:
+        return SOURCE
+    return FILTER if output else SINK
+
+
+def split_pipeline(argv: list) -> list:
+    """
+    Split the command line into stages
+    :param argv: pipeline arguments (a single string or a list of tokens)
+    :return: list of token lists, one per stage
+    """
+    if len(argv) > 1:
+        argv = [shlex.quote(_) if '|' not in _ else _ for _ in argv]
+    lexer = shlex.shlex(' '.join(argv),
+                        posix=True, punctuation_chars='|')
+    output_list = [[]]
+    for token in lexer:
+        if token == '|':
+            output_list.append([])
+        else:
+            output_list[-1].append(token)
+    return output_list
+
+
+def build_pipeline(stages: list) -> tuple:
+    """
+    Chain the stages
+    :param stages: list of token lists (see split_pipeline)
+    :return: (sink function, sink arguments, iterator of the last stage before the sink) tuple
+    """
+    items = None
+    for n, tokens in enumerate(stages):
+        if not tokens:
+            raise ValueError('empty stage')
+        if tokens[0] not in STAGES:
+            raise ValueError(f'unknown stage {tokens[0]} (stages: {", ".join(STAGES)})')
+        kind = stage_kind(tokens[0])
+        if (n == 0) != (kind == SOURCE):
+            raise ValueError(f'{tokens[0]} ' + ('is not a source' if n == 0 else 'has to be the first stage'))
+        if kind == SINK and n != len(stages) - 1:
+            raise ValueError(f'{tokens[0]} has to be the last stage')
+        inputs = STAGES[tokens[0]][1]
+        if n > 0 and items not in inputs:
+            raise ValueError(f'{tokens[0]} takes {" or ".join(inputs)}, but {stages[n - 1][0]} produces {items}')
+        items = STAGES[tokens[0]][2]
+    if items is not None:
+        stages = stages + [['report' if items == ALARMS else 'write']]
+
+    iterator = iter(())
+    for tokens in stages[:-1]:
+        function = STAGES[tokens[0]][0]
+        iterator = function(iterator, stage_parser(tokens[0]).parse_args(tokens[1:]))
+    sink = stages[-1]
+    return STAGES[sink[0]][0], stage_parser(sink[0]).parse_args(sink[1:]), iterator
+
+
+def main(argv: list):
+    """
+    Run a pipeline
+    :param argv: pipeline arguments
+    """
+    if not argv or argv[0] in ('-h', '--help'):
+        print(__doc__)
+        print('stages:')
+        for name, (function, inputs, output) in STAGES.items():
+            items = f'{"|".join(inputs) if inputs else "-"} -> {output if output else "-"}'
+            print(f'  {name:16}{stage_kind(name):8}{items:26}{function.__doc__.strip().splitlines()[0]}')
+        return
+    try:
+        sink, sink_args, iterator = build_pipeline(split_pipeline(argv))
+    except ValueError as e:
+        argparse.ArgumentParser(prog='ade2 pipe', usage='python3 -m ade2 pipe "<stage> [options] | ..."').error(str(e))
+    try:
+        sink(iterator, sink_args)
+    except BrokenPipeError:
+        # Output closed before the end (e.g. piped to head)
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except OSError as e:
+        print(e)
+        exit(1)
+    except KeyboardInterrupt:
+        print('Aborted')
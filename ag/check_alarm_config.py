@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of the alarm configuration of the records in the database files.
+
+For each record, the alarm related fields are used to predict whether the record
+can raise alarms at all, and to flag suspect configurations:
+* limit alarms (HIHI/HIGH/LOW/LOLO with HHSV/HSV/LSV/LLSV)
+* state alarms (ZSV, OSV, COSV, ZRSV..FFSV, UNSV)
+* other severities (BRSV, ERSV, SIMS)
+* disable alarms (DISS, with SDIS/DISV)
+* input links that propagate the alarm severity (MS, MSS, MSI)
+* device support other than soft channel (READ/WRITE/COMM alarms)
+
+Alarms that any record can have (UDF, LINK, SOFT) are not predicted.
+The records that can raise alarms can be written to a file and used as the
+input of check_alarms.py or capture_alarms.csh.
+"""
+import re
+import argparse
+from process_channels import FILE_LIST, INDEX_FILE, load_database_index, merge_records, write_list
+from process_channels import not_reference
+
+NO_ALARM = 'NO_ALARM'
+SEVERITIES = ('NO_ALARM', 'MINOR', 'MAJOR', 'INVALID')
+
+# Limit fields and their severities, from the highest to the lowest limit
+LIMIT_FIELDS = (('HIHI', 'HHSV'), ('HIGH', 'HSV'), ('LOW', 'LSV'), ('LOLO', 'LLSV'))
+
+# State severity fields (bi, bo, mbbi, mbbo)
+STATE_FIELDS = ('ZSV', 'OSV', 'COSV', 'UNSV',
+                'ZRSV', 'ONSV', 'TWSV', 'THSV', 'FRSV', 'FVSV', 'SXSV', 'SVSV',
+                'EISV', 'NISV', 'TESV', 'ELSV', 'TVSV', 'TTSV', 'FTSV', 'FFSV')
+
+# Other severity fields
+OTHER_FIELDS = ('BRSV', 'ERSV', 'SIMS')
+
+# Input link fields
+INPUT_LINK_PATTERN = re.compile(r'^(INP[A-Z]?|DOL[0-9A-F]?|SIOL|SELL|NVL|SDIS)$')
+
+# Link options that propagate the severity
+MAXIMIZE_SEVERITY = ('MS', 'MSS', 'MSI')
+
+# Device types that do not talk to hardware
+SOFT_DEVICES = ('', 'Soft Channel', 'Raw Soft Channel', 'Async Soft Channel', 'Soft Timestamp')
+
+
+def to_float(s: str):
+    """
+    Convert a field value to float
+    :param s: field value
+    :return: float value, None if it's not a number
+    """
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+def analyze_record(fields: dict) -> tuple:
+    """
+    Analyze the alarm fields of a record.
+    :param fields: field dictionary
+    :return: tuple with the list of alarm sources and the list of suspect configurations
+    """
+    sources = []
+    suspects = []
+
+    # Unknown severity names
+    for field_name in fields:
+        if (field_name.endswith('SV') and field_name != 'DISV') or field_name in ('DISS', 'SIMS'):
+            if fields[field_name] not in SEVERITIES and not_reference(fields[field_name]):
+                suspects.append(f'{field_name} invalid severity "{fields[field_name]}"')
+
+    # Limit alarms
+    active = []
+    for limit_name, severity_name in LIMIT_FIELDS:
+        severity = fields.get(severity_name, NO_ALARM)
+        if severity == NO_ALARM:
+            continue
+        sources.append(f'{limit_name}={severity}')
+        limit = to_float(fields.get(limit_name, '0'))
+        if limit is None:
+            suspects.append(f'{limit_name} is not a number')
+        else:
+            active.append((limit_name, limit))
+            if limit == 0:
+                suspects.append(f'{limit_name} is zero with {severity_name}={severity}')
+    for (name_1, limit_1), (name_2, limit_2) in zip(active, active[1:]):
+        if limit_1 < limit_2:
+            suspects.append(f'{name_1} ({limit_1:g}) < {name_2} ({limit_2:g})')
+
+    # State and other severities
+    for field_name in STATE_FIELDS + OTHER_FIELDS:
+        severity = fields.get(field_name, NO_ALARM)
+        if severity != NO_ALARM:
+            sources.append(f'{field_name}={severity}')
+
+    # Disable alarm
+    sdis = fields.get('SDIS', '')
+    disv = to_float(fields.get('DISV', '1'))
+    sdis_value = to_float(sdis) if not_reference(sdis) and sdis else None
+    if fields.get('DISS', NO_ALARM) != NO_ALARM:
+        if not not_reference(sdis):
+            sources.append(f'DISS={fields["DISS"]}')
+        elif sdis_value is not None and sdis_value == disv:
+            sources.append(f'DISS={fields["DISS"]}')
+    if sdis_value is not None and disv is not None and sdis_value == disv:
+        suspects.append(f'permanently disabled (SDIS={sdis}, DISV={fields.get("DISV")})')
+
+    # Input links that propagate the severity
+    for field_name in fields:
+        if INPUT_LINK_PATTERN.search(field_name) and not not_reference(fields[field_name]):
+            options = fields[field_name].split()[1:]
+            if any(_ in MAXIMIZE_SEVERITY for _ in options):
+                sources.append(f'{field_name} {" ".join(options)}')
+
+    # Device support
+    if fields.get('DTYP', '') not in SOFT_DEVICES:
+        sources.append(f'DTYP={fields["DTYP"]}')
+
+    return sources, suspects
+
+
+def analyze(records: dict) -> dict:
+    """
+    Analyze all the records
+    :param records: dictionary of (record type, field dictionary) tuples indexed by record name
+    :return: dictionary of (record type, alarm sources, suspect configurations) indexed by record name
+    """
+    output_dict = {}
+    for record_name in records:
+        record_type, fields = records[record_name]
+        sources, suspects = analyze_record(fields)
+        output_dict[record_name] = (record_type, sources, suspects)
+    return output_dict
+
+
+def print_report(results: dict, csv_output=False, show_all=False):
+    """
+    Print the records that can raise alarms or have suspect configurations
+    :param results: analyze output
+    :param csv_output: csv output?
+    :param show_all: include records that cannot raise alarms?
+    """
+    if csv_output:
+        print('Record name,type,alarm sources,suspect')
+    count_alarm = count_suspect = 0
+    for record_name in sorted(results):
+        record_type, sources, suspects = results[record_name]
+        count_alarm += 1 if sources else 0
+        count_suspect += 1 if suspects else 0
+        if not (sources or suspects or show_all):
+            continue
+        if csv_output:
+            print(f'{record_name},{record_type},{";".join(sources)},{";".join(suspects)}')
+        else:
+            print(f'{record_name:40}{record_type:12}{", ".join(sources)}')
+            for s in suspects:
+                print(f'{"":52}suspect: {s}')
+    if not csv_output:
+        print(f'{len(results)} records, {count_alarm} can raise alarms, {count_suspect} suspect')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(action='store',
+                        dest='input_files',
+                        nargs='*',
+                        default=FILE_LIST,
+                        help='database files (default is the A&G database set)')
+
+    parser.add_argument('--csv',
+                        action='store_true',
+                        dest='csv',
+                        default=False,
+                        help='format output as csv')
+
+    parser.add_argument('--all',
+                        action='store_true',
+                        dest='all',
+                        default=False,
+                        help='include records that cannot raise alarms')
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        dest='output',
+                        default='',
+                        help='write the names of the records that can raise alarms to this file')
+
+    parser.add_argument('--index',
+                        action='store',
+                        dest='index',
+                        default=INDEX_FILE,
+                        help='parsed database cache (use an empty string to disable it)')
+
+    args = parser.parse_args()
+
+    try:
+        record_dict = merge_records(load_database_index(args.input_files, index_file=args.index))
+    except OSError as e:
+        print(f'Cannot read database: {e}')
+        exit(1)
+
+    result_dict = analyze(record_dict)
+    print_report(result_dict, csv_output=args.csv, show_all=args.all)
+    if args.output:
+        write_list(args.output, sorted(_ for _ in result_dict if result_dict[_][1]))
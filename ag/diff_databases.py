@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Record aware comparison of two versions of a database set (e.g. before and after tdct regeneration).
+
+Each version is a database file or a directory (all the .db files in it are used).
+Records are compared by name, so reordering and regeneration noise do not show up.
+The output lists the added and removed records, and for the changed records the
+field differences. Changes in link fields are reported as link retargeting when
+the referenced record changes.
+
+The record digests computed when the files are parsed (and kept in the database index)
+are compared first, so unchanged records are skipped without comparing their fields.
+"""
+import os
+import sys
+import csv
+import argparse
+from process_channels import INDEX_FILE, load_index_entries, reference_field, not_reference
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+RETARGETED = 'retargeted'
+TYPE = 'type'
+
+
+def database_files(path_name: str) -> list:
+    """
+    Return the list of database files in a version
+    :param path_name: database file or directory
+    :return: list of database file names
+    """
+    if os.path.isdir(path_name):
+        return sorted(os.path.join(path_name, _) for _ in os.listdir(path_name) if _.endswith('.db'))
+    return [path_name]
+
+
+def load_version(path_name: str, index_file=INDEX_FILE) -> tuple:
+    """
+    Read the records of a version
+    :param path_name: database file or directory
+    :param index_file: database index file (no caching if empty)
+    :return: (records, digests) tuple of dictionaries indexed by record name
+    """
+    records, digests = {}, {}
+    for entry in load_index_entries(database_files(path_name), index_file=index_file).values():
+        records.update(entry['records'])
+        digests.update(entry['digests'])
+    return records, digests
+
+
+def link_target(value: str) -> str:
+    """
+    Return the record referenced by a link field value
+    :param value: field value
+    :return: record name, or an empty string if it's not a reference
+    """
+    if not_reference(value):
+        return ''
+    return value.split()[0].split('.')[0]
+
+
+def diff_fields(old_fields: dict, new_fields: dict) -> list:
+    """
+    Compare the fields of two versions of a record
+    :param old_fields: old field dictionary
+    :param new_fields: new field dictionary
+    :return: list of (kind, field name, old value, new value) tuples
+    """
+    output_list = []
+    for field_name in sorted(set(old_fields) | set(new_fields)):
+        old_value = old_fields.get(field_name)
+        new_value = new_fields.get(field_name)
+        if old_value == new_value:
+            continue
+        if old_value is None:
+            output_list.append((ADDED, field_name, '', new_value))
+        elif new_value is None:
+            output_list.append((REMOVED, field_name, old_value, ''))
+        elif reference_field(field_name) and link_target(old_value) != link_target(new_value):
+            output_list.append((RETARGETED, field_name, old_value, new_value))
+        else:
+            output_list.append((CHANGED, field_name, old_value, new_value))
+    return output_list
+
+
+def diff_records(old_records: dict, new_records: dict, old_digests: dict, new_digests: dict) -> list:
+    """
+    Compare two sets of records
+    :param old_records: old records (see load_version)
+    :param new_records: new records
+    :param old_digests: old record digests (see load_version)
+    :param new_digests: new record digests
+    :return: list of (kind, record name, record type, field differences) tuples sorted by record name
+    """
+    output_list = []
+    for record_name in sorted(set(old_records) | set(new_records)):
+        old_record = old_records.get(record_name)
+        new_record = new_records.get(record_name)
+        if old_record is None:
+            output_list.append((ADDED, record_name, new_record[0], []))
+        elif new_record is None:
+            output_list.append((REMOVED, record_name, old_record[0], []))
+        elif old_digests[record_name] != new_digests[record_name]:
+            differences = diff_fields(old_record[1], new_record[1])
+            if old_record[0] != new_record[0]:
+                differences.insert(0, (TYPE, '', old_record[0], new_record[0]))
+            if differences:
+                output_list.append((CHANGED, record_name, new_record[0], differences))
+    return output_list
+
+
+def print_differences(differences: list, csv_output=False):
+    """
+    Print the database differences
+    :param differences: diff_records output
+    :param csv_output: csv output?
+    """
+    symbol = {ADDED: '+', REMOVED: '-', CHANGED: '~', RETARGETED: '>', TYPE: '!'}
+    count = {ADDED: 0, REMOVED: 0, CHANGED: 0}
+    writer = csv.writer(sys.stdout, lineterminator='\n') if csv_output else None
+    if csv_output:
+        writer.writerow(['change', 'record', 'type', 'field', 'old', 'new'])
+    for kind, record_name, record_type, fields in differences:
+        count[kind] += 1
+        if csv_output:
+            if fields:
+                for field_kind, field_name, old_value, new_value in fields:
+                    writer.writerow([field_kind, record_name, record_type, field_name, old_value, new_value])
+            else:
+                writer.writerow([kind, record_name, record_type, '', '', ''])
+        else:
+            print(f'{symbol[kind]} {record_name} ({record_type})')
+            for field_kind, field_name, old_value, new_value in fields:
+                if field_kind == RETARGETED:
+                    print(f'    {symbol[field_kind]} {field_name}: {link_target(old_value)} -> '
+                          f'{link_target(new_value)}  ("{old_value}" -> "{new_value}")')
+                else:
+                    print(f'    {symbol[field_kind]} {field_name}: "{old_value}" -> "{new_value}"')
+    if not csv_output:
+        print(f'{count[ADDED]} added, {count[REMOVED]} removed, {count[CHANGED]} changed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(action='store',
+                        dest='old',
+                        help='old database file or directory')
+
+    parser.add_argument(action='store',
+                        dest='new',
+                        help='new database file or directory')
+
+    parser.add_argument('--csv',
+                        action='store_true',
+                        dest='csv',
+                        default=False,
+                        help='format output as csv')
+
+    parser.add_argument('--index',
+                        action='store',
+                        dest='index',
+                        default=INDEX_FILE,
+                        help='parsed database cache (use an empty string to disable it)')
+
+    args = parser.parse_args()
+
+    try:
+        old_dict, old_digest_dict = load_version(args.old, index_file=args.index)
+        new_dict, new_digest_dict = load_version(args.new, index_file=args.index)
+    except OSError as e:
+        print(f'Cannot read database: {e}')
+        exit(1)
+
+    print_differences(diff_records(old_dict, new_dict, old_digest_dict, new_digest_dict), csv_output=args.csv)
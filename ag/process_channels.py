@@ -1,5 +1,14 @@
 #!/usr/bin/env python3
+import os
 import re
+import sys
+import time
+import pickle
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
 
 FILE_LIST = [
     'ag_top.db',
@@ -9,6 +18,26 @@ FILE_LIST = [
     'oiwfsgwTop.db'
 ]
 
+# Parsed database cache (see load_database_index)
+INDEX_FILE = '.db_index.pickle'
+INDEX_VERSION = 2
+
+# Index entries not used for this long are removed (seconds)
+INDEX_MAX_AGE = 30 * 24 * 3600
+
+# The last use time of an entry is only updated after this long, so reading the index does not rewrite it
+INDEX_TOUCH_INTERVAL = 24 * 3600
+
+# Output files
+RECORD_FILE = 'record_list.txt'
+SCRIPT_FILE = 'caget.sh'
+
+# Polling interval in watch mode (seconds)
+WATCH_INTERVAL = 0.2
+
+RECORD_PATTERN = re.compile(r'^record\(\s*([^,\s]+)\s*,\s*"([^"]*)"')
+FIELD_PATTERN = re.compile(r'^field\(\s*([A-Za-z0-9_]+)\s*,\s*"(.*)"\s*\)')
+
 MACROS = {
     r'${ag}': 'tag:',
     r'${pwfs1}': 'pwfs1:',
@@ -100,42 +129,74 @@ def reference_field(field_name: str) -> bool:
     return False
 
 
+def record_references(records: dict) -> dict:
+    """
+    Get the references to other records in a set of parsed records
+    :param records: parse_database output
+    :return: dictionary with the set of referenced fields indexed by record name
+    """
+    output_dict = {}
+    for record_type, fields in records.values():
+        for field_name, value in fields.items():
+            # Only process those fields that can reference other records
+            if not reference_field(field_name):
+                continue
+            field_value = re.sub(r' .*', '', value)
+            if not_reference(field_value):
+                # skip fields that are not a reference other records
+                continue
+            instrument.count('references')
+
+            # Extract record name and field. Assume VAL if field is not specified
+            ref_record, _, ref_field = field_value.partition('.')
+            if ref_record not in output_dict:
+                output_dict[ref_record] = set()
+            output_dict[ref_record].add(ref_field if ref_field else 'VAL')
+    return output_dict
+
+
+def file_references(file_name: str) -> dict:
+    """
+    Get the references to other records in a database file
+    :param file_name: database file name
+    :return: dictionary with the set of referenced fields indexed by record name
+    """
+    return record_references(parse_database(file_name))
+
+
+def merge_references(output_dict: dict, references: dict, records: set):
+    """
+    Add the references to records that are not in the record set
+    :param output_dict: external reference dictionary (updated)
+    :param references: file_references output
+    :param records: names of the records in the database set
+    """
+    for ref_record, fields in references.items():
+        if ref_record not in records:
+            if ref_record not in output_dict:
+                output_dict[ref_record] = set()
+            output_dict[ref_record].update(fields)
+
+
 def process_fields(file_list: list, rec_list: list) -> dict:
+    records = set(rec_list)
     output_dict = {}
     for file_name in file_list:
         print('++', file_name)
-        with open(file_name, 'r') as f:
-            for line in f:
-                line = substitute_macros(line.strip(), MACROS)
-                if re.search(r'^field', line):
-                    # print(line)
-                    f_name, f_value = line.split(',', 1)
-                    field_name = re.sub(r'^field\(', '', f_name)
-
-                    # Only process those fields that can reference other records
-                    if reference_field(field_name):
-                        field_value = re.sub(r' .*', '', re.sub(r'"', '', re.sub(r'"\)', '', f_value)))
-                        if not_reference(field_value):
-                            # skip fields that are not a reference other records
-                            continue
-
-                        # Extract record name and field. Assume VAL if field is not specified
-                        if '.' in field_value:
-                            ref_record, ref_field = field_value.split('.')
-                        else:
-                            ref_record, ref_field = field_value, 'VAL'
-
-                        # Add those references that are not in the record list
-                        if ref_record not in rec_list:
-                            if ref_record not in output_dict:
-                                output_dict[ref_record] = set()
-                            output_dict[ref_record].add(ref_field)
-
-                        # print(f'n={name}, v={value} - fn=[{field_name}] fv=[{field_value}] - rr=[{ref_record}] rf=[{ref_field}]')
-
+        with instrument.timer('process_fields'):
+            merge_references(output_dict, file_references(file_name), records)
     return output_dict
 
 
+def file_record_names(file_name: str) -> list:
+    """
+    Get the list of record names in a database file
+    :param file_name: database file name
+    :return: record name list
+    """
+    return list(parse_database(file_name))
+
+
 def get_record_names(file_list: list) -> list:
     """
     Get the list of record name in all the database files
@@ -144,19 +205,221 @@ def get_record_names(file_list: list) -> list:
     """
     output_list = []
     for file_name in file_list:
-        with open(file_name, 'r') as f:
-            print('--', file_name)
-            for line in f:
-                line = substitute_macros(line.strip(), MACROS)
-                if re.search(r'^record', line):
-                    record_name = re.sub(r'".*', '', re.sub(r'record.*,"', '', line))
-                    output_list.append(record_name)
+        print('--', file_name)
+        output_list.extend(file_record_names(file_name))
     return output_list
 
 
+def parse_database(file_name: str) -> dict:
+    """
+    Parse a database file (macros are substituted)
+    :param file_name: database file name
+    :return: dictionary of (record type, field dictionary) tuples indexed by record name
+    """
+    output_dict = {}
+    fields = {}
+    with open(file_name, 'r') as f:
+        for line in f:
+            line = substitute_macros(line.strip(), MACROS)
+            m = FIELD_PATTERN.search(line)
+            if m is not None:
+                fields[m.group(1)] = m.group(2)
+                continue
+            m = RECORD_PATTERN.search(line)
+            if m is not None:
+                fields = {}
+                output_dict[m.group(2)] = (m.group(1), fields)
+    return output_dict
+
+
+def record_digest(record: tuple) -> bytes:
+    """
+    Digest of a record (type and fields), stable between runs
+    :param record: (record type, field dictionary) tuple
+    :return: digest
+    """
+    record_type, fields = record
+    return hashlib.blake2b(repr((record_type, sorted(fields.items()))).encode(), digest_size=16).digest()
+
+
+def load_index_entries(file_list: list, index_file=INDEX_FILE) -> dict:
+    """
+    Parse a list of database files, reusing the cached results for the files
+    that did not change (same modification time and size) since the last call.
+    Entries for files that no longer exist or were not used for INDEX_MAX_AGE are removed.
+    :param file_list: list of database files
+    :param index_file: cache file name (no caching if empty)
+    :return: dictionary of {'records': parse_database output, 'digests': record_digest by record name}
+             dictionaries indexed by file name
+    """
+    cache = {}
+    if index_file:
+        try:
+            with open(index_file, 'rb') as f:
+                d = pickle.load(f)
+            if d.get('version') == INDEX_VERSION:
+                cache = d['files']
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, KeyError):
+            pass
+
+    now = time.time()
+    output_dict = {}
+    changed = False
+    for file_name in file_list:
+        st = os.stat(file_name)
+        key = os.path.abspath(file_name)
+        entry = cache.get(key)
+        if entry is None or entry['state'] != (st.st_mtime_ns, st.st_size):
+            with instrument.timer('parse'):
+                records = parse_database(file_name)
+            entry = {'state': (st.st_mtime_ns, st.st_size), 'records': records,
+                     'digests': {name: record_digest(record) for name, record in records.items()}, 'used': now}
+            cache[key] = entry
+            changed = True
+        elif now - entry['used'] > INDEX_TOUCH_INTERVAL:
+            entry['used'] = now
+            changed = True
+        output_dict[file_name] = entry
+
+    for key in [_ for _ in cache if now - cache[_]['used'] > INDEX_MAX_AGE or not os.path.exists(_)]:
+        del cache[key]
+        changed = True
+
+    if index_file and changed:
+        tmp_file_name = f'{index_file}.{os.getpid()}'
+        with open(tmp_file_name, 'wb') as f:
+            pickle.dump({'version': INDEX_VERSION, 'files': cache}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_name, index_file)
+    return output_dict
+
+
+def load_database_index(file_list: list, index_file=INDEX_FILE) -> dict:
+    """
+    Parse a list of database files, using the cache in the index file (see load_index_entries)
+    :param file_list: list of database files
+    :param index_file: cache file name (no caching if empty)
+    :return: dictionary with the parse_database output indexed by file name
+    """
+    return {file_name: entry['records'] for file_name, entry in load_index_entries(file_list, index_file).items()}
+
+
+def merge_records(index: dict) -> dict:
+    """
+    Merge the records of all the files in a database index
+    :param index: database index (see load_database_index)
+    :return: dictionary of (record type, field dictionary) tuples indexed by record name
+    """
+    output_dict = {}
+    for file_name in index:
+        output_dict.update(index[file_name])
+    return output_dict
+
+
+def file_state(file_name: str) -> tuple:
+    """
+    :param file_name: file name
+    :return: (modification time, size) tuple, used to detect changes
+    """
+    st = os.stat(file_name)
+    return st.st_mtime_ns, st.st_size
+
+
+def write_outputs(file_list: list, records: dict, references: dict) -> dict:
+    """
+    Merge the per file results and write the record list and the caget script
+    :param file_list: list of database files
+    :param records: record name lists indexed by file name
+    :param references: record_references output indexed by file name
+    :return: external reference dictionary (same as process_fields)
+    """
+    record_list = [record_name for file_name in file_list for record_name in records[file_name]]
+    record_set = set(record_list)
+    field_dict = {}
+    for file_name in file_list:
+        merge_references(field_dict, references[file_name], record_set)
+    write_list(RECORD_FILE, record_list)
+    generate_script(SCRIPT_FILE, field_dict)
+    return field_dict
+
+
+def watch(file_list: list, interval: float):
+    """
+    Regenerate the outputs when a database file changes. Only the files whose
+    modification time or size changed are parsed again (once, see parse_database).
+    :param file_list: list of database files
+    :param interval: polling interval (seconds)
+    """
+    states, records, references = {}, {}, {}
+    field_dict = {}
+    while True:
+        changed = []
+        for file_name in file_list:
+            try:
+                state = file_state(file_name)
+            except OSError:
+                # file being replaced, keep the previous results
+                continue
+            if state == states.get(file_name):
+                continue
+            t = time.perf_counter()
+            try:
+                with instrument.timer('parse'):
+                    parsed = parse_database(file_name)
+                records[file_name] = list(parsed)
+                references[file_name] = record_references(parsed)
+            except (OSError, UnicodeDecodeError) as e:
+                print(e)
+                continue
+            states[file_name] = state
+            changed.append((file_name, time.perf_counter() - t))
+
+        if changed and len(records) == len(file_list):
+            t = time.perf_counter()
+            previous = field_dict
+            field_dict = write_outputs(file_list, records, references)
+            added = sorted(set(field_dict) - set(previous))
+            removed = sorted(set(previous) - set(field_dict))
+            elapsed = time.perf_counter() - t + sum([_[1] for _ in changed])
+            print(f'{time.strftime("%H:%M:%S")} {", ".join([_[0] for _ in changed])}: '
+                  f'{sum([len(_) for _ in records.values()])} records, {len(field_dict)} external records '
+                  f'(+{len(added)} -{len(removed)}), {elapsed * 1000:.0f} ms')
+            if previous:
+                for record_name in added:
+                    print(f'  + {record_name}')
+                for record_name in removed:
+                    print(f'  - {record_name}')
+        time.sleep(interval)
+
+
 if __name__ == '__main__':
-    record_list = get_record_names(FILE_LIST)
-    write_list('record_list.txt', record_list)
-    field_dict = process_fields(FILE_LIST, record_list)
-    generate_script('caget.sh', field_dict)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--watch',
+                        action='store_true',
+                        dest='watch',
+                        default=False,
+                        help=f'regenerate {RECORD_FILE} and {SCRIPT_FILE} when a database file changes')
+    parser.add_argument('--interval',
+                        action='store',
+                        dest='interval',
+                        type=float,
+                        default=WATCH_INTERVAL,
+                        help=f'polling interval in watch mode (default {WATCH_INTERVAL} s)')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.start(args)
+
+    if args.watch:
+        try:
+            watch(FILE_LIST, args.interval)
+        except KeyboardInterrupt:
+            pass
+        instrument.finish(args)
+        exit(0)
+
+    # Each file is parsed once (or read from the index if it did not change)
+    database_index = load_database_index(FILE_LIST)
+    field_dict = write_outputs(FILE_LIST, {_: list(database_index[_]) for _ in FILE_LIST},
+                               {_: record_references(database_index[_]) for _ in FILE_LIST})
+    instrument.count('external records', len(field_dict))
     print_dict(field_dict)
+    instrument.finish(args)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Check the references to records outside the database set (the records in caget.sh,
+see process_channels.py) in one batched pass instead of one caget per record.
+
+Live mode (default, requires pyepics): the channel access searches for all the
+referenced channels (record.field) are sent at once and the replies are collected
+until the timeout, so the whole set takes at most one timeout.
+
+Offline mode (--offline): the records are looked up in the channel catalog, which
+can be filled with the database files of the other IOCs (../catalog.py build <files>).
+
+Channels are classified as:
+* resolvable  connected (live) or record in the catalog (offline)
+* missing     the catalog has database files for the IOC, but not this record (offline)
+* timeout     no reply before the timeout (live)
+* unknown     no database file for the IOC in the catalog (offline)
+
+Resolvable live results are cached (--cache) and reused until they are older than --max-age,
+so only the new channels are searched after the database files change. Timeouts are not
+cached: a channel that did not reply is searched again in the next run.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
+from catalog import CATALOG_FILE, open_catalog, record_prefix
+from process_channels import FILE_LIST, parse_database, record_references
+
+RESOLVABLE = 'resolvable'
+MISSING = 'missing'
+TIMEOUT = 'timeout'
+UNKNOWN = 'unknown'
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'resolve_references.json')
+CACHE_VERSION = 1
+
+# Cached results are reused for this long (seconds)
+DEFAULT_MAX_AGE = 3600.0
+
+# Polling interval while waiting for the channel access replies (seconds)
+POLL_INTERVAL = 0.01
+
+
+def external_channels(file_list: list) -> dict:
+    """
+    Get the channels referenced by the database files that are not in the database set
+    :param file_list: list of database files
+    :return: dictionary with the set of files referencing each channel (record.field)
+    """
+    records = set()
+    references = {}
+    for file_name in file_list:
+        with instrument.timer('parse'):
+            parsed = parse_database(file_name)
+        records.update(parsed)
+        references[file_name] = record_references(parsed)
+
+    output_dict = {}
+    for file_name in file_list:
+        for ref_record, fields in references[file_name].items():
+            if ref_record in records:
+                continue
+            for field_name in fields:
+                channel_name = f'{ref_record}.{field_name}'
+                if channel_name not in output_dict:
+                    output_dict[channel_name] = set()
+                output_dict[channel_name].add(os.path.basename(file_name))
+    return output_dict
+
+
+def check_live(channels: list, timeout: float) -> dict:
+    """
+    Connect to all the channels at the same time
+    :param channels: list of channel names
+    :param timeout: connection timeout (seconds)
+    :return: status dictionary indexed by channel name
+    """
+    from epics import ca
+    with instrument.timer('ca search'):
+        channel_ids = {_: ca.create_channel(_, connect=False, callback=None, auto_cb=False) for _ in channels}
+        pending = set(channels)
+        deadline = time.perf_counter() + timeout
+        while pending and time.perf_counter() < deadline:
+            ca.pend_event(POLL_INTERVAL)
+            pending = set([_ for _ in pending if not ca.isConnected(channel_ids[_])])
+    with instrument.timer('ca clear'):
+        for channel_id in channel_ids.values():
+            ca.clear_channel(channel_id)
+    return {_: TIMEOUT if _ in pending else RESOLVABLE for _ in channels}
+
+
+def check_catalog(channels: list, file_name=CATALOG_FILE) -> dict:
+    """
+    Look up the channel records in the catalog
+    :param channels: list of channel names
+    :param file_name: catalog file name
+    :return: status dictionary indexed by channel name
+    """
+    with instrument.timer('catalog lookup'):
+        db = open_catalog(file_name, read_only=True)
+        prefixes = set([_[0] for _ in db.execute('SELECT DISTINCT prefix FROM records')])
+        output_dict = {}
+        for channel_name in channels:
+            record_name = channel_name.partition('.')[0]
+            if db.execute('SELECT 1 FROM records WHERE name = ?', (record_name,)).fetchone():
+                output_dict[channel_name] = RESOLVABLE
+            elif record_prefix(record_name) in prefixes:
+                output_dict[channel_name] = MISSING
+            else:
+                output_dict[channel_name] = UNKNOWN
+        db.close()
+    return output_dict
+
+
+def load_cache(file_name: str) -> dict:
+    """
+    Read the cached live results
+    :param file_name: cache file name
+    :return: dictionary of [status, time] lists indexed by channel name
+    """
+    try:
+        with open(file_name, 'r') as f:
+            d = json.load(f)
+        if d.get('version') == CACHE_VERSION:
+            # Only the resolvable channels are reused (older caches also have the timeouts)
+            return {key: value for key, value in d['channels'].items() if value[0] == RESOLVABLE}
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def save_cache(file_name: str, cache: dict):
+    """
+    Write the cached live results
+    :param file_name: cache file name
+    :param cache: dictionary of [status, time] lists indexed by channel name
+    """
+    d = {'version': CACHE_VERSION, 'channels': cache}
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        tmp_file_name = f'{file_name}.{os.getpid()}'
+        with open(tmp_file_name, 'w') as f:
+            json.dump(d, f, indent=2)
+        os.replace(tmp_file_name, file_name)
+    except OSError as e:
+        print(f'Cannot write cache file {file_name}: {e}', file=sys.stderr)
+
+
+def resolve(channels: list, offline=False, timeout=5.0, catalog_file=CATALOG_FILE, cache_file='',
+            max_age=DEFAULT_MAX_AGE) -> dict:
+    """
+    Classify the channels, checking only the ones that are not in the cache.
+    Only the resolvable channels are cached.
+    :param channels: list of channel names
+    :param offline: use the catalog instead of channel access
+    :param timeout: channel access timeout (seconds)
+    :param catalog_file: catalog file name
+    :param cache_file: cache file name for the live results (no cache if empty)
+    :param max_age: maximum age of the cached results (seconds)
+    :return: status dictionary indexed by channel name
+    """
+    if offline:
+        return check_catalog(channels, catalog_file)
+
+    cache = load_cache(cache_file) if cache_file else {}
+    now = time.time()
+    output_dict = {_: cache[_][0] for _ in channels if _ in cache and now - cache[_][1] <= max_age}
+    pending = [_ for _ in channels if _ not in output_dict]
+    instrument.count('cached', len(output_dict))
+    instrument.count('checked', len(pending))
+    if pending:
+        results = check_live(pending, timeout)
+        output_dict.update(results)
+        if cache_file:
+            for channel_name, status in results.items():
+                if status == RESOLVABLE:
+                    cache[channel_name] = [status, now]
+                else:
+                    cache.pop(channel_name, None)
+            save_cache(cache_file, cache)
+    return output_dict
+
+
+def print_results(channels: dict, results: dict, csv_output=False, include_all=False):
+    """
+    Print the channels that could not be resolved and a summary
+    :param channels: external_channels output
+    :param results: status dictionary indexed by channel name
+    :param csv_output: csv output?
+    :param include_all: include the resolvable channels
+    """
+    if csv_output:
+        print('Channel,Status,Files')
+    for channel_name in sorted(channels, key=lambda _: (results[_] == RESOLVABLE, results[_], _)):
+        status = results[channel_name]
+        if status == RESOLVABLE and not include_all:
+            continue
+        files = ' '.join(sorted(channels[channel_name]))
+        if csv_output:
+            print(f'{channel_name},{status},{files}')
+        else:
+            print(f'{channel_name:40} {status:12} {files}')
+    if not csv_output:
+        counts = {}
+        for status in results.values():
+            counts[status] = counts.get(status, 0) + 1
+        print(f'{len(results)} channels: ' + ', '.join([f'{counts[_]} {_}' for _ in sorted(counts)]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(action='store',
+                        dest='input_files',
+                        nargs='*',
+                        default=FILE_LIST,
+                        help='database files (default is the A&G database set)')
+
+    parser.add_argument('--offline',
+                        action='store_true',
+                        dest='offline',
+                        default=False,
+                        help='look up the records in the channel catalog instead of channel access')
+
+    parser.add_argument('--catalog',
+                        action='store',
+                        dest='catalog',
+                        default=CATALOG_FILE,
+                        help='catalog file (offline mode)')
+
+    parser.add_argument('--timeout',
+                        action='store',
+                        dest='timeout',
+                        type=float,
+                        default=5.0,
+                        help='channel access timeout (seconds)')
+
+    parser.add_argument('--cache',
+                        action='store',
+                        dest='cache',
+                        default=DEFAULT_CACHE_FILE,
+                        help='live results cache file (use an empty string to disable it)')
+
+    parser.add_argument('--max-age',
+                        action='store',
+                        dest='max_age',
+                        type=float,
+                        default=DEFAULT_MAX_AGE,
+                        help=f'reuse the cached results younger than this (default {DEFAULT_MAX_AGE:g} s)')
+
+    parser.add_argument('--csv',
+                        action='store_true',
+                        dest='csv',
+                        default=False,
+                        help='format output as csv')
+
+    parser.add_argument('--all',
+                        action='store_true',
+                        dest='all',
+                        default=False,
+                        help='include the resolvable channels')
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    instrument.start(args)
+
+    try:
+        channel_dict = external_channels(args.input_files)
+    except OSError as e:
+        print(e)
+        exit(1)
+
+    try:
+        result_dict = resolve(sorted(channel_dict), offline=args.offline, timeout=args.timeout,
+                              catalog_file=args.catalog, cache_file=args.cache, max_age=args.max_age)
+    except OSError as e:
+        print(e)
+        exit(1)
+    except KeyboardInterrupt:
+        print('Aborted')
+        exit(1)
+
+    print_results(channel_dict, result_dict, csv_output=args.csv, include_all=args.all)
+    instrument.finish(args)
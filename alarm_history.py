@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+Alarm history store. The alarm states read by check_alarms.py, sweep_alarms.py and
+process_alarms.py (--history option) are appended to a local SQLite file.
+
+Only the state changes are stored: each row is the start of a run of sweeps in which a
+record had the same severity and status (SEVR, STAT, NSEV, NSTA, stored as small integer
+codes). The storage grows with the number of state changes, not with the number of
+sweeps times the number of records. The changes are indexed by record and sweep, and
+the sweeps by time.
+
+Each sweep also refers to the set of records it covered. Sweeps of the same record list
+share the set, so the sets grow with the number of different lists. A record is assumed
+to keep its state from a sweep that covered it until the next sweep; the time after a
+sweep that did not cover the record is not counted in the durations.
+Sweeps have to be added in time order (add_sweep rejects older sweeps).
+
+Records that could not be read (timeout) are stored with the NOT_READ severity.
+
+Usage:
+* ./alarm_history.py add <capture file> [--time]        add a capture_alarms.csh output file
+* ./alarm_history.py count <prefix> [--severity] [--start] [--end]
+                                                         how often (and how long) records were in alarm
+* ./alarm_history.py show <prefix> [--start] [--end]    state changes of the records
+* ./alarm_history.py info                               number of sweeps, records and changes
+"""
+import os
+import hashlib
+import sqlite3
+import argparse
+from datetime import datetime
+from typing import Union
+from common import alarm_dict, ALARM_SEVERITY, ALARM_STATUS, NEW_ALARM_SEVERITY, NEW_ALARM_STATUS
+
+# Default history file. Can be changed with the ADE2_ALARM_HISTORY environment variable.
+HISTORY_FILE = os.environ.get('ADE2_ALARM_HISTORY',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alarm_history.sqlite'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sweeps (id INTEGER PRIMARY KEY, time REAL, source TEXT, records INTEGER);
+CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, name TEXT UNIQUE,
+                                    sevr INTEGER, stat INTEGER, nsev INTEGER, nsta INTEGER);
+CREATE TABLE IF NOT EXISTS changes (record INTEGER, sweep INTEGER,
+                                    sevr INTEGER, stat INTEGER, nsev INTEGER, nsta INTEGER,
+                                    PRIMARY KEY (record, sweep)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS record_sets (id INTEGER PRIMARY KEY, digest BLOB UNIQUE);
+CREATE TABLE IF NOT EXISTS set_members (record INTEGER, record_set INTEGER,
+                                        PRIMARY KEY (record, record_set)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sweeps_time ON sweeps (time);
+CREATE INDEX IF NOT EXISTS changes_sweep ON changes (sweep);
+"""
+
+# Severity and status codes (status codes are the ones in common.alarm_dict)
+SEVERITIES = ('NO_ALARM', 'MINOR', 'MAJOR', 'INVALID')
+SEVERITY_CODES = {name: code for code, name in enumerate(SEVERITIES)}
+STATUS_CODES = {name: int(code) for code, name in alarm_dict.items()}
+NOT_READ = -1
+UNKNOWN = 99
+
+# Date formats accepted in the command line
+DATE_FORMATS = ('%Y%m%d-%H%M%S', '%Y%m%d')
+
+
+def encode_value(value: str, codes: dict) -> int:
+    """
+    Convert a severity or status name to its code
+    :param value: severity or status (name or number)
+    :param codes: dictionary of codes indexed by name
+    :return: code, UNKNOWN if the name is not known
+    """
+    if value in codes:
+        return codes[value]
+    return int(value) if value.isdigit() else UNKNOWN
+
+
+def decode_value(code: int, names: dict) -> str:
+    """
+    Convert a severity or status code to its name
+    :param code: code
+    :param names: dictionary of names indexed by code
+    :return: name
+    """
+    if code == NOT_READ:
+        return 'NOT_READ'
+    return names.get(code, str(code))
+
+
+def encode_state(d: Union[dict, None]) -> tuple:
+    """
+    :param d: alarm dictionary (see common.default_alarm_dictionary), None if the record could not be read
+    :return: (SEVR, STAT, NSEV, NSTA) code tuple
+    """
+    if d is None:
+        return NOT_READ, NOT_READ, NOT_READ, NOT_READ
+    return (encode_value(d[ALARM_SEVERITY], SEVERITY_CODES), encode_value(d[ALARM_STATUS], STATUS_CODES),
+            encode_value(d[NEW_ALARM_SEVERITY], SEVERITY_CODES), encode_value(d[NEW_ALARM_STATUS], STATUS_CODES))
+
+
+def decode_state(state: tuple) -> tuple:
+    """
+    :param state: (SEVR, STAT, NSEV, NSTA) code tuple
+    :return: (SEVR, STAT, NSEV, NSTA) name tuple
+    """
+    severity_names = {code: name for name, code in SEVERITY_CODES.items()}
+    status_names = {code: name for name, code in STATUS_CODES.items()}
+    sevr, stat, nsev, nsta = state
+    return (decode_value(sevr, severity_names), decode_value(stat, status_names),
+            decode_value(nsev, severity_names), decode_value(nsta, status_names))
+
+
+def open_history(file_name=HISTORY_FILE) -> sqlite3.Connection:
+    """
+    Open (and create if needed) the history file
+    :param file_name: history file name
+    :return: database connection
+    """
+    db = sqlite3.connect(file_name)
+    db.executescript(SCHEMA)
+    if 'record_set' not in [_[1] for _ in db.execute('PRAGMA table_info(sweeps)')]:
+        # History created before the record sets were stored (these sweeps cover all the records)
+        db.execute('ALTER TABLE sweeps ADD COLUMN record_set INTEGER')
+        db.commit()
+    return db
+
+
+def record_set_id(db: sqlite3.Connection, record_ids: list) -> int:
+    """
+    Return the record set with these records, adding it if needed
+    :param db: database connection
+    :param record_ids: record ids
+    :return: record set id
+    """
+    digest = hashlib.blake2b(repr(sorted(record_ids)).encode(), digest_size=16).digest()
+    row = db.execute('SELECT id FROM record_sets WHERE digest = ?', (digest,)).fetchone()
+    if row is not None:
+        return row[0]
+    set_id = db.execute('INSERT INTO record_sets VALUES (NULL, ?)', (digest,)).lastrowid
+    db.executemany('INSERT INTO set_members VALUES (?, ?)', [(_, set_id) for _ in record_ids])
+    return set_id
+
+
+def add_sweep(states: dict, sweep_time: Union[datetime, None] = None, source='', file_name=HISTORY_FILE) -> int:
+    """
+    Append the result of a sweep to the history. Only the records whose state
+    changed since their last sweep are stored, so sweeps have to be added in time order.
+    :param states: dictionary of alarm dictionaries (None if the record could not be read) indexed by record name
+    :param sweep_time: time of the sweep (default is now)
+    :param source: program (and file) that produced the sweep
+    :param file_name: history file name
+    :return: number of state changes stored
+    :raise ValueError: if the sweep is older than the last sweep in the history
+    """
+    t = (sweep_time if sweep_time is not None else datetime.now()).timestamp()
+    db = open_history(file_name)
+    t_last = db.execute('SELECT MAX(time) FROM sweeps').fetchone()[0]
+    if t_last is not None and t < t_last:
+        db.close()
+        raise ValueError(f'sweep time {format_time(t)} is before the last sweep in {file_name} '
+                         f'({format_time(t_last)}), sweeps have to be added in time order')
+    last = {name: (record_id, (sevr, stat, nsev, nsta))
+            for record_id, name, sevr, stat, nsev, nsta in db.execute('SELECT * FROM records')}
+    sweep_id = db.execute('INSERT INTO sweeps (time, source, records) VALUES (?, ?, ?)',
+                          (t, source, len(states))).lastrowid
+    change_rows = []
+    record_ids = []
+    for record_name, d in states.items():
+        state = encode_state(d)
+        if record_name not in last:
+            record_id = db.execute('INSERT INTO records VALUES (NULL, ?, ?, ?, ?, ?)',
+                                   (record_name,) + state).lastrowid
+            record_ids.append(record_id)
+        else:
+            record_id, last_state = last[record_name]
+            record_ids.append(record_id)
+            if state == last_state:
+                continue
+            db.execute('UPDATE records SET sevr = ?, stat = ?, nsev = ?, nsta = ? WHERE id = ?', state + (record_id,))
+        change_rows.append((record_id, sweep_id) + state)
+    db.executemany('INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)', change_rows)
+    db.execute('UPDATE sweeps SET record_set = ? WHERE id = ?', (record_set_id(db, record_ids), sweep_id))
+    db.commit()
+    db.close()
+    return len(change_rows)
+
+
+def last_states(file_name=HISTORY_FILE) -> dict:
+    """
+    Return the state of each record in its last sweep
+    :param file_name: history file name
+    :return: dictionary of (SEVR, STAT, NSEV, NSTA) code tuples indexed by record name
+    """
+    db = open_history(file_name)
+    output_dict = {name: (sevr, stat, nsev, nsta)
+                   for name, sevr, stat, nsev, nsta in db.execute('SELECT name, sevr, stat, nsev, nsta FROM records')}
+    db.close()
+    return output_dict
+
+
+def record_changes(prefix: str, start: Union[datetime, None] = None, end: Union[datetime, None] = None,
+                   file_name=HISTORY_FILE) -> tuple:
+    """
+    Return the state changes of the records matching a prefix. The state at the start
+    of the interval is included (with the time of the change that started it).
+    :param prefix: record name prefix (a full record name selects that record)
+    :param start: start of the interval (default is the first sweep)
+    :param end: end of the interval (default is the last sweep)
+    :param file_name: history file name
+    :return: tuple with a dictionary of lists of (time, state code tuple) indexed by record name,
+             and the time of the last sweep in the interval (None if there are no sweeps)
+    """
+    t_start = start.timestamp() if start is not None else float('-inf')
+    t_end = end.timestamp() if end is not None else float('inf')
+    db = open_history(file_name)
+    last_sweep = db.execute('SELECT MAX(time) FROM sweeps WHERE time <= ?', (t_end,)).fetchone()[0]
+    rows = db.execute('SELECT r.name, s.time, c.sevr, c.stat, c.nsev, c.nsta '
+                      'FROM records r JOIN changes c ON c.record = r.id JOIN sweeps s ON s.id = c.sweep '
+                      'WHERE r.name >= ? AND r.name < ? AND s.time <= ? ORDER BY r.name, c.sweep',
+                      (prefix, prefix + '\uffff', t_end)).fetchall()
+    db.close()
+
+    output_dict = {}
+    for record_name, t, sevr, stat, nsev, nsta in rows:
+        changes = output_dict.setdefault(record_name, [])
+        # Keep only the last change before the start of the interval
+        if changes and changes[-1][0] <= t_start and t <= t_start:
+            changes.pop()
+        changes.append((t, (sevr, stat, nsev, nsta)))
+    return output_dict, last_sweep
+
+
+def alarm_counts(prefix: str, severity='MAJOR', start: Union[datetime, None] = None,
+                 end: Union[datetime, None] = None, file_name=HISTORY_FILE) -> dict:
+    """
+    Count how many times the records matching a prefix went into a severity (SEVR)
+    and for how long, within an interval. The state of a record read in a sweep is assumed
+    to last until the next sweep (or the last sweep in the interval). The time after the
+    sweeps that did not cover the record is not counted.
+    :param prefix: record name prefix
+    :param severity: severity name (SEVERITIES, or NOT_READ)
+    :param start: start of the interval (default is the first sweep)
+    :param end: end of the interval (default is the last sweep)
+    :param file_name: history file name
+    :return: dictionary of (count, seconds) tuples indexed by record name (only records with count > 0)
+    """
+    code = NOT_READ if severity == 'NOT_READ' else SEVERITY_CODES[severity]
+    changes, last_sweep = record_changes(prefix, start=start, end=end, file_name=file_name)
+    t_start = start.timestamp() if start is not None else float('-inf')
+    t_end = end.timestamp() if end is not None else float('inf')
+    db = open_history(file_name)
+    sweeps = db.execute('SELECT time, record_set FROM sweeps WHERE time <= ? ORDER BY time, id', (t_end,)).fetchall()
+    members = {}
+    for record_name, set_id in db.execute('SELECT r.name, m.record_set FROM records r '
+                                          'JOIN set_members m ON m.record = r.id WHERE r.name >= ? AND r.name < ?',
+                                          (prefix, prefix + '\uffff')):
+        members.setdefault(record_name, set()).add(set_id)
+    db.close()
+
+    output_dict = {}
+    for record_name, change_list in changes.items():
+        covered = members.get(record_name, set())
+        count = 0
+        seconds = 0.0
+        previous = None
+        state = None
+        n = 0
+        for k, (t, set_id) in enumerate(sweeps):
+            # Sweeps without a record set were added before the sets were stored, and cover all the records
+            if set_id is not None and set_id not in covered:
+                continue
+            while n < len(change_list) and change_list[n][0] <= t:
+                state = change_list[n][1]
+                n += 1
+            if state is None:
+                continue
+            t_next = sweeps[k + 1][0] if k + 1 < len(sweeps) else last_sweep
+            if state[0] == code:
+                if previous != code and t > t_start:
+                    count += 1
+                seconds += max(0.0, t_next - max(t, t_start))
+            previous = state[0]
+        if count or seconds:
+            output_dict[record_name] = (count, seconds)
+    return output_dict
+
+
+def history_info(file_name=HISTORY_FILE) -> dict:
+    """
+    :param file_name: history file name
+    :return: dictionary with the number of sweeps, records and changes, and the time of the first and last sweep
+    """
+    db = open_history(file_name)
+    d = {'sweeps': db.execute('SELECT COUNT(*) FROM sweeps').fetchone()[0],
+         'records': db.execute('SELECT COUNT(*) FROM records').fetchone()[0],
+         'changes': db.execute('SELECT COUNT(*) FROM changes').fetchone()[0]}
+    d['first'], d['last'] = db.execute('SELECT MIN(time), MAX(time) FROM sweeps').fetchone()
+    db.close()
+    return d
+
+
+def parse_date(s: str) -> Union[datetime, None]:
+    """
+    :param s: date (DATE_FORMATS)
+    :return: datetime, None if the string is empty
+    """
+    if not s:
+        return None
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(s, date_format)
+        except ValueError:
+            pass
+    raise ValueError(f'invalid date {s}')
+
+
+def format_time(t: float) -> str:
+    """
+    :param t: time stamp
+    :return: formatted time
+    """
+    return datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', action='store', default=HISTORY_FILE, help='history file')
+    subparsers = parser.add_subparsers(dest='command')
+
+    add_parser = subparsers.add_parser('add', help='add a capture_alarms.csh output file')
+    add_parser.add_argument('input_file', help='capture file')
+    add_parser.add_argument('--time', action='store', default='',
+                            help='sweep time (YYYYMMDD-HHMMSS, default is the file modification time)')
+
+    for name, text in (('count', 'how often records went into a severity'), ('show', 'state changes')):
+        p = subparsers.add_parser(name, help=text)
+        p.add_argument('prefix', help='record name or prefix')
+        p.add_argument('--start', action='store', default='', help='start date (YYYYMMDD[-HHMMSS])')
+        p.add_argument('--end', action='store', default='', help='end date (YYYYMMDD[-HHMMSS])')
+        p.add_argument('--csv', action='store_true', default=False, help='format output as csv')
+        if name == 'count':
+            p.add_argument('--severity', action='store', default='MAJOR', choices=SEVERITIES + ('NOT_READ',),
+                           help='severity (default MAJOR)')
+
+    subparsers.add_parser('info', help='number of sweeps, records and changes')
+
+    args = parser.parse_args()
+
+    try:
+        start_date = parse_date(getattr(args, 'start', ''))
+        end_date = parse_date(getattr(args, 'end', ''))
+        sweep_date = parse_date(getattr(args, 'time', ''))
+    except ValueError as e:
+        print(e)
+        exit(1)
+
+    if args.command == 'add':
+        from process_alarms import process_file
+        try:
+            if sweep_date is None:
+                sweep_date = datetime.fromtimestamp(os.path.getmtime(args.input_file))
+            alarms = process_file(args.input_file)
+        except OSError:
+            print(f'file {args.input_file} does not exist')
+            exit(1)
+        try:
+            n = add_sweep(alarms, sweep_time=sweep_date, source=f'capture {os.path.abspath(args.input_file)}',
+                          file_name=args.history)
+        except ValueError as e:
+            print(e)
+            exit(1)
+        print(f'{len(alarms)} records, {n} changes')
+    elif args.command == 'count':
+        count_dict = alarm_counts(args.prefix, severity=args.severity, start=start_date, end=end_date,
+                                  file_name=args.history)
+        if args.csv:
+            print('Record name,count,seconds')
+        for record_name in sorted(count_dict, key=lambda _: (-count_dict[_][0], _)):
+            n, seconds = count_dict[record_name]
+            if args.csv:
+                print(f'{record_name},{n},{seconds:.0f}')
+            else:
+                print(f'{record_name:40}{n:>8}{seconds / 3600:>10.1f} h')
+    elif args.command == 'show':
+        change_dict, _ = record_changes(args.prefix, start=start_date, end=end_date, file_name=args.history)
+        if args.csv:
+            print('Record name,time,SEVR,STAT,NSEV,NSTA')
+        for record_name in change_dict:
+            for t, state in change_dict[record_name]:
+                names = decode_state(state)
+                if args.csv:
+                    print(f'{record_name},{format_time(t)},{",".join(names)}')
+                else:
+                    print(f'{record_name:40}{format_time(t):22}' + ''.join(f'{_:15}' for _ in names))
+    elif args.command == 'info':
+        d = history_info(file_name=args.history)
+        print(f'{d["sweeps"]} sweeps, {d["records"]} records, {d["changes"]} changes')
+        if d['first'] is not None:
+            print(f'from {format_time(d["first"])} to {format_time(d["last"])}')
+    else:
+        parser.print_help()
@@ -26,7 +26,12 @@ VALI    sample on table or number of written arrays (0..19)
 import re
 import argparse
 from datetime import datetime
-import matplotlib.pyplot as plt
+from typing import Union
+from functools import partial
+# numpy and matplotlib are imported by the functions that use them (startup time)
+from log_reader import map_lines, map_chunks
+from catalog import channel_group
+import instrument
 
 # Used to filter out lines with valid time stamps
 YEAR = datetime.now().year
@@ -34,6 +39,10 @@ YEAR = datetime.now().year
 # Starting date. It is set to the first time stamp in the daya so plots are relative to the start of the data
 starting_time = None
 
+# Wavefront sensors (channel name prefixes)
+# The OIWFS records (oiwfs: prefix) have no followA or interpol channels, so there is no 'oi' entry
+WFS_LIST = ['p1', 'p2']
+
 # Indices to extract data from the log lines
 INDEX_CHANNEL_NAME = 0
 INDEX_DATE = 1
@@ -44,6 +53,26 @@ INDEX_X = 7
 INDEX_Y = 8
 INDEX_Z = 9
 
+# Percentiles reported by the latency analysis
+PERCENTILES = (50, 90, 95, 99, 100)
+
+# A sample interval longer than GAP_FACTOR times the median interval is counted as a gap
+GAP_FACTOR = 3
+
+# Channels used by the batch summary (keys in the channel dictionary)
+SUMMARY_KEYS = ('t', 'vx', 'vy', 'vz', 't3', 'x3', 'y3', 'z3')
+
+# Batch summary columns
+SUMMARY_COLUMNS = ('file', 'wfs', 'start', 'samples', 'duration', 'rate', 'gaps', 'max_gap',
+                   'max_vx', 'max_vy', 'max_vz')
+
+# Channels used by the latency analysis (keys in the channel dictionary).
+# The demands are indexed by followA field (old/middle/new demand).
+DEMAND_KEYS = {'A': ('t1', 'x1', 'y1', 'z1'),
+               'B': ('t2', 'x2', 'y2', 'z2'),
+               'C': ('t3', 'x3', 'y3', 'z3')}
+INTERPOL_KEYS = ('t', 'x', 'y', 'z')
+
 
 def date_to_datetime(date: str, time: str) -> datetime:
     """
@@ -63,8 +92,17 @@ def date_to_delta(date: str, time: str) -> float:
     :param time: time 'HH:MM:SS.SSSSSS'
     :return: seconds from reference
     """
+    return datetime_to_delta(date_to_datetime(date, time))
+
+
+def datetime_to_delta(dt: datetime) -> float:
+    """
+    Convert a datetime object to seconds from the starting time.
+    The starting time is set to the first value converted.
+    :param dt: datetime object
+    :return: seconds from reference
+    """
     global starting_time
-    dt = datetime.strptime(f'{date} {time}', '%Y-%m-%d %H:%M:%S.%f')
     if starting_time is None:
         starting_time = dt
     delta = dt - starting_time
@@ -72,97 +110,379 @@ def date_to_delta(date: str, time: str) -> float:
     return delta.total_seconds()
 
 
+def reset_starting_time():
+    """
+    Clear the starting time, so the next time stamp becomes the new reference.
+    Used when processing several files in the same process.
+    """
+    global starting_time
+    starting_time = None
+
+
+def parse_channel_lines(channel_name: str, channel_index: int, lines: list) -> list:
+    """
+    Line handler used by extract_data.
+    Return the time stamp and value of the lines matching the channel name.
+    :param channel_name: channel name to extract
+    :param channel_index: data index in the line
+    :param lines: input lines
+    :return: list of (datetime, value) tuples
+    """
+    m = re.compile(f'^{channel_name}.*{YEAR}')
+    output_list = []
+    for line in lines:
+        if m.search(line):
+            line = line.strip().split()
+            output_list.append((date_to_datetime(line[INDEX_DATE], line[INDEX_TIME]),
+                                float(line[channel_index])))
+    return output_list
+
+
 def extract_data(file_name: str, channel_name: str, channel_index: int) -> tuple:
     """
     Extract data matching the channel name from the file.
     Each file in the line consists of the channel name, date, time and data.
     Data starts at INDEX_DATA and can continue for array data.
+    The file is parsed in parallel chunks (see log_reader).
     :param file_name: input file
     :param channel_name: channel name to extract
     :param channel_index: data index in the line
     :return:
     """
-    m = re.compile(f'^{channel_name}.*{YEAR}')
     t_out = []
     v_out = []
     try:
-        f = open(file_name, 'r')
+        with instrument.timer('wfs parse'):
+            samples = map_lines(file_name, partial(parse_channel_lines, channel_name, channel_index))
     except OSError:
         print(f'File {file_name} does not exist')
         return None, None
 
-    for line in f:
-        if m.search(line):
-            line = line.strip().split()
-            # print(line)
-            # t_out.append(date_to_datetime(line[1], line[2]))
-            t = date_to_delta(line[INDEX_DATE], line[INDEX_TIME])
-            print('--', t, line[channel_index])
+    with instrument.timer('wfs merge'):
+        for dt, v in samples:
+            t = datetime_to_delta(dt)
             if t < 0:
                 continue
             t_out.append(t)
-            v_out.append(float(line[channel_index]))
+            v_out.append(v)
+    instrument.count('wfs samples', len(t_out))
     return t_out, v_out
 
 
+def parse_channel_dict_lines(channels: dict, lines: list) -> dict:
+    """
+    Line handler used by extract_channels.
+    Same as parse_channel_lines, but for several channels at once.
+    :param channels: dictionary of (channel name, data index) tuples
+    :param lines: input lines
+    :return: dictionary with a list of (datetime, value) tuples for each key
+    """
+    # Map channel names to the keys (and data indices) that use them,
+    # and to the number of fields a line needs to hold all those indices
+    name_dict = {}
+    min_length = {}
+    for key, (channel_name, channel_index) in channels.items():
+        name_dict.setdefault(channel_name, []).append((key, channel_index))
+        min_length[channel_name] = max(min_length.get(channel_name, INDEX_DATA + 1), channel_index + 1)
+
+    year = str(YEAR)
+    output_dict = {key: [] for key in channels}
+    for line in lines:
+        line = line.strip().split()
+        if len(line) <= INDEX_DATA or line[INDEX_CHANNEL_NAME] not in name_dict or year not in line[INDEX_DATE]:
+            continue
+        # Skip short lines altogether, so the lists of the keys sharing a channel stay aligned
+        if len(line) < min_length[line[INDEX_CHANNEL_NAME]]:
+            continue
+        dt = date_to_datetime(line[INDEX_DATE], line[INDEX_TIME])
+        for key, channel_index in name_dict[line[INDEX_CHANNEL_NAME]]:
+            output_dict[key].append((dt, float(line[channel_index])))
+    return output_dict
+
+
+def extract_channels(file_name: str, channels: dict, workers: Union[int, None] = None) -> Union[dict, None]:
+    """
+    Extract the data for several channels in a single pass over the file.
+    Times are relative to the starting time, as in extract_data.
+    :param file_name: input file
+    :param channels: dictionary of (channel name, data index) tuples
+    :param workers: number of worker processes used to parse the file (None = number of cores)
+    :return: dictionary with a (time list, value list) tuple for each key, None on error
+    """
+    try:
+        with instrument.timer('wfs parse'):
+            chunks = map_chunks(file_name, partial(parse_channel_dict_lines, channels), workers=workers)
+    except OSError:
+        print(f'File {file_name} does not exist')
+        return None
+
+    output_dict = {key: ([], []) for key in channels}
+    with instrument.timer('wfs merge'):
+        for chunk in chunks:
+            # Use the earliest sample of any channel as the reference
+            if starting_time is None:
+                first = [chunk[key][0][0] for key in chunk if chunk[key]]
+                if first:
+                    datetime_to_delta(min(first))
+            for key in chunk:
+                t_out, v_out = output_dict[key]
+                for dt, v in chunk[key]:
+                    t = datetime_to_delta(dt)
+                    if t < 0:
+                        continue
+                    t_out.append(t)
+                    v_out.append(v)
+    instrument.count('wfs samples', sum(len(_[0]) for _ in output_dict.values()))
+    return output_dict
+
+
+def asof_values(t_ref: 'np.ndarray', v_ref: 'np.ndarray', t: 'np.ndarray') -> 'np.ndarray':
+    """
+    Vectorized "as of" join. Return the last reference value at or before each time.
+    Times before the first reference are returned as NaN.
+    :param t_ref: sorted reference times
+    :param v_ref: reference values
+    :param t: times to look up
+    :return: array of values
+    """
+    import numpy as np
+    index = np.searchsorted(t_ref, t, side='right') - 1
+    output = np.full(len(t), np.nan)
+    valid = index >= 0
+    output[valid] = v_ref[index[valid]]
+    return output
+
+
+def analyze_latency(file_name: str, wfs_list: list) -> Union[dict, None]:
+    """
+    Join the followA demands (VALA/B/C) with the interpol output samples and
+    compute the tracking error and update latency distributions of each wavefront sensor.
+    The file is parsed once for all the sensors.
+
+    Interpol samples are assembled by joining VALA/B/C with the apply time (VALG) on
+    the monitor time stamp. The demands of the three followA fields are merged, sorted by
+    apply time, and the demand position at each interpol apply time is linearly interpolated
+    between them. The update latency is the time from a demand arrival to the next interpol
+    update, computed for each followA field.
+    :param file_name: input file
+    :param wfs_list: wavefront sensor names
+    :return: dictionary with a metric dictionary (arrays of values for each metric) for each
+             wavefront sensor with data, None on error
+    """
+    import numpy as np
+    keys = [key for slot_keys in DEMAND_KEYS.values() for key in slot_keys] + list(INTERPOL_KEYS)
+    channels = {}
+    for wfs_name in wfs_list:
+        channel_dictionary = create_channel_dictionary(wfs_name)
+        for key in keys:
+            channels[f'{wfs_name}:{key}'] = channel_dictionary[key]
+    data = extract_channels(file_name, channels)
+    if data is None:
+        return None
+
+    output_dict = {}
+    for wfs_name in wfs_list:
+        d = {key: (np.asarray(data[f'{wfs_name}:{key}'][0]), np.asarray(data[f'{wfs_name}:{key}'][1]))
+             for key in keys}
+        slots = [slot for slot, slot_keys in DEMAND_KEYS.items() if len(d[slot_keys[0]][0])]
+        if not slots or not all(len(d[key][0]) for key in INTERPOL_KEYS):
+            print(f'No {wfs_name} demand or interpol data in {file_name}')
+            continue
+
+        # Demands of all the fields. The values of a field come from the same line so they are aligned.
+        # Sort by apply time and drop the demands repeated when they move from VALC to VALB and VALA.
+        d_apply = np.concatenate([d[DEMAND_KEYS[slot][0]][1] for slot in slots])
+        d_pos = [np.concatenate([d[DEMAND_KEYS[slot][n]][1] for slot in slots]) for n in (1, 2, 3)]
+        d_apply, index = np.unique(d_apply, return_index=True)
+        d_pos = [_[index] for _ in d_pos]
+
+        # Interpol output, one sample per apply time (VALG) update
+        i_arrival, i_apply = d['t']
+        i_pos = [asof_values(d[key][0], d[key][1], i_arrival) for key in INTERPOL_KEYS[1:]]
+
+        # Tracking error, only where the apply time is covered by the demands
+        covered = (i_apply >= d_apply[0]) & (i_apply <= d_apply[-1])
+        metric_dict = {}
+        for axis, demand, current in zip(('x', 'y', 'z'), d_pos, i_pos):
+            error = current[covered] - np.interp(i_apply[covered], d_apply, demand)
+            metric_dict[f'|error {axis}|'] = np.abs(error[~np.isnan(error)])
+
+        # Update latency: demand arrival to the first interpol update after it
+        for slot in slots:
+            d_arrival = d[DEMAND_KEYS[slot][0]][0]
+            index = np.searchsorted(i_arrival, d_arrival, side='left')
+            valid = index < len(i_arrival)
+            metric_dict[f'update latency {slot}'] = i_arrival[index[valid]] - d_arrival[valid]
+            metric_dict[f'demand period {slot}'] = np.diff(d_arrival)
+        metric_dict['interpol period'] = np.diff(i_arrival)
+        output_dict[wfs_name] = metric_dict
+
+    return output_dict
+
+
+def print_percentiles(metrics: dict):
+    """
+    Print the number of samples, mean and percentiles of each metric
+    :param metrics: dictionary of value arrays
+    """
+    import numpy as np
+    title = f'{"metric":20}{"n":>10}{"mean":>14}'
+    for p in PERCENTILES:
+        title += f'{"p" + str(p):>14}'
+    print(title)
+    for name, values in metrics.items():
+        line = f'{name:20}{len(values):>10}'
+        if len(values):
+            line += f'{np.mean(values):>14.6g}'
+            for v in np.percentile(values, PERCENTILES):
+                line += f'{v:>14.6g}'
+        print(line)
+
+
+def sample_statistics(t: 'np.ndarray') -> tuple:
+    """
+    Compute the sample rate and the gaps in a sorted time array.
+    A gap is an interval longer than GAP_FACTOR times the median interval.
+    :param t: sorted time array
+    :return: (rate, number of gaps, longest interval) tuple
+    """
+    import numpy as np
+    if len(t) < 2 or t[-1] <= t[0]:
+        return 0.0, 0, 0.0
+    dt = np.diff(t)
+    rate = (len(t) - 1) / (t[-1] - t[0])
+    gaps = int(np.count_nonzero(dt > GAP_FACTOR * np.median(dt)))
+    return rate, gaps, float(np.max(dt))
+
+
+def summarize_file(file_name: str, wfs_list: list, workers: Union[int, None] = None) -> list:
+    """
+    Compute the summary statistics of each wavefront sensor in a file.
+    The rate and gaps are computed from the interpol apply time updates, or from the
+    new demand (followA.VALC) updates for captures without interpol data.
+    Velocities come from interpol VALD/E/F, or are derived from the new demands.
+    :param file_name: input file
+    :param wfs_list: wavefront sensor names
+    :param workers: number of worker processes used to parse the file (None = number of cores)
+    :return: list of dictionaries, one per wavefront sensor with data, keyed by SUMMARY_COLUMNS
+    """
+    import numpy as np
+    channels = {}
+    for wfs_name in wfs_list:
+        channel_dictionary = create_channel_dictionary(wfs_name)
+        for key in SUMMARY_KEYS:
+            channels[f'{wfs_name}:{key}'] = channel_dictionary[key]
+
+    reset_starting_time()
+    data = extract_channels(file_name, channels, workers=workers)
+    if data is None or starting_time is None:
+        return []
+    start = starting_time.isoformat(sep=' ')
+
+    output_list = []
+    for wfs_name in wfs_list:
+        d = {key: (np.asarray(data[f'{wfs_name}:{key}'][0]), np.asarray(data[f'{wfs_name}:{key}'][1]))
+             for key in SUMMARY_KEYS}
+        if len(d['t'][0]):
+            t = d['t'][0]
+            velocity = [np.abs(d[key][1]) for key in ('vx', 'vy', 'vz')]
+        elif len(d['t3'][0]):
+            t = d['t3'][0]
+            apply_time = d['t3'][1]
+            dt = np.diff(apply_time)
+            valid = dt > 0
+            velocity = [np.abs(np.diff(d[key][1])[valid] / dt[valid]) for key in ('x3', 'y3', 'z3')]
+        else:
+            continue
+        rate, gaps, max_gap = sample_statistics(t)
+        row = {'file': file_name, 'wfs': wfs_name, 'start': start, 'samples': len(t),
+               'duration': float(t[-1] - t[0]), 'rate': rate, 'gaps': gaps, 'max_gap': max_gap}
+        for column, v in zip(('max_vx', 'max_vy', 'max_vz'), velocity):
+            row[column] = float(np.max(v)) if len(v) else ''
+        output_list.append(row)
+    return output_list
+
+
+def batch_summary(file_list: list, wfs_list: list, workers: Union[int, None] = None) -> list:
+    """
+    Summarize several files in parallel, one file per worker process.
+    :param file_list: input files
+    :param wfs_list: wavefront sensor names
+    :param workers: number of worker processes (None = number of cores)
+    :return: list of summary dictionaries, in input file order
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if workers == 1 or len(file_list) < 2:
+        return [row for file_name in file_list for row in summarize_file(file_name, wfs_list)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(summarize_file, file_name, wfs_list, 1) for file_name in file_list]
+        return [row for future in futures for row in future.result()]
+
+
+def write_summary(rows: list, file_name=''):
+    """
+    Write the batch summary in csv format, to a file or to the standard output
+    :param rows: list of summary dictionaries
+    :param file_name: output file name (standard output if empty)
+    """
+    lines = [','.join(SUMMARY_COLUMNS)]
+    for row in rows:
+        lines.append(','.join(f'{row[_]:.6g}' if isinstance(row[_], float) else str(row[_])
+                              for _ in SUMMARY_COLUMNS))
+    if file_name:
+        with open(file_name, 'w') as f:
+            for line in lines:
+                f.write(f'{line}\n')
+    else:
+        for line in lines:
+            print(line)
+
+
 def plot_data(title: str, t: list, v: list):
     """
     Plot single set of data
+    The data is decimated to the plot resolution (see decimate).
     :param title: plot title
     :param t: time list
     :param v: value list
     """
+    import matplotlib.pyplot as plt
+    from decimate import DecimatedLine
     plt.title(title)
-    plt.plot(t, v)
+    ax = plt.gca()
+    # Keep the line referenced by the axes, matplotlib only keeps weak references to the zoom callbacks
+    ax.decimated_line = DecimatedLine(ax, t, v)
     plt.show()
 
 
 def plot_data_2(title: str, t_1: list, v_1: list, t_2: list, v_2: list):
     """
     Plot two sets of data
+    The data is decimated to the plot resolution (see decimate).
     :param title: plot title
     :param t_1: time list for set 1
     :param v_1: value list for set 1
     :param t_2: time list for set 2
     :param v_2: value list for set 2
     """
+    import matplotlib.pyplot as plt
+    from decimate import DecimatedLine
     fig, (ax1, ax2) = plt.subplots(2)
     fig.suptitle(title)
-    ax1.plot(t_1, v_1)
-    ax2.plot(t_2, v_2)
+    # Keep the lines referenced by the axes, matplotlib only keeps weak references to the zoom callbacks
+    ax1.decimated_line = DecimatedLine(ax1, t_1, v_1)
+    ax2.decimated_line = DecimatedLine(ax2, t_2, v_2)
     plt.show()
 
 
 def create_channel_dictionary(wfs_name: str) -> dict:
-    return {
-        't1': (f'ag:{wfs_name}:followA.VALA', INDEX_APPLY_TIME),
-        'x1': (f'ag:{wfs_name}:followA.VALA', INDEX_X),
-        'y1': (f'ag:{wfs_name}:followA.VALA', INDEX_Y),
-        'z1': (f'ag:{wfs_name}:followA.VALA', INDEX_Z),
-
-        't2': (f'ag:{wfs_name}:followA.VALB', INDEX_APPLY_TIME),
-        'x2': (f'ag:{wfs_name}:followA.VALB', INDEX_X),
-        'y2': (f'ag:{wfs_name}:followA.VALB', INDEX_Y),
-        'z2': (f'ag:{wfs_name}:followA.VALB', INDEX_Z),
-
-        't3': (f'ag:{wfs_name}:followA.VALC', INDEX_APPLY_TIME),
-        'x3': (f'ag:{wfs_name}:followA.VALC', INDEX_X),
-        'y3': (f'ag:{wfs_name}:followA.VALC', INDEX_Y),
-        'z3': (f'ag:{wfs_name}:followA.VALC', INDEX_Z),
-
-        'x': (f'ag:{wfs_name}:interpol.VALA', INDEX_DATA),
-        'y': (f'ag:{wfs_name}:interpol.VALB', INDEX_DATA),
-        'z': (f'ag:{wfs_name}:interpol.VALC', INDEX_DATA),
-
-        'vx': (f'ag:{wfs_name}:interpol.VALD', INDEX_DATA),
-        'vy': (f'ag:{wfs_name}:interpol.VALE', INDEX_DATA),
-        'vz': (f'ag:{wfs_name}:interpol.VALF', INDEX_DATA),
-
-        't': (f'ag:{wfs_name}:interpol.VALG', INDEX_DATA),
-
-        'gs': (f'ag:{wfs_name}:interpol.VALH', INDEX_DATA),
-        's': (f'ag:{wfs_name}:interpol.VALI', INDEX_DATA)
-    }
+    """
+    Create the dictionary used to map channel names to the channel and data index
+    to extract. The channels are defined in the 'wfs' group of the channel catalog.
+    :param wfs_name: wavefront sensor name
+    :return: dictionary of (channel name, data index) tuples
+    """
+    return {key: (channel, index) for key, channel, index in channel_group('wfs', wfs=wfs_name)}
 
 
 if __name__ == '__main__':
@@ -175,13 +495,20 @@ if __name__ == '__main__':
     # exit(0)
 
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('input_file', action='store', help='input file')
-    parser.add_argument('c1', action='store',
+    parser.add_argument('input_file', action='store', nargs='?', default='', help='input file')
+    parser.add_argument('c1', action='store', nargs='?', default='',
                         help='first channel to plot')
     parser.add_argument('c2', action='store', nargs='?', default='',
                         help='second channel to plot (optional)')
-    parser.add_argument('--wfs', action='store', default='p1',
-                        choices=['p1', 'p2'], help='wavefront sensor')
+    parser.add_argument('--wfs', action='append', default=None, choices=WFS_LIST,
+                        help='wavefront sensor (default p1). Can be repeated in batch and latency modes')
+    parser.add_argument('--latency', action='store_true', default=False,
+                        help='print the tracking error and update latency percentiles instead of plotting')
+    parser.add_argument('--batch', action='store', nargs='+', default=[], metavar='FILE',
+                        help='write summary statistics for several files (no plotting)')
+    parser.add_argument('--output', action='store', default='',
+                        help='batch summary output file (default is standard output)')
+    instrument.add_arguments(parser)
 
     parser.epilog = """
     Channel names:
@@ -200,8 +527,27 @@ if __name__ == '__main__':
     """
 
     args = parser.parse_args()
-
-    channel_dictionary = create_channel_dictionary(args.wfs)
+    instrument.start(args)
+    wfs_list = args.wfs if args.wfs else ['p1']
+    if len(wfs_list) > 1 and not (args.batch or args.latency):
+        parser.error('only one --wfs value can be plotted')
+
+    if args.batch:
+        write_summary(batch_summary(args.batch, wfs_list), file_name=args.output)
+        instrument.finish(args)
+        exit(0)
+
+    if args.latency:
+        output_dict = analyze_latency(args.input_file, wfs_list)
+        if output_dict is not None:
+            for wfs_name, metric_dict in output_dict.items():
+                if len(wfs_list) > 1:
+                    print(wfs_name)
+                print_percentiles(metric_dict)
+        instrument.finish(args)
+        exit(0)
+
+    channel_dictionary = create_channel_dictionary(wfs_list[0])
 
     t1, v1, t2, v2 = None, None, None, None
 
@@ -214,6 +560,8 @@ if __name__ == '__main__':
         t2, v2 = extract_data(args.input_file, channel_dictionary[args.c2][0],
                               channel_dictionary[args.c2][1])
 
+    instrument.finish(args)
+
     # Plot data
     if t1 is not None and t2 is not None:
         plot_data_2(f'{args.input_file}: {args.c1} - {args.c2}', t1, v1, t2, v2)
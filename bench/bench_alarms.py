@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Alarm sweep benchmark against a local stand-in for the IOCs.
+
+A local channel access server is started with the alarm fields (SEVR, STAT, NSEV,
+NSTA, DESC, AMSG, NAMSG) of a sample of the records in the ag/*.db files.
+A configurable fraction of the records is in alarm, disconnected (not served)
+or slow (every read is delayed).
+
+Each sweep backend is run against the server in a separate process and the
+number of records per second, the p50/p99 per record latency and the peak RSS
+are reported. Backends:
+* ca        check_alarms.py low level channel access interface (default)
+* pv        check_alarms.py PV interface (--pv)
+* caget     capture_alarms.csh (requires csh and caget)
+
+The server is either caproto (pip install caproto) or softIoc from EPICS base.
+The softIoc server does not support slow records.
+
+Requirements: pyepics for the ca and pv backends.
+Everything runs on the local host (127.0.0.1), using its own server port.
+
+Running:
+* ./bench_alarms.py [options]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ag'))
+
+BACKENDS = ['ca', 'pv', 'caget']
+SERVERS = ['caproto', 'softioc']
+
+# Default channel access server port (not the standard one, to avoid talking to real IOCs)
+DEFAULT_PORT = 15064
+
+# Time to wait for the server to start (seconds)
+SERVER_STARTUP = 5.0
+
+# Alarm field values
+ALARM_VALUES = {'SEVR': 'MAJOR', 'STAT': 'HIHI', 'NSEV': 'MAJOR', 'NSTA': 'HIHI',
+                'AMSG': 'benchmark alarm', 'NAMSG': ''}
+NO_ALARM_VALUES = {'SEVR': 'NO_ALARM', 'STAT': 'NO_ALARM', 'NSEV': 'NO_ALARM', 'NSTA': 'NO_ALARM',
+                   'AMSG': '', 'NAMSG': ''}
+
+# Record states
+STATE_OK = 'ok'
+STATE_ALARM = 'alarm'
+STATE_DISCONNECTED = 'disconnected'
+STATE_SLOW = 'slow'
+
+
+def ca_environment(port: int) -> dict:
+    """
+    Channel access environment used by the server and the clients
+    :param port: server port
+    :return: environment dictionary
+    """
+    env = dict(os.environ)
+    env.update({'EPICS_CA_ADDR_LIST': '127.0.0.1',
+                'EPICS_CA_AUTO_ADDR_LIST': 'NO',
+                'EPICS_CA_SERVER_PORT': str(port),
+                'EPICS_CAS_INTF_ADDR_LIST': '127.0.0.1',
+                'EPICS_CAS_SERVER_PORT': str(port),
+                'EPICS_CAS_BEACON_ADDR_LIST': '127.0.0.1',
+                'EPICS_CAS_AUTO_BEACON_ADDR_LIST': 'NO'})
+    return env
+
+
+def record_sample(count: int, seed: int) -> list:
+    """
+    Select a sample of record names from the A&G database files
+    :param count: number of records
+    :param seed: random seed
+    :return: list of record names
+    """
+    from process_channels import FILE_LIST, load_database_index, merge_records
+    ag_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ag')
+    index = load_database_index([os.path.join(ag_directory, _) for _ in FILE_LIST],
+                                index_file=os.path.join(ag_directory, '.db_index.pickle'))
+    names = sorted(merge_records(index))
+    random.Random(seed).shuffle(names)
+    # Repeat names with a suffix if more records than available are requested
+    return [names[n % len(names)] + (f'_{n // len(names)}' if n >= len(names) else '') for n in range(count)]
+
+
+def assign_states(names: list, alarm: float, disconnected: float, slow: float, seed: int) -> dict:
+    """
+    Assign a state to each record
+    :param names: record names
+    :param alarm: fraction of records in alarm
+    :param disconnected: fraction of disconnected records
+    :param slow: fraction of slow records
+    :param seed: random seed
+    :return: dictionary of states indexed by record name
+    """
+    rnd = random.Random(seed + 1)
+    d = {}
+    for name in names:
+        x = rnd.random()
+        if x < disconnected:
+            d[name] = STATE_DISCONNECTED
+        elif x < disconnected + slow:
+            d[name] = STATE_SLOW
+        elif x < disconnected + slow + alarm:
+            d[name] = STATE_ALARM
+        else:
+            d[name] = STATE_OK
+    return d
+
+
+def field_values(name: str, state: str) -> dict:
+    """
+    :param name: record name
+    :param state: record state
+    :return: dictionary with the alarm field values of a record
+    """
+    d = dict(ALARM_VALUES if state == STATE_ALARM else NO_ALARM_VALUES)
+    d['DESC'] = name[-28:]
+    return d
+
+
+def serve_caproto(states: dict, delay: float):
+    """
+    Run a caproto server with the alarm fields of all the records that are not disconnected.
+    :param states: dictionary of states indexed by record name
+    :param delay: read delay for slow records (seconds)
+    """
+    import asyncio
+    from caproto import ChannelString
+    from caproto.asyncio.server import run
+
+    class SlowChannelString(ChannelString):
+        async def read(self, data_type):
+            await asyncio.sleep(delay)
+            return await super().read(data_type)
+
+    pvdb = {}
+    for name, state in states.items():
+        if state == STATE_DISCONNECTED:
+            continue
+        cls = SlowChannelString if state == STATE_SLOW else ChannelString
+        for field_name, value in field_values(name, state).items():
+            pvdb[f'{name}.{field_name}'] = cls(value=value)
+    asyncio.run(run(pvdb, interfaces=['127.0.0.1']))
+
+
+def softioc_database(states: dict, file_name: str):
+    """
+    Write a database for softIoc. Records in alarm are ai records above their HIHI limit.
+    :param states: dictionary of states indexed by record name
+    :param file_name: output file name
+    """
+    with open(file_name, 'w') as f:
+        for name, state in states.items():
+            if state == STATE_DISCONNECTED:
+                continue
+            f.write(f'record(ai, "{name}") {{\n')
+            f.write(f'    field(DESC, "{name[-28:]}")\n')
+            f.write('    field(PINI, "YES")\n')
+            if state == STATE_ALARM:
+                f.write('    field(VAL, "10")\n    field(HIHI, "5")\n    field(HHSV, "MAJOR")\n')
+            f.write('}\n')
+
+
+def start_server(server: str, states: dict, delay: float, port: int, work_dir: str) -> subprocess.Popen:
+    """
+    Start the channel access server in a separate process
+    :param server: server type (SERVERS)
+    :param states: dictionary of states indexed by record name
+    :param delay: read delay for slow records (seconds)
+    :param port: server port
+    :param work_dir: directory for temporary files
+    :return: server process
+    """
+    env = ca_environment(port)
+    if server == 'softioc':
+        db_file = os.path.join(work_dir, 'bench.db')
+        softioc_database(states, db_file)
+        return subprocess.Popen(['softIoc', '-d', db_file], env=env, stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    state_file = os.path.join(work_dir, 'states.json')
+    with open(state_file, 'w') as f:
+        json.dump(states, f)
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', state_file,
+                             '--delay', str(delay)], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for_server(name: str, port: int, timeout: float) -> bool:
+    """
+    Wait until a channel can be read from the server
+    :param name: record name known to be served
+    :param port: server port
+    :param timeout: maximum time to wait (seconds)
+    :return: True if the server answered
+    """
+    cmd = [sys.executable, '-c',
+           f'import epics, sys; sys.exit(epics.caget("{name}.SEVR", timeout=1.0) is None)']
+    t = time.monotonic()
+    while time.monotonic() - t < timeout:
+        if subprocess.run(cmd, env=ca_environment(port), stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 0:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Percentile (nearest rank) of a list of values
+    :param values: list of values
+    :param p: percentile (0..100)
+    :return: percentile value
+    """
+    if not values:
+        return 0.0
+    v = sorted(values)
+    return v[min(len(v) - 1, max(0, int(round(p / 100 * len(v) + 0.5)) - 1))]
+
+
+def run_check_alarms(file_name: str, use_pv: bool, timeout: float) -> dict:
+    """
+    Sweep the records with check_alarms.py (in the current process)
+    :param file_name: file with record names
+    :param use_pv: use the PV interface?
+    :param timeout: channel access timeout (seconds)
+    :return: dictionary with the results
+    """
+    import check_alarms
+    check_alarms.GET_TIMEOUT = timeout
+
+    with open(file_name, 'r') as f:
+        names = [_.strip() for _ in f if _.strip()]
+    latency = []
+    timeouts = alarms = 0
+    msg_flag = True
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    t_start = time.monotonic()
+    try:
+        for name in names:
+            t = time.monotonic()
+            d, msg_flag = check_alarms.get_record_alarms(name, msg_flag=msg_flag, use_pv=use_pv)
+            latency.append(time.monotonic() - t)
+            if d is None:
+                timeouts += 1
+            elif not check_alarms.ignore_alarms(d):
+                alarms += 1
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    elapsed = time.monotonic() - t_start
+    return {'records': len(names), 'elapsed': elapsed, 'latency': latency,
+            'timeouts': timeouts, 'alarms': alarms,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_capture_alarms(file_name: str, work_dir: str, port: int) -> dict:
+    """
+    Sweep the records with capture_alarms.csh. The per record latency is the time between
+    the record names echoed by the script.
+    :param file_name: file with record names
+    :param work_dir: directory for temporary files
+    :param port: server port
+    :return: dictionary with the results
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'capture_alarms.csh')
+    out_file = os.path.join(work_dir, 'capture.out')
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    latency = []
+    t_start = t = time.monotonic()
+    p = subprocess.Popen(['csh', script, file_name, out_file], env=ca_environment(port),
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    first = True
+    for _ in p.stdout:
+        now = time.monotonic()
+        if not first:
+            latency.append(now - t)
+        first = False
+        t = now
+    p.wait()
+    elapsed = time.monotonic() - t_start
+    latency.append(elapsed - (t - t_start))
+    with open(file_name, 'r') as f:
+        records = len([_ for _ in f if _.strip()])
+    return {'records': records, 'elapsed': elapsed, 'latency': latency, 'timeouts': None, 'alarms': None,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def run_backend(backend: str, file_name: str, port: int, timeout: float, work_dir: str) -> dict:
+    """
+    Run a backend in a separate process, so the peak RSS is measured independently
+    :param backend: backend name (BACKENDS)
+    :param file_name: file with record names
+    :param port: server port
+    :param timeout: channel access timeout (seconds)
+    :param work_dir: directory for temporary files
+    :return: dictionary with the results, None if the backend failed
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', backend, '--records-file', file_name,
+           '--port', str(port), '--timeout', str(timeout), '--work-dir', work_dir]
+    p = subprocess.run(cmd, env=ca_environment(port), stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        return json.loads(p.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return None
+
+
+def print_results(results: dict):
+    """
+    Print the benchmark results
+    :param results: dictionary of results indexed by backend name
+    """
+    print(f'{"backend":10}{"records":>10}{"elapsed":>10}{"rec/s":>10}{"p50 ms":>10}{"p99 ms":>10}'
+          f'{"timeouts":>10}{"alarms":>8}{"rss MB":>10}')
+    for backend, r in results.items():
+        if r is None:
+            print(f'{backend:10}failed')
+            continue
+        rate = r['records'] / r['elapsed'] if r['elapsed'] > 0 else 0
+        timeouts = '' if r['timeouts'] is None else r['timeouts']
+        alarms = '' if r['alarms'] is None else r['alarms']
+        print(f'{backend:10}{r["records"]:>10}{r["elapsed"]:>10.2f}{rate:>10.1f}'
+              f'{percentile(r["latency"], 50) * 1000:>10.2f}{percentile(r["latency"], 99) * 1000:>10.2f}'
+              f'{timeouts:>10}{alarms:>8}{r["max_rss_kb"] / 1024:>10.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-n', '--records', action='store', type=int, default=2000,
+                        help='number of records served')
+    parser.add_argument('--alarm', action='store', type=float, default=0.05,
+                        help='fraction of records in alarm')
+    parser.add_argument('--disconnected', action='store', type=float, default=0.0,
+                        help='fraction of disconnected records')
+    parser.add_argument('--slow', action='store', type=float, default=0.0,
+                        help='fraction of slow records')
+    parser.add_argument('--delay', action='store', type=float, default=0.1,
+                        help='read delay of the slow records (seconds)')
+    parser.add_argument('--timeout', action='store', type=float, default=1.0,
+                        help='channel access timeout used by the sweeps (seconds)')
+    parser.add_argument('-b', '--backend', action='append', choices=BACKENDS, default=None,
+                        help='sweep backend (can be repeated, default is ca and pv)')
+    parser.add_argument('--server', action='store', choices=SERVERS, default='caproto',
+                        help='channel access server')
+    parser.add_argument('--port', action='store', type=int, default=DEFAULT_PORT,
+                        help='channel access server port')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='random seed used to select the records and their states')
+    parser.add_argument('--json', action='store', default='',
+                        help='write the results to a json file')
+
+    # Internal options, used to run the server and the backends in separate processes
+    parser.add_argument('--serve', action='store', default='', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store', default='', help=argparse.SUPPRESS)
+    parser.add_argument('--records-file', action='store', default='', help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', action='store', default='', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.serve:
+        with open(args.serve, 'r') as f:
+            serve_caproto(json.load(f), args.delay)
+        exit(0)
+
+    if args.worker:
+        if args.worker == 'caget':
+            result = run_capture_alarms(args.records_file, args.work_dir, args.port)
+        else:
+            result = run_check_alarms(args.records_file, args.worker == 'pv', args.timeout)
+        print(json.dumps(result))
+        exit(0)
+
+    if args.server == 'softioc' and shutil.which('softIoc') is None:
+        print('softIoc not found')
+        exit(1)
+    if args.server == 'softioc' and args.slow > 0:
+        print('slow records are not supported by softIoc, ignored')
+        args.slow = 0
+
+    record_names = record_sample(args.records, args.seed)
+    state_dict = assign_states(record_names, args.alarm, args.disconnected, args.slow, args.seed)
+    backend_list = args.backend if args.backend else ['ca', 'pv']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        records_file = os.path.join(tmp_dir, 'records.txt')
+        with open(records_file, 'w') as f:
+            for record_name in record_names:
+                f.write(f'{record_name}\n')
+
+        server = start_server(args.server, state_dict, args.delay, args.port, tmp_dir)
+        try:
+            served = [_ for _ in record_names if state_dict[_] != STATE_DISCONNECTED]
+            if not served or not wait_for_server(served[0], args.port, SERVER_STARTUP + len(served) / 1000):
+                print('server did not start')
+                exit(1)
+            result_dict = {}
+            for backend_name in backend_list:
+                result_dict[backend_name] = run_backend(backend_name, records_file, args.port,
+                                                        args.timeout, tmp_dir)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f'{args.records} records, alarm={args.alarm}, disconnected={args.disconnected}, '
+          f'slow={args.slow} ({args.delay} s), server={args.server}')
+    print_results(result_dict)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': result_dict}, f, indent=2)
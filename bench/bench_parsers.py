@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Parser throughput benchmark and regression check.
+
+Synthetic inputs are generated in the formats used by the scripts:
+* wfs       camonitor log of the WFS follow/interpol channels (analayze_ag_wfs.extract_channels)
+* coma      '---' delimited coma log (process_coma_data.parse_follow_lines)
+* alarms    record.FIELD,value alarm capture (process_alarms.process_file)
+* db        scaled copy of the A&G database set (process_channels.parse_database)
+* fields    same database set (process_channels.process_fields)
+
+The inputs are written to a corpus directory and reused by later runs with the same size.
+Each parser is run in a separate process; the best of several runs is reported
+as MB/s and lines/s, together with the peak RSS of the process (and of the
+chunk worker processes, if any).
+
+The results are appended to a history file (one json object per line). A run is
+compared against the median of the previous runs on the same host with the same
+input size, and the exit status is 1 if any parser is slower than the threshold.
+
+Running:
+* ./bench_parsers.py [options]
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import resource
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIRECTORY = os.path.join(BENCH_DIRECTORY, '..')
+AG_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'ag')
+
+sys.path.insert(0, ROOT_DIRECTORY)
+sys.path.insert(1, AG_DIRECTORY)
+
+PARSERS = ['wfs', 'coma', 'alarms', 'db', 'fields']
+
+DEFAULT_CORPUS = os.path.join(BENCH_DIRECTORY, 'corpus')
+DEFAULT_HISTORY = os.path.join(BENCH_DIRECTORY, 'parser_history.jsonl')
+
+# Default log size (MB) and number of copies of the database set
+DEFAULT_SIZE = 20
+DEFAULT_SCALE = 4
+
+# Slowdown (percent of the historical median MB/s) that fails the check
+DEFAULT_THRESHOLD = 20.0
+
+# Number of previous runs used to compute the reference
+HISTORY_DEPTH = 5
+
+# Alarm fields written by capture_alarms.csh
+ALARM_FIELDS = ('SEVR', 'STAT', 'AMSG', 'NSTA', 'NSEV', 'NAMSG', 'DESC')
+
+
+def generate_wfs(file_name: str, size: int, seed: int):
+    """
+    Write a camonitor log with the channels read by analayze_ag_wfs.py.
+    The follow channels are updated at 20 Hz and the interpol channels at 200 Hz.
+    :param file_name: output file name
+    :param size: approximate file size (bytes)
+    :param seed: random seed
+    """
+    from catalog import channel_group
+    rnd = random.Random(seed)
+    follow = sorted(set(channel for key, channel, _ in channel_group('wfs', wfs='p1') if 'follow' in channel))
+    interpol = sorted(set(channel for key, channel, _ in channel_group('wfs', wfs='p1') if 'interpol' in channel))
+    t = datetime(datetime.now().year, 1, 1)
+    step = timedelta(microseconds=5000)
+    count = 0
+    written = 0
+    with open(file_name, 'w') as f:
+        while written < size:
+            stamp = t.strftime('%Y-%m-%d %H:%M:%S.%f')
+            lines = [f'{channel} {stamp} {rnd.gauss(0, 1):.4f}\n' for channel in interpol]
+            if count % 10 == 0:
+                lines += [f'{channel} {stamp} 6 1 2 3 {count // 10} {rnd.gauss(0, 1):.4f} '
+                          f'{rnd.gauss(0, 1):.4f} {rnd.gauss(0, 1):.4f}\n' for channel in follow]
+            s = ''.join(lines)
+            f.write(s)
+            written += len(s)
+            count += 1
+            t += step
+
+
+def generate_coma(file_name: str, size: int, seed: int):
+    """
+    Write a coma log as captured by monitor_coma_follow.sh (one block per second)
+    :param file_name: output file name
+    :param size: approximate file size (bytes)
+    :param seed: random seed
+    """
+    from catalog import channel_group
+    rnd = random.Random(seed)
+    channels = [channel for key, channel, _ in channel_group('coma')] + ['tcs:drives:driveM2S.VALA']
+    t = datetime(datetime.now().year, 1, 1)
+    step = timedelta(seconds=1)
+    written = 0
+    with open(file_name, 'w') as f:
+        while written < size:
+            lines = [f'-- {t.strftime("%Y%m%d-%H:%M:%S")} --------------------\n']
+            lines += [f'{channel}    {rnd.gauss(0, 1):.3f}\n' for channel in channels]
+            s = ''.join(lines)
+            f.write(s)
+            written += len(s)
+            t += step
+
+
+def generate_alarms(file_name: str, size: int, seed: int):
+    """
+    Write an alarm capture as generated by capture_alarms.csh (about 5% of the records in alarm)
+    :param file_name: output file name
+    :param size: approximate file size (bytes)
+    :param seed: random seed
+    """
+    rnd = random.Random(seed)
+    count = 0
+    written = 0
+    with open(file_name, 'w') as f:
+        while written < size:
+            record_name = f'tag:bench{count}'
+            alarm = rnd.random() < 0.05
+            values = {'SEVR': 'MAJOR' if alarm else 'NO_ALARM', 'STAT': 'HIHI' if alarm else 'NO_ALARM',
+                      'AMSG': '', 'NSTA': 'NO_ALARM', 'NSEV': 'NO_ALARM', 'NAMSG': '',
+                      'DESC': f'benchmark record {count}'}
+            s = ''.join(f'{record_name}.{field_name},{values[field_name]}\n' for field_name in ALARM_FIELDS)
+            f.write(s)
+            written += len(s)
+            count += 1
+
+
+def generate_databases(directory: str, scale: int):
+    """
+    Write scale copies of the A&G database set. The record names of each copy
+    (and the links between them) get a different prefix.
+    :param directory: output directory
+    :param scale: number of copies
+    """
+    from process_channels import FILE_LIST
+    os.makedirs(directory, exist_ok=True)
+    for file_name in FILE_LIST:
+        with open(os.path.join(AG_DIRECTORY, file_name), 'r') as f:
+            text = f.read()
+        for n in range(scale):
+            base, ext = os.path.splitext(file_name)
+            with open(os.path.join(directory, f'{base}_{n}{ext}'), 'w') as f:
+                f.write(text.replace('${ag}', f'${{ag}}s{n}_'))
+
+
+def corpus_files(corpus: str, size_mb: int, scale: int, seed: int) -> dict:
+    """
+    Return the input of each parser, generating the files that do not exist yet
+    :param corpus: corpus directory
+    :param size_mb: log size (MB)
+    :param scale: number of copies of the database set
+    :param seed: random seed
+    :return: dictionary of input file lists indexed by parser name
+    """
+    os.makedirs(corpus, exist_ok=True)
+    output_dict = {}
+    for name, generator in (('wfs', generate_wfs), ('coma', generate_coma), ('alarms', generate_alarms)):
+        file_name = os.path.join(corpus, f'{name}_{size_mb}mb_{seed}.log')
+        if not os.path.exists(file_name):
+            print(f'generating {file_name}')
+            generator(file_name + '.tmp', size_mb * 1024 * 1024, seed)
+            os.replace(file_name + '.tmp', file_name)
+        output_dict[name] = [file_name]
+
+    db_directory = os.path.join(corpus, f'db_x{scale}')
+    if not os.path.isdir(db_directory):
+        print(f'generating {db_directory}')
+        generate_databases(db_directory + '.tmp', scale)
+        os.replace(db_directory + '.tmp', db_directory)
+    db_files = sorted(os.path.join(db_directory, _) for _ in os.listdir(db_directory))
+    output_dict['db'] = output_dict['fields'] = db_files
+    return output_dict
+
+
+def count_lines(file_list: list) -> tuple:
+    """
+    :param file_list: list of file names
+    :return: (bytes, lines) tuple
+    """
+    size = lines = 0
+    for file_name in file_list:
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                size += len(block)
+                lines += block.count(b'\n')
+    return size, lines
+
+
+def run_parser(name: str, file_list: list):
+    """
+    Run a parser once on its input
+    :param name: parser name (PARSERS)
+    :param file_list: input files
+    """
+    if name == 'wfs':
+        import analayze_ag_wfs
+        analayze_ag_wfs.reset_starting_time()
+        analayze_ag_wfs.extract_channels(file_list[0], analayze_ag_wfs.create_channel_dictionary('p1'))
+    elif name == 'coma':
+        from log_reader import map_lines
+        from process_coma_data import parse_follow_lines
+        map_lines(file_list[0], parse_follow_lines)
+    elif name == 'alarms':
+        from process_alarms import process_file
+        process_file(file_list[0])
+    elif name == 'db':
+        from process_channels import load_database_index
+        load_database_index(file_list, index_file='')
+    elif name == 'fields':
+        from process_channels import process_fields
+        process_fields(file_list, [])
+
+
+def run_worker(name: str, file_list: list, repeat: int) -> dict:
+    """
+    Time a parser (in the current process). The modules are imported before timing.
+    :param name: parser name (PARSERS)
+    :param file_list: input files
+    :param repeat: number of runs
+    :return: dictionary with the results
+    """
+    import analayze_ag_wfs, process_coma_data, process_alarms, process_channels
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        for _ in range(repeat):
+            t = time.perf_counter()
+            run_parser(name, file_list)
+            times.append(time.perf_counter() - t)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    return {'elapsed': min(times), 'times': times,
+            'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'rss_delta_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start) / 1024,
+            'child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def benchmark(name: str, file_list: list, repeat: int) -> dict:
+    """
+    Run a parser benchmark in a separate process, so the memory is measured independently
+    :param name: parser name (PARSERS)
+    :param file_list: input files
+    :param repeat: number of runs
+    :return: dictionary with the results, None if the parser failed
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', name, '--repeat', str(repeat)] + file_list
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        result = json.loads(p.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return None
+    size, lines = count_lines(file_list)
+    result.update({'bytes': size, 'lines': lines,
+                   'mb_s': size / 1024 / 1024 / result['elapsed'],
+                   'lines_s': lines / result['elapsed']})
+    return result
+
+
+def git_revision() -> str:
+    """
+    :return: current git commit (short), or an empty string if not available
+    """
+    try:
+        p = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIRECTORY,
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        return p.stdout.strip()
+    except OSError:
+        return ''
+
+
+def read_history(file_name: str) -> list:
+    """
+    :param file_name: history file name
+    :return: list of previous runs (oldest first)
+    """
+    output_list = []
+    try:
+        with open(file_name, 'r') as f:
+            for line in f:
+                try:
+                    output_list.append(json.loads(line))
+                except ValueError:
+                    pass
+    except OSError:
+        pass
+    return output_list
+
+
+def append_history(file_name: str, run: dict):
+    """
+    :param file_name: history file name
+    :param run: run to append
+    """
+    with open(file_name, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+def check_regressions(run: dict, history: list, threshold: float) -> dict:
+    """
+    Compare a run with the median throughput of the previous comparable runs
+    (same host, log size and database scale).
+    :param run: current run
+    :param history: previous runs
+    :param threshold: maximum slowdown (percent)
+    :return: dictionary of (reference MB/s, change in percent, regression flag) indexed by parser name
+    """
+    previous = [_ for _ in history if _.get('host') == run['host'] and _.get('size_mb') == run['size_mb']
+                and _.get('scale') == run['scale']][-HISTORY_DEPTH:]
+    output_dict = {}
+    for name, result in run['results'].items():
+        values = [_['results'][name]['mb_s'] for _ in previous if _['results'].get(name)]
+        if not values or result is None:
+            continue
+        reference = statistics.median(values)
+        change = (result['mb_s'] - reference) / reference * 100
+        output_dict[name] = (reference, change, change < -threshold)
+    return output_dict
+
+
+def print_results(run: dict, regressions: dict):
+    """
+    Print the benchmark results
+    :param run: current run
+    :param regressions: check_regressions output
+    """
+    print(f'{"parser":8}{"MB":>8}{"lines":>11}{"best s":>9}{"MB/s":>9}{"lines/s":>11}'
+          f'{"rss MB":>9}{"+MB":>8}{"child MB":>10}{"ref MB/s":>10}{"change":>9}')
+    for name, r in run['results'].items():
+        if r is None:
+            print(f'{name:8}failed')
+            continue
+        reference, change, regression = regressions.get(name, (None, None, False))
+        ref_text = '' if reference is None else f'{reference:.1f}'
+        change_text = '' if change is None else f'{change:+.1f}%'
+        print(f'{name:8}{r["bytes"] / 1024 / 1024:>8.1f}{r["lines"]:>11}{r["elapsed"]:>9.2f}'
+              f'{r["mb_s"]:>9.1f}{r["lines_s"]:>11.0f}{r["rss_mb"]:>9.1f}{r["rss_delta_mb"]:>8.1f}'
+              f'{r["child_rss_mb"]:>10.1f}{ref_text:>10}{change_text:>9}{"  SLOWER" if regression else ""}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-p', '--parser', action='append', choices=PARSERS, default=None,
+                        help='parser to benchmark (can be repeated, default is all)')
+    parser.add_argument('-s', '--size', action='store', type=int, default=DEFAULT_SIZE,
+                        help='size of the generated logs (MB)')
+    parser.add_argument('--scale', action='store', type=int, default=DEFAULT_SCALE,
+                        help='number of copies of the A&G database set')
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=3,
+                        help='number of runs of each parser (the best one is reported)')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='random seed used to generate the logs')
+    parser.add_argument('--corpus', action='store', default=DEFAULT_CORPUS,
+                        help='directory with the generated inputs')
+    parser.add_argument('--history', action='store', default=DEFAULT_HISTORY,
+                        help='history file (use an empty string to disable it)')
+    parser.add_argument('--threshold', action='store', type=float, default=DEFAULT_THRESHOLD,
+                        help='slowdown that fails the check (percent)')
+    parser.add_argument('--no-save', action='store_true', default=False,
+                        help='do not add this run to the history')
+    parser.add_argument('--json', action='store', default='',
+                        help='write the results to a json file')
+
+    # Internal option, used to run each parser in a separate process
+    parser.add_argument('--worker', action='store', default='', help=argparse.SUPPRESS)
+    parser.add_argument('input_files', nargs='*', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.input_files, args.repeat)))
+        exit(0)
+
+    try:
+        input_dict = corpus_files(args.corpus, args.size, args.scale, args.seed)
+    except OSError as e:
+        print(f'Cannot generate the corpus: {e}')
+        exit(1)
+
+    run_dict = {'time': datetime.now().isoformat(timespec='seconds'), 'host': socket.gethostname(),
+                'revision': git_revision(), 'python': sys.version.split()[0], 'cpus': os.cpu_count(),
+                'size_mb': args.size, 'scale': args.scale, 'repeat': args.repeat, 'results': {}}
+    for parser_name in args.parser if args.parser else PARSERS:
+        run_dict['results'][parser_name] = benchmark(parser_name, input_dict[parser_name], args.repeat)
+
+    history_list = read_history(args.history) if args.history else []
+    regression_dict = check_regressions(run_dict, history_list, args.threshold)
+    print_results(run_dict, regression_dict)
+
+    if args.history and not args.no_save:
+        append_history(args.history, run_dict)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run_dict, f, indent=2)
+
+    failed = [_ for _ in run_dict['results'] if run_dict['results'][_] is None]
+    slower = [_ for _ in regression_dict if regression_dict[_][2]]
+    if failed:
+        print(f'failed: {", ".join(failed)}')
+    if slower:
+        print(f'slower than {args.threshold:g}% below the reference: {", ".join(slower)}')
+    exit(1 if failed or slower else 0)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Startup time check. Each command is run several times with --help (or another
+parse only command line) and the median wall time is compared with the budget.
+
+With --importtime, the slowest imports of the commands over budget are listed
+(python -X importtime).
+
+Running:
+* ./bench_startup.py [options]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Startup budget (milliseconds)
+DEFAULT_BUDGET = 100.0
+
+# Commands checked (relative to the repository directory)
+COMMANDS = [
+    ['check_alarms.py', '--help'],
+    ['sweep_alarms.py', '--help'],
+    ['process_alarms.py', '--help'],
+    ['process_coma_data.py', '--help'],
+    ['analayze_ag_wfs.py', '--help'],
+    ['detect_anomalies.py', '--help'],
+    ['pkgdeps.py', '--help'],
+    ['catalog.py', '--help'],
+    ['alarm_history.py', '--help'],
+    ['ag/process_channels.py', '--help'],
+    ['ag/check_alarm_config.py', '--help'],
+    ['ag/resolve_references.py', '--help'],
+    ['ag/diff_databases.py', '--help'],
+    ['-m', 'ade2', '--help'],
+    ['-m', 'ade2', 'alarms', '--help'],
+    ['-m', 'ade2', 'wfs', '--help'],
+]
+
+
+def run_command(command: list, repeat: int) -> list:
+    """
+    Run a command several times
+    :param command: python arguments
+    :param repeat: number of runs
+    :return: list of wall times (seconds), empty if the command failed
+    """
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        p = subprocess.run([sys.executable] + command, cwd=ROOT_DIRECTORY,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t)
+        if p.returncode != 0:
+            return []
+    return times
+
+
+def slowest_imports(command: list, count: int) -> list:
+    """
+    :param command: python arguments
+    :param count: number of imports
+    :return: list of (cumulative microseconds, module name) tuples, slowest first
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=ROOT_DIRECTORY,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    output_list = []
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            output_list.append((int(cumulative), name.strip()))
+    return sorted(output_list, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=5, help='number of runs per command')
+    parser.add_argument('--budget', action='store', type=float, default=DEFAULT_BUDGET,
+                        help=f'startup budget in ms (default {DEFAULT_BUDGET:g})')
+    parser.add_argument('--importtime', action='store_true', default=False,
+                        help='list the slowest imports of the commands over budget')
+    args = parser.parse_args()
+
+    baseline = statistics.median(run_command(['-c', 'pass'], args.repeat)) * 1000
+    print(f'{"command":40}{"median ms":>10}{"max ms":>10}')
+    print(f'{"python -c pass":40}{baseline:>10.1f}')
+    over = []
+    for cmd in COMMANDS:
+        name = ' '.join(cmd)
+        time_list = run_command(cmd, args.repeat)
+        if not time_list:
+            print(f'{name:40}failed')
+            over.append(cmd)
+            continue
+        median = statistics.median(time_list) * 1000
+        print(f'{name:40}{median:>10.1f}{max(time_list) * 1000:>10.1f}'
+              f'{"  OVER BUDGET" if median > args.budget else ""}')
+        if median > args.budget:
+            over.append(cmd)
+            if args.importtime:
+                for cumulative, module in slowest_imports(cmd, 5):
+                    print(f'{"":44}{cumulative / 1000:>8.1f} ms  {module}')
+    exit(1 if over else 0)
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Local SQLite channel catalog shared by the scripts in this directory.
+
+The catalog contains:
+* the records in the database files (type, IOC prefix, fields and links to other records),
+  filled from the files parsed by ag/process_channels.py
+* the channel groups used by the analysis and capture scripts (coma and WFS channels).
+  The groups are copied from DEFAULT_GROUPS and can be edited in the catalog.
+  A group that was not edited follows DEFAULT_GROUPS; an edited group is used as it is,
+  with a warning if DEFAULT_GROUPS changed after it was copied (catalog.py groups --reset).
+
+Records are indexed by prefix and type, and links by target record.
+Channel templates in groups can contain {wfs}, replaced when the group is read.
+
+Usage:
+* ./catalog.py build [db files]          fill the catalog (default is the A&G database set)
+* ./catalog.py channels <group> [--wfs]  print the channels in a group (used by the capture scripts)
+* ./catalog.py records [--prefix] [--type]
+* ./catalog.py groups [--reset [group ...]]  check the groups, or copy them again from DEFAULT_GROUPS
+
+Queries open the catalog read only, so they work when the file is not writable.
+"""
+import os
+import sys
+import hashlib
+import sqlite3
+import argparse
+from urllib.parse import quote
+from typing import Union
+
+# Default catalog file. Can be changed with the ADE2_CATALOG environment variable.
+CATALOG_FILE = os.environ.get('ADE2_CATALOG',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'channels.sqlite'))
+
+# Directory with the A&G database files
+AG_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ag')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, mtime INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS records (name TEXT PRIMARY KEY, type TEXT, prefix TEXT, file TEXT);
+CREATE TABLE IF NOT EXISTS fields (record TEXT, name TEXT, value TEXT, PRIMARY KEY (record, name));
+CREATE TABLE IF NOT EXISTS links (record TEXT, field TEXT, target TEXT, target_field TEXT, options TEXT);
+CREATE TABLE IF NOT EXISTS macros (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS channel_groups (grp TEXT, position INTEGER, key TEXT, channel TEXT, idx INTEGER,
+                                           PRIMARY KEY (grp, position));
+CREATE TABLE IF NOT EXISTS group_defaults (grp TEXT PRIMARY KEY, digest TEXT);
+CREATE INDEX IF NOT EXISTS records_prefix ON records (prefix);
+CREATE INDEX IF NOT EXISTS records_type ON records (type);
+CREATE INDEX IF NOT EXISTS records_file ON records (file);
+CREATE INDEX IF NOT EXISTS links_target ON links (target);
+CREATE INDEX IF NOT EXISTS links_record ON links (record);
+"""
+
+# Data indices in the camonitor WFS log lines (see analayze_ag_wfs.py)
+INDEX_DATA = 3
+INDEX_APPLY_TIME = 6
+INDEX_X = 7
+INDEX_Y = 8
+INDEX_Z = 9
+
+# Channel groups: lists of (key, channel, data index) tuples
+DEFAULT_GROUPS = {
+    # process_coma_data.py: EPICS channels to data keys
+    'coma': [
+        ('m2xpos', 'tcs:om:m2RawXPos', None),
+        ('m2ypos', 'tcs:om:m2RawYPos', None),
+        ('userx', 'tcs:m2XUserOffset', None),
+        ('usery', 'tcs:m2YUserOffset', None),
+        ('userx', 'tcs:m2XYOffset.VALA', None),
+        ('usery', 'tcs:m2XYOffset.VALB', None),
+        ('z5', 'tcs:m2XErrorCorr.VAL', None),
+        ('z6', 'tcs:m2YErrorCorr.VAL', None),
+        ('tempx', 'tcs:om:m2XY.VALA', None),
+        ('tempy', 'tcs:om:m2XY.VALB', None),
+        ('modelx', 'tcs:om:m2XY.VALC', None),
+        ('modely', 'tcs:om:m2XY.VALD', None),
+        ('nominalx', 'tcs:om:m2XY.VALG', None),
+        ('nominaly', 'tcs:om:m2XY.VALH', None),
+        ('currentx', 'tcs:om:m2XY.VALI', None),
+        ('currenty', 'tcs:om:m2XY.VALJ', None),
+        ('demandx', 'tcs:om:m2XY.VALE', None),
+        ('demandy', 'tcs:om:m2XY.VALF', None),
+    ],
+    # monitor_coma_follow.sh: channels captured with caget
+    'coma_capture': [(None, _, None) for _ in (
+        'm2:xPos', 'm2:yPos',
+        'tcs:m2XUserOffset', 'tcs:m2YUserOffset',
+        'tcs:om:m2RawXPos', 'tcs:om:m2RawYPos',
+        'tcs:om:m2XYErr.VALA', 'tcs:om:m2XYErr.VALB',
+        'tcs:m2XErrorCorr.VAL', 'tcs:m2YErrorCorr.VAL',
+        'tcs:om:m2XY.VALA', 'tcs:om:m2XY.VALB', 'tcs:om:m2XY.VALC', 'tcs:om:m2XY.VALD', 'tcs:om:m2XY.VALE',
+        'tcs:om:m2XY.VALF', 'tcs:om:m2XY.VALG', 'tcs:om:m2XY.VALH', 'tcs:om:m2XY.VALI', 'tcs:om:m2XY.VALJ',
+        'tcs:drives:driveM2S.VALA', 'tcs:drives:driveM2S.VALB', 'tcs:drives:driveM2S.VALC',
+        'tcs:drives:driveM2S.VALD', 'tcs:drives:driveM2S.VALE', 'tcs:drives:driveM2S.VALF',
+        'tcs:drives:driveM2S.VALG', 'tcs:drives:driveM2S.VALH', 'tcs:drives:driveM2S.VALI')],
+    # analayze_ag_wfs.py: channel names to (channel, data index)
+    'wfs': [
+        ('t1', 'ag:{wfs}:followA.VALA', INDEX_APPLY_TIME),
+        ('x1', 'ag:{wfs}:followA.VALA', INDEX_X),
+        ('y1', 'ag:{wfs}:followA.VALA', INDEX_Y),
+        ('z1', 'ag:{wfs}:followA.VALA', INDEX_Z),
+        ('t2', 'ag:{wfs}:followA.VALB', INDEX_APPLY_TIME),
+        ('x2', 'ag:{wfs}:followA.VALB', INDEX_X),
+        ('y2', 'ag:{wfs}:followA.VALB', INDEX_Y),
+        ('z2', 'ag:{wfs}:followA.VALB', INDEX_Z),
+        ('t3', 'ag:{wfs}:followA.VALC', INDEX_APPLY_TIME),
+        ('x3', 'ag:{wfs}:followA.VALC', INDEX_X),
+        ('y3', 'ag:{wfs}:followA.VALC', INDEX_Y),
+        ('z3', 'ag:{wfs}:followA.VALC', INDEX_Z),
+        ('x', 'ag:{wfs}:interpol.VALA', INDEX_DATA),
+        ('y', 'ag:{wfs}:interpol.VALB', INDEX_DATA),
+        ('z', 'ag:{wfs}:interpol.VALC', INDEX_DATA),
+        ('vx', 'ag:{wfs}:interpol.VALD', INDEX_DATA),
+        ('vy', 'ag:{wfs}:interpol.VALE', INDEX_DATA),
+        ('vz', 'ag:{wfs}:interpol.VALF', INDEX_DATA),
+        ('t', 'ag:{wfs}:interpol.VALG', INDEX_DATA),
+        ('gs', 'ag:{wfs}:interpol.VALH', INDEX_DATA),
+        ('s', 'ag:{wfs}:interpol.VALI', INDEX_DATA),
+    ],
+    # capture_ag_wfs.csh: channels captured with camonitor
+    'wfs_capture': [(None, _, None) for _ in (
+        'ag:{wfs}:followA.VALA', 'ag:{wfs}:followA.VALB', 'ag:{wfs}:followA.VALC',
+        'ag:{wfs}:followA.VALD', 'ag:{wfs}:followA.VALF', 'ag:{wfs}:followA.VALH',
+        'ag:{wfs}:interpol.VALA', 'ag:{wfs}:interpol.VALB', 'ag:{wfs}:interpol.VALC',
+        'ag:{wfs}:interpol.VALD', 'ag:{wfs}:interpol.VALE', 'ag:{wfs}:interpol.VALF',
+        'ag:{wfs}:interpol.VALG', 'ag:{wfs}:interpol.VALH', 'ag:{wfs}:interpol.VALI',
+        'ag:{wfs}:probeinPosition')],
+}
+
+# Capture scripts with a copy of a group, used when the catalog cannot be read.
+# The copy is the list between "set fallback = (" and ")", with {wfs} written as ${wfs}.
+SCRIPT_GROUPS = {
+    'wfs_capture': ('capture_ag_wfs.csh', {'wfs': '${wfs}'}),
+    'coma_capture': ('monitor_coma_follow.sh', {}),
+}
+
+# Group status (see group_status)
+DEFAULT = 'default'
+EDITED = 'edited'
+OUTDATED = 'outdated'
+MISSING = 'missing'
+
+
+def open_catalog(file_name=CATALOG_FILE, read_only=False) -> sqlite3.Connection:
+    """
+    Open the catalog. In write mode the catalog is created if needed, and the groups
+    that are missing or were not edited are copied from DEFAULT_GROUPS.
+    :param file_name: catalog file name
+    :param read_only: open the catalog read only (it has to exist)
+    :return: database connection
+    """
+    if read_only:
+        if not os.path.exists(file_name):
+            raise OSError(f'catalog {file_name} does not exist (see catalog.py build)')
+        return sqlite3.connect(f'file:{quote(os.path.abspath(file_name))}?mode=ro', uri=True)
+    db = sqlite3.connect(file_name)
+    db.executescript(SCHEMA)
+    statuses = group_status(db)
+    for group_name in DEFAULT_GROUPS:
+        if statuses[group_name] in (MISSING, DEFAULT):
+            set_channel_group(db, group_name, DEFAULT_GROUPS[group_name])
+    db.commit()
+    return db
+
+
+def group_digest(channels: list) -> str:
+    """
+    :param channels: list of (key, channel, data index) tuples
+    :return: digest of the group contents
+    """
+    return hashlib.sha1(repr([tuple(_) for _ in channels]).encode()).hexdigest()
+
+
+def read_group(db: sqlite3.Connection, group_name: str) -> list:
+    """
+    :param db: database connection
+    :param group_name: group name
+    :return: list of (key, channel, data index) tuples, empty if the group is not in the catalog
+    """
+    return db.execute('SELECT key, channel, idx FROM channel_groups WHERE grp = ? ORDER BY position',
+                      (group_name,)).fetchall()
+
+
+def group_status(db: sqlite3.Connection) -> dict:
+    """
+    Compare the groups in the catalog with DEFAULT_GROUPS:
+    * default   not edited since it was copied (DEFAULT_GROUPS is used)
+    * edited    edited in the catalog, DEFAULT_GROUPS did not change since it was copied
+    * outdated  edited in the catalog, and DEFAULT_GROUPS changed since it was copied
+    * missing   not in the catalog
+    :param db: database connection
+    :return: status dictionary indexed by group name
+    """
+    try:
+        copied = dict(db.execute('SELECT grp, digest FROM group_defaults'))
+    except sqlite3.OperationalError:
+        # Catalog created before the copies were recorded
+        copied = {}
+    output_dict = {}
+    for group_name in DEFAULT_GROUPS:
+        rows = read_group(db, group_name)
+        digest = group_digest(rows)
+        if not rows:
+            output_dict[group_name] = MISSING
+        elif digest == copied.get(group_name) or rows == DEFAULT_GROUPS[group_name]:
+            output_dict[group_name] = DEFAULT
+        elif copied.get(group_name) == group_digest(DEFAULT_GROUPS[group_name]):
+            output_dict[group_name] = EDITED
+        else:
+            output_dict[group_name] = OUTDATED
+    return output_dict
+
+
+def record_prefix(record_name: str) -> str:
+    """
+    Return the IOC prefix of a record name (up to and including the first colon)
+    :param record_name: record name
+    :return: prefix
+    """
+    n = record_name.find(':')
+    return record_name[:n + 1] if n >= 0 else ''
+
+
+def set_channel_group(db: sqlite3.Connection, group_name: str, channels: list):
+    """
+    Replace the channels in a group
+    :param db: database connection
+    :param group_name: group name
+    :param channels: list of (key, channel, data index) tuples
+    """
+    db.execute('DELETE FROM channel_groups WHERE grp = ?', (group_name,))
+    db.executemany('INSERT INTO channel_groups VALUES (?, ?, ?, ?, ?)',
+                   [(group_name, n, key, channel, index) for n, (key, channel, index) in enumerate(channels)])
+    db.execute('INSERT OR REPLACE INTO group_defaults VALUES (?, ?)', (group_name, group_digest(channels)))
+
+
+def update_records(db: sqlite3.Connection, file_name: str, records: dict, macros: dict):
+    """
+    Replace the records of a database file in the catalog
+    :param db: database connection
+    :param file_name: database file name
+    :param records: dictionary of (record type, field dictionary) tuples (see process_channels.parse_database)
+    :param macros: macro substitutions used to parse the file
+    """
+    from process_channels import reference_field, not_reference
+
+    old = [_[0] for _ in db.execute('SELECT name FROM records WHERE file = ?', (file_name,))]
+    db.executemany('DELETE FROM fields WHERE record = ?', [(_,) for _ in old])
+    db.executemany('DELETE FROM links WHERE record = ?', [(_,) for _ in old])
+    db.execute('DELETE FROM records WHERE file = ?', (file_name,))
+
+    record_rows, field_rows, link_rows = [], [], []
+    for record_name, (record_type, fields) in records.items():
+        record_rows.append((record_name, record_type, record_prefix(record_name), file_name))
+        for field_name, value in fields.items():
+            field_rows.append((record_name, field_name, value))
+            if reference_field(field_name) and not not_reference(value):
+                t = value.split()
+                target, _, target_field = t[0].partition('.')
+                link_rows.append((record_name, field_name, target, target_field or 'VAL', ' '.join(t[1:])))
+    db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)', record_rows)
+    db.executemany('INSERT OR REPLACE INTO fields VALUES (?, ?, ?)', field_rows)
+    db.executemany('INSERT INTO links VALUES (?, ?, ?, ?, ?)', link_rows)
+    db.executemany('INSERT OR REPLACE INTO macros VALUES (?, ?)', list(macros.items()))
+
+
+def build_catalog(file_list: list, file_name=CATALOG_FILE) -> int:
+    """
+    Fill the catalog with the records in a list of database files.
+    Only the files that changed since the last build (modification time and size) are updated.
+    :param file_list: list of database files
+    :param file_name: catalog file name
+    :return: number of files updated
+    """
+    if AG_DIRECTORY not in sys.path:
+        sys.path.append(AG_DIRECTORY)
+    from process_channels import parse_database, MACROS
+
+    db = open_catalog(file_name)
+    count = 0
+    for db_file in file_list:
+        key = os.path.abspath(db_file)
+        st = os.stat(key)
+        row = db.execute('SELECT mtime, size FROM files WHERE name = ?', (key,)).fetchone()
+        if row == (st.st_mtime_ns, st.st_size):
+            continue
+        update_records(db, key, parse_database(db_file), MACROS)
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (key, st.st_mtime_ns, st.st_size))
+        db.commit()
+        count += 1
+    db.close()
+    return count
+
+
+def channel_group(group_name: str, file_name=CATALOG_FILE, **kwargs) -> list:
+    """
+    Return the channels in a group.
+    The default group is used if the catalog does not exist, or the group was not edited in the catalog.
+    :param group_name: group name
+    :param file_name: catalog file name
+    :param kwargs: values for the channel templates (e.g. wfs='p1')
+    :return: list of (key, channel, data index) tuples
+    """
+    rows = DEFAULT_GROUPS.get(group_name, [])
+    if os.path.exists(file_name):
+        try:
+            db = open_catalog(file_name, read_only=True)
+            status = group_status(db).get(group_name, MISSING)
+            if status in (EDITED, OUTDATED):
+                rows = read_group(db, group_name)
+            db.close()
+            if status == OUTDATED:
+                print(f'channel group {group_name} was edited in {file_name} and changed in catalog.py '
+                      f'since it was copied (see catalog.py groups)', file=sys.stderr)
+        except (OSError, sqlite3.Error):
+            pass
+    return [(key, channel.format(**kwargs), index) for key, channel, index in rows]
+
+
+def find_records(prefix='', record_type='', file_name=CATALOG_FILE) -> list:
+    """
+    Find records by prefix (start of the record name) and/or type
+    :param prefix: record name prefix
+    :param record_type: record type
+    :param file_name: catalog file name
+    :return: list of (record name, record type) tuples sorted by name
+    """
+    query = 'SELECT name, type FROM records WHERE 1'
+    values = []
+    if prefix:
+        # Range query, so the primary key index is used
+        query += ' AND name >= ? AND name < ?'
+        values += [prefix, prefix + '\uffff']
+    if record_type:
+        query += ' AND type = ?'
+        values.append(record_type)
+    db = open_catalog(file_name, read_only=True)
+    output_list = db.execute(query + ' ORDER BY name', values).fetchall()
+    db.close()
+    return output_list
+
+
+def record_fields(record_name: str, file_name=CATALOG_FILE) -> Union[dict, None]:
+    """
+    Return the fields of a record
+    :param record_name: record name
+    :param file_name: catalog file name
+    :return: field dictionary, None if the record is not in the catalog
+    """
+    db = open_catalog(file_name, read_only=True)
+    rows = db.execute('SELECT name, value FROM fields WHERE record = ?', (record_name,)).fetchall()
+    db.close()
+    return dict(rows) if rows else None
+
+
+def script_group(group_name: str) -> list:
+    """
+    Read the copy of a group in its capture script (see SCRIPT_GROUPS)
+    :param group_name: group name
+    :return: list of channel names
+    """
+    script, _ = SCRIPT_GROUPS[group_name]
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), script), 'r') as f:
+        text = f.read()
+    start = text.index('set fallback = (') + len('set fallback = (')
+    return [_ for _ in text[start:text.index(')', start)].split() if _ != '\\']
+
+
+def check_groups(file_name=CATALOG_FILE, wfs='p1') -> list:
+    """
+    Check the groups against the records in the catalog and the copies in the capture scripts.
+    Only the channels of the IOCs with records in the catalog are checked.
+    :param file_name: catalog file name
+    :param wfs: wavefront sensor used to check the {wfs} templates
+    :return: list of problem descriptions
+    """
+    output_list = []
+    db = open_catalog(file_name, read_only=True) if os.path.exists(file_name) else None
+    prefixes = set([_[0] for _ in db.execute('SELECT DISTINCT prefix FROM records')]) if db else set()
+    for group_name in DEFAULT_GROUPS:
+        for _, channel_name, _ in channel_group(group_name, file_name=file_name, wfs=wfs):
+            record_name = channel_name.partition('.')[0]
+            if record_prefix(record_name) in prefixes and \
+                    not db.execute('SELECT 1 FROM records WHERE name = ?', (record_name,)).fetchone():
+                output_list.append(f'{group_name}: {channel_name} is not in the database files')
+        if group_name in SCRIPT_GROUPS:
+            script, values = SCRIPT_GROUPS[group_name]
+            try:
+                if script_group(group_name) != [_[1].format(**values) for _ in DEFAULT_GROUPS[group_name]]:
+                    output_list.append(f'{group_name}: the copy in {script} differs from DEFAULT_GROUPS')
+            except (OSError, ValueError) as e:
+                output_list.append(f'{group_name}: cannot read the copy in {script} ({e})')
+    if db:
+        db.close()
+    return output_list
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--catalog', action='store', default=CATALOG_FILE, help='catalog file')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='fill the catalog from database files')
+    build_parser.add_argument('files', nargs='*', help='database files (default is the A&G database set)')
+
+    channels_parser = subparsers.add_parser('channels', help='print the channels in a group')
+    channels_parser.add_argument('group', choices=sorted(DEFAULT_GROUPS), help='group name')
+    channels_parser.add_argument('--wfs', action='store', default='p1', help='wavefront sensor')
+
+    records_parser = subparsers.add_parser('records', help='print records by prefix and/or type')
+    records_parser.add_argument('--prefix', action='store', default='', help='record name prefix')
+    records_parser.add_argument('--type', action='store', default='', help='record type')
+
+    groups_parser = subparsers.add_parser('groups', help='check the channel groups against DEFAULT_GROUPS, '
+                                                         'the database files and the capture scripts')
+    groups_parser.add_argument('--reset', action='store', nargs='*', default=None, metavar='GROUP',
+                               help='copy the groups (default is all of them) again from DEFAULT_GROUPS')
+    groups_parser.add_argument('--wfs', action='store', default='p1', help='wavefront sensor')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.files:
+            db_files = args.files
+        else:
+            sys.path.append(AG_DIRECTORY)
+            from process_channels import FILE_LIST
+            db_files = [os.path.join(AG_DIRECTORY, _) for _ in FILE_LIST]
+        n = build_catalog(db_files, file_name=args.catalog)
+        print(f'{n} files updated')
+    elif args.command == 'channels':
+        for _, channel_name, _ in channel_group(args.group, file_name=args.catalog, wfs=args.wfs):
+            print(channel_name)
+    elif args.command == 'records':
+        try:
+            for record_name, record_type in find_records(prefix=args.prefix, record_type=args.type,
+                                                         file_name=args.catalog):
+                print(f'{record_name:40}{record_type}')
+        except OSError as e:
+            print(e)
+            exit(1)
+    elif args.command == 'groups':
+        if args.reset is not None:
+            for name in args.reset:
+                if name not in DEFAULT_GROUPS:
+                    print(f'unknown group {name} (groups: {", ".join(DEFAULT_GROUPS)})')
+                    exit(1)
+            catalog = open_catalog(args.catalog)
+            for name in args.reset if args.reset else DEFAULT_GROUPS:
+                set_channel_group(catalog, name, DEFAULT_GROUPS[name])
+            catalog.commit()
+            catalog.close()
+        status_dict = {}
+        if os.path.exists(args.catalog):
+            catalog = open_catalog(args.catalog, read_only=True)
+            status_dict = group_status(catalog)
+            catalog.close()
+        for name in DEFAULT_GROUPS:
+            print(f'{name:16}{status_dict.get(name, MISSING)}')
+        problems = check_groups(file_name=args.catalog, wfs=args.wfs)
+        for problem in problems:
+            print(problem)
+        exit(1 if problems else 0)
+    else:
+        parser.print_help()
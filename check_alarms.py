@@ -12,12 +12,15 @@ Running:
 * conda activate py36
 * ./check_alarms.py [options] <file>
 """
+import os
 import argparse
 from typing import Union
-from epics import PV
-from epics import ca
+# pyepics is imported by get_channel_value (startup time)
 from common import print_title, print_line, default_alarm_dictionary, ignore_alarms
 from common import field_list, message_field_list
+from catalog import record_prefix
+from alarm_history import HISTORY_FILE, add_sweep
+import instrument
 
 # Read timeout (seconds)
 GET_TIMEOUT = 5
@@ -32,85 +35,123 @@ def get_channel_value(record_name: str, field_name: str, use_pv=False) -> Union[
     :param use_pv: use high level channel access interface
     :return: channel value or None if unable to read the value
     """
+    from epics import PV, ca
     channel_name = f'{record_name}.{field_name}'
     if use_pv:
-        pv = PV(channel_name)
-        value = pv.get(as_string=True, timeout=GET_TIMEOUT)
+        with instrument.timer('pv connect'):
+            pv = PV(channel_name)
+            connect_flag = pv.wait_for_connection(timeout=GET_TIMEOUT)
+        if not connect_flag:
+            instrument.count('connect timeouts')
+            return None
+        with instrument.timer('pv get'):
+            value = pv.get(as_string=True, timeout=GET_TIMEOUT)
     else:
-        channel_id = ca.create_channel(channel_name, connect=False, callback=None, auto_cb=False)
-        connect_flag = ca.connect_channel(channel_id, timeout=GET_TIMEOUT, verbose=False)
+        with instrument.timer('ca connect'):
+            channel_id = ca.create_channel(channel_name, connect=False, callback=None, auto_cb=False)
+            connect_flag = ca.connect_channel(channel_id, timeout=GET_TIMEOUT, verbose=False)
         if not connect_flag:
+            instrument.count('connect timeouts')
             return None
-        value = ca.get(channel_id, as_string=True, as_numpy=False, wait=True, timeout=GET_TIMEOUT)
-        ca.clear_channel(channel_id)
+        with instrument.timer('ca get'):
+            value = ca.get(channel_id, as_string=True, as_numpy=False, wait=True, timeout=GET_TIMEOUT)
+        with instrument.timer('ca clear'):
+            ca.clear_channel(channel_id)
+    if value is None:
+        instrument.count('get timeouts')
     return value
 
 
-def process_file(file_name: str, include_udf=False, csv_output=False, use_pv=False) -> list:
+def get_record_alarms(record_name: str, msg_flag=True, use_pv=False) -> tuple:
+    """
+    Read the alarm fields of a record.
+    The message fields are read only if msg_flag is set. The flag is cleared
+    if any of them cannot be read (not supported by older versions of EPICS).
+    :param record_name: record name
+    :param msg_flag: read the message fields?
+    :param use_pv: use PV interface for channel access?
+    :return: tuple with the alarm dictionary (None if there was a timeout) and the new message flag
+    """
+    d = default_alarm_dictionary()
+
+    # Loop over the field names.
+    # Break the loop if it fails to read.
+    for field_name in field_list:
+
+        # Get the channel value.
+        value = get_channel_value(record_name, field_name, use_pv=use_pv)
+        if value is None:
+            print(f'connection timeout {record_name}')
+            instrument.count(f'timeouts {record_prefix(record_name)}')
+            return None, msg_flag
+        else:
+            d[field_name] = value
+
+        # The alarm status is sometimes reported as a numeric value
+        # Convert to the string equivalent.
+        if value in d:
+            d[field_name] = d[value]
+        else:
+            d[field_name] = value
+
+    # Process the message fields
+    # The no_msg_flag will be set if the program fails to read any of them.
+    # This will prevent timeouts while getting these fields down the road.
+    if msg_flag:
+        for field_name in message_field_list:
+            # value = PV(channel_name(record_name, field_name)).get(as_string=True, timeout=GET_TIMEOUT)
+            value = get_channel_value(record_name, field_name, use_pv=use_pv)
+            if value is None:
+                msg_flag = False
+                break
+            else:
+                d[field_name] = value
+
+    return d, msg_flag
+
+
+def process_file(file_name: str, include_udf=False, csv_output=False, use_pv=False, keep_results=False) -> dict:
     """
     :param file_name: file name
     :param include_udf: include undefined alarms?
     :param csv_output: output in csv format?
     :param use_pv: use PV interface for channel access?
-    :return: list with output
+    :param keep_results: return the alarm dictionaries? (otherwise the records are only printed)
+    :return: dictionary of alarm dictionaries (None if there was a timeout) indexed by record name,
+             empty unless keep_results is set
     """
     try:
         f = open(file_name, 'r')
     except FileNotFoundError:
         print(f'file {file_name} does not exist')
-        return []
+        return {}
 
+    output_dict = {}
     msg_flag = True
     print_title(csv_output=csv_output)
 
     for line in f:
         record_name = line.strip()
 
-        timeout = False
-        d = default_alarm_dictionary()
-
-        # Loop over the field names.
-        # Break the loop if it fails to read.
-        for field_name in field_list:
-
-            # Get the channel value.
-            value = get_channel_value(record_name, field_name, use_pv=use_pv)
-            if value is None:
-                timeout = True
-                print(f'connection timeout {record_name}')
-                break
-            else:
-                d[field_name] = value
-
-            # The alarm status is sometimes reported as a numeric value
-            # Convert to the string equivalent.
-            if value in d:
-                d[field_name] = d[value]
-            else:
-                d[field_name] = value
-
-        # Process the message fields
-        # The no_msg_flag will be set if the program fails to read any of them.
-        # This will prevent timeouts while getting these fields down the road.
-        if msg_flag:
-            for field_name in message_field_list:
-                # value = PV(channel_name(record_name, field_name)).get(as_string=True, timeout=GET_TIMEOUT)
-                value = get_channel_value(record_name, field_name, use_pv=use_pv)
-                if value is None:
-                    msg_flag = False
-                    break
-                else:
-                    d[field_name] = value
+        with instrument.timer('record'):
+            d, msg_flag = get_record_alarms(record_name, msg_flag=msg_flag, use_pv=use_pv)
+        instrument.count('records')
+        if keep_results:
+            output_dict[record_name] = d
 
         # Skip record if there was a timeout or if there are no alarms
         # Ignoring the UDF alarm state is also done at this point.
-        if timeout:
+        if d is None:
             continue
         elif ignore_alarms(d, include_udf=include_udf):
             continue
 
         # The program will get here only if there are alarms
-        print_line(record_name, d, csv_output=csv_output)
+        instrument.count('alarms')
+        with instrument.timer('output'):
+            print_line(record_name, d, csv_output=csv_output)
+
+    return output_dict
 
 
 if __name__ == '__main__':
@@ -140,11 +181,25 @@ if __name__ == '__main__':
                         default=False,
                         help='use the high level channel interface interface')
 
+    parser.add_argument('--history',
+                        action='store',
+                        dest='history',
+                        nargs='?',
+                        const=HISTORY_FILE,
+                        default='',
+                        help='add the alarm states to the alarm history (see alarm_history.py)')
+
+    instrument.add_arguments(parser)
+
     args = parser.parse_args()
+    instrument.start(args)
 
     # Process input file. Trap keyboard exceptions (CTR-C).
     try:
-        process_file(args.input_file, include_udf=args.include_udf,
-                     csv_output=args.csv, use_pv=args.pv)
+        alarm_dict = process_file(args.input_file, include_udf=args.include_udf,
+                                  csv_output=args.csv, use_pv=args.pv, keep_results=bool(args.history))
+        if args.history and alarm_dict:
+            add_sweep(alarm_dict, source=f'check_alarms {os.path.abspath(args.input_file)}', file_name=args.history)
     except KeyboardInterrupt:
         print('Aborted')
+    instrument.finish(args)
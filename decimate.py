@@ -0,0 +1,123 @@
+"""
+Min/max envelope decimation used to plot long time series.
+
+Only the samples inside the current view are considered. When there are more
+samples than the plot can resolve, the view is split in buckets and the minimum
+and maximum of each bucket are kept (in time order), so spikes and jumps remain
+visible at any zoom level. The plotted data is recomputed from the cached arrays
+every time the x limits change (zoom/pan).
+"""
+import numpy as np
+
+# Number of points plotted per horizontal pixel
+POINTS_PER_PIXEL = 2
+
+# Number of points used when the axes size is not known
+DEFAULT_MAX_POINTS = 4000
+
+
+def view_indices(t: np.ndarray, t_min: float, t_max: float) -> tuple:
+    """
+    Return the index range of the samples inside a time window.
+    One extra sample is included at each side so the line reaches the plot edges.
+    :param t: sorted time array
+    :param t_min: window start
+    :param t_max: window end
+    :return: (start, end) indices
+    """
+    start = max(int(np.searchsorted(t, t_min, side='left')) - 1, 0)
+    end = min(int(np.searchsorted(t, t_max, side='right')) + 1, len(t))
+    return start, end
+
+
+def envelope(t: np.ndarray, v: np.ndarray, max_points: int) -> tuple:
+    """
+    Decimate a time series keeping the minimum and maximum value of each bucket.
+    The data is returned unchanged if it has max_points samples or fewer.
+    :param t: sorted time array
+    :param v: value array
+    :param max_points: maximum number of output points
+    :return: decimated (t, v) arrays
+    """
+    n = len(t)
+    buckets = max_points // 2
+    if n <= max_points or buckets < 1:
+        return t, v
+
+    # Buckets of equal size. The remainder goes into a last (shorter) bucket.
+    size = n // buckets
+    m = buckets * size
+    vb = v[:m].reshape(buckets, size)
+    offset = np.arange(buckets) * size
+    i_min = offset + np.argmin(vb, axis=1)
+    i_max = offset + np.argmax(vb, axis=1)
+    if m < n:
+        i_min = np.append(i_min, m + np.argmin(v[m:]))
+        i_max = np.append(i_max, m + np.argmax(v[m:]))
+
+    # Keep the points in time order, and the first and last sample
+    index = np.unique(np.concatenate(([0], i_min, i_max, [n - 1])))
+    return t[index], v[index]
+
+
+def decimate_view(t: np.ndarray, v: np.ndarray, t_min: float, t_max: float, max_points: int) -> tuple:
+    """
+    Decimate the part of a time series that falls inside a time window
+    :param t: sorted time array
+    :param v: value array
+    :param t_min: window start
+    :param t_max: window end
+    :param max_points: maximum number of output points
+    :return: decimated (t, v) arrays
+    """
+    start, end = view_indices(t, t_min, t_max)
+    return envelope(t[start:end], v[start:end], max_points)
+
+
+class DecimatedLine:
+    """
+    Line plot that is re-decimated from the cached arrays when the view changes.
+    A reference to the object has to be kept while the plot is displayed, since
+    matplotlib only keeps weak references to callbacks.
+    """
+
+    def __init__(self, ax, t: list, v: list, **kwargs):
+        """
+        :param ax: matplotlib axes
+        :param t: time list
+        :param v: value list
+        :param kwargs: passed to ax.plot
+        """
+        self.ax = ax
+        self.t = np.asarray(t, dtype=float)
+        self.v = np.asarray(v, dtype=float)
+
+        # Samples are normally in time order, but sort them just in case
+        if len(self.t) > 1 and np.any(np.diff(self.t) < 0):
+            index = np.argsort(self.t, kind='stable')
+            self.t, self.v = self.t[index], self.v[index]
+
+        t_dec, v_dec = envelope(self.t, self.v, self.max_points())
+        self.line, = ax.plot(t_dec, v_dec, **kwargs)
+        ax.callbacks.connect('xlim_changed', self.update)
+
+    def max_points(self) -> int:
+        """
+        Number of points that can be resolved with the current axes width
+        :return: maximum number of points
+        """
+        try:
+            width = int(self.ax.bbox.width)
+        except (AttributeError, ValueError):
+            width = 0
+        return POINTS_PER_PIXEL * width if width > 0 else DEFAULT_MAX_POINTS
+
+    def update(self, ax):
+        """
+        Callback used to re-decimate the data when the x limits change
+        :param ax: axes that changed
+        """
+        t_min, t_max = ax.get_xlim()
+        t_dec, v_dec = decimate_view(self.t, self.v, t_min, t_max, self.max_points())
+        self.line.set_data(t_dec, v_dec)
+        ax.figure.canvas.draw_idle()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Look for sampling anomalies in the capture logs, in a single streaming pass.
+
+Two log formats are supported:
+* wfs: camonitor output captured with capture_ag_wfs.csh (analayze_ag_wfs.py input)
+* coma: caget blocks captured with monitor_coma_follow.sh (process_coma_data.py input)
+
+Anomalies reported:
+* missed      interpol.VALH (global sample) or VALI (table sample) skipped values,
+              or M2 samples further apart than the 2 s capture period
+* reset       interpol.VALH went backwards
+* reversal    time stamp older than the previous one (same channel for camonitor)
+* stalled     periodic channel not updated for much longer than its usual update period (wfs),
+              or missing from consecutive caget blocks (coma)
+
+camonitor only logs a value when it changes, so event driven channels (e.g. followA,
+probeinPosition) are not checked for stalls: only the channels that are expected to
+update periodically (PERIODIC_CHANNELS, or the --periodic option) are.
+
+Each anomaly is reported with the byte offsets of the lines delimiting it,
+so the log can be opened at that position (e.g. tail -c +<offset>, or
+zcat <file> | tail -c +<offset> for compressed logs).
+"""
+import argparse
+from datetime import datetime
+from process_coma_data import get_timestamp
+from log_reader import read_lines
+
+FORMAT_WFS = 'wfs'
+FORMAT_COMA = 'coma'
+
+# Anomaly types
+MISSED = 'missed'
+RESET = 'reset'
+REVERSAL = 'reversal'
+STALLED = 'stalled'
+
+# Counter channel suffixes (camonitor logs)
+GLOBAL_SAMPLE = 'interpol.VALH'
+TABLE_SAMPLE = 'interpol.VALI'
+
+# Number of values of the table sample counter (0..19)
+TABLE_SIZE = 20
+
+# A channel is stalled when it is not updated for STALL_FACTOR times its average
+# update period, and at least MIN_STALL seconds (camonitor logs)
+STALL_FACTOR = 10
+MIN_STALL = 1.0
+
+# Channels updated periodically (the interpolated samples), checked for stalls in the
+# camonitor logs. Channel names ending with one of these are checked.
+PERIODIC_CHANNELS = ('interpol.VALA', 'interpol.VALB', 'interpol.VALC', 'interpol.VALD', 'interpol.VALE',
+                     'interpol.VALF', 'interpol.VALG', 'interpol.VALH', 'interpol.VALI')
+
+# Weight of the last interval in the average update period
+PERIOD_WEIGHT = 0.05
+
+# Capture period of the coma logs (seconds). Intervals longer than
+# COMA_PERIOD * COMA_TOLERANCE count as missed samples.
+COMA_PERIOD = 2.0
+COMA_TOLERANCE = 1.5
+
+# Number of consecutive blocks a channel has to be missing to be reported as stalled (coma logs)
+COMA_STALL_BLOCKS = 3
+
+# Report columns
+COLUMNS = ('type', 'channel', 'start_offset', 'end_offset', 'start_time', 'end_time', 'detail')
+
+# Cache used to convert dates to seconds
+_date_cache = {}
+
+
+def camonitor_seconds(date: str, time: str) -> float:
+    """
+    Fast conversion of a camonitor time stamp to seconds (since 0001-01-01).
+    Equivalent to strptime, but the date conversion is cached.
+    :param date: date 'YYYY-MM-DD'
+    :param time: time 'HH:MM:SS.SSSSSS'
+    :return: seconds
+    """
+    days = _date_cache.get(date)
+    if days is None:
+        days = datetime.strptime(date, '%Y-%m-%d').toordinal()
+        _date_cache[date] = days
+    h, m, s = time.split(':')
+    return days * 86400.0 + int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def format_seconds(t: float) -> str:
+    """
+    Format a time in seconds (since 0001-01-01) as a date and time string
+    :param t: seconds
+    :return: formatted time
+    """
+    days, s = divmod(t, 86400.0)
+    d = datetime.fromordinal(int(days))
+    h, s = divmod(s, 3600)
+    m, s = divmod(s, 60)
+    return f'{d:%Y-%m-%d} {int(h):02d}:{int(m):02d}:{s:09.6f}'
+
+
+def iter_lines(file_name: str):
+    """
+    Iterate over the lines of a file, keeping track of the byte offsets.
+    Compressed files are decompressed (see log_reader), and the offsets are
+    those of the decompressed data.
+    :param file_name: input file name
+    :return: generator of (offset, line) tuples
+    """
+    offset = 0
+    for line in read_lines(file_name):
+        yield offset, line.decode('utf-8', errors='replace')
+        offset += len(line)
+
+
+def anomaly(kind: str, channel: str, start_offset: int, end_offset: int,
+            start_time: float, end_time: float, detail: str) -> dict:
+    """
+    Build an anomaly dictionary (keyed by COLUMNS)
+    """
+    return {'type': kind, 'channel': channel, 'start_offset': start_offset, 'end_offset': end_offset,
+            'start_time': format_seconds(start_time), 'end_time': format_seconds(end_time), 'detail': detail}
+
+
+def scan_wfs(file_name: str, periodic=PERIODIC_CHANNELS) -> list:
+    """
+    Scan a camonitor log
+    :param file_name: input file name
+    :param periodic: suffixes of the channels checked for stalls
+    :return: list of anomaly dictionaries
+    """
+    output_list = []
+    last = {}      # channel -> (offset, time, value)
+    period = {}    # channel -> average update period
+    checked = {}   # channel -> checked for stalls?
+
+    for offset, line in iter_lines(file_name):
+        aux = line.split()
+        if len(aux) < 4 or len(aux[1]) != 10 or aux[1][4] != '-':
+            continue
+        channel = aux[0]
+        try:
+            t = camonitor_seconds(aux[1], aux[2])
+        except ValueError:
+            continue
+
+        if channel not in last:
+            last[channel] = (offset, t, aux[3])
+            continue
+        last_offset, last_t, last_value = last[channel]
+        dt = t - last_t
+
+        if channel not in checked:
+            checked[channel] = channel.endswith(tuple(periodic))
+
+        if dt < 0:
+            output_list.append(anomaly(REVERSAL, channel, last_offset, offset, last_t, t,
+                                       f'{dt:.6f} s'))
+        elif checked[channel] and channel in period:
+            p = period[channel]
+            if dt > STALL_FACTOR * p and dt > MIN_STALL:
+                output_list.append(anomaly(STALLED, channel, last_offset, offset, last_t, t,
+                                           f'{dt:.3f} s without updates (period {p:.3f} s)'))
+            period[channel] = p + PERIOD_WEIGHT * (dt - p)
+        elif checked[channel] and dt > 0:
+            period[channel] = dt
+
+        if channel.endswith(GLOBAL_SAMPLE) or channel.endswith(TABLE_SAMPLE):
+            try:
+                delta = int(float(aux[3])) - int(float(last_value))
+            except ValueError:
+                delta = 1
+            if channel.endswith(TABLE_SAMPLE):
+                delta %= TABLE_SIZE
+            if delta > 1:
+                output_list.append(anomaly(MISSED, channel, last_offset, offset, last_t, t,
+                                           f'{delta - 1} samples ({last_value} -> {aux[3]})'))
+            elif delta < 0:
+                output_list.append(anomaly(RESET, channel, last_offset, offset, last_t, t,
+                                           f'{last_value} -> {aux[3]}'))
+
+        last[channel] = (offset, t, aux[3])
+
+    return output_list
+
+
+def scan_coma(file_name: str) -> list:
+    """
+    Scan a coma log (caget blocks separated by time stamp lines)
+    :param file_name: input file name
+    :return: list of anomaly dictionaries
+    """
+    output_list = []
+    last_offset, last_t = None, None
+    seen = {}       # channel -> (offset, time) of the last block where it was present
+    block = set()   # channels in the current block
+    missing = {}    # channel -> number of consecutive blocks without the channel
+
+    def close_block(offset: int, t: float):
+        for channel in seen:
+            if channel in block:
+                missing[channel] = 0
+                continue
+            missing[channel] = missing.get(channel, 0) + 1
+            if missing[channel] == COMA_STALL_BLOCKS:
+                s_offset, s_t = seen[channel]
+                output_list.append(anomaly(STALLED, channel, s_offset, offset, s_t, t,
+                                           f'missing from {COMA_STALL_BLOCKS} blocks'))
+
+    for offset, line in iter_lines(file_name):
+        if '---' in line:
+            try:
+                ts = get_timestamp(line)
+                t = ts.toordinal() * 86400.0 + ts.hour * 3600 + ts.minute * 60 + ts.second
+            except ValueError:
+                continue
+            if last_t is not None:
+                close_block(offset, t)
+                dt = t - last_t
+                if dt < 0:
+                    output_list.append(anomaly(REVERSAL, '', last_offset, offset, last_t, t, f'{dt:.0f} s'))
+                elif dt > COMA_PERIOD * COMA_TOLERANCE:
+                    n = int(round(dt / COMA_PERIOD)) - 1
+                    output_list.append(anomaly(MISSED, '', last_offset, offset, last_t, t,
+                                               f'{max(n, 1)} samples ({dt:.0f} s)'))
+            last_offset, last_t = offset, t
+            block = set()
+        elif last_t is not None:
+            aux = line.split()
+            if len(aux) > 1:
+                block.add(aux[0])
+                seen[aux[0]] = (last_offset, last_t)
+    return output_list
+
+
+def detect_format(file_name: str) -> str:
+    """
+    Guess the log format from the first non empty line
+    :param file_name: input file name
+    :return: FORMAT_WFS or FORMAT_COMA
+    """
+    for _, line in iter_lines(file_name):
+        if line.strip():
+            return FORMAT_COMA if line.startswith('--') else FORMAT_WFS
+    return FORMAT_WFS
+
+
+def print_anomalies(anomalies: list, csv_output=False):
+    """
+    Print the anomaly report
+    :param anomalies: list of anomaly dictionaries
+    :param csv_output: csv output?
+    """
+    if csv_output:
+        print(','.join(COLUMNS))
+        for a in anomalies:
+            print(','.join(str(a[_]) for _ in COLUMNS))
+    else:
+        for a in anomalies:
+            print(f'{a["type"]:10}{a["channel"]:28}{a["start_offset"]:>12}{a["end_offset"]:>12}  '
+                  f'{a["start_time"]}  {a["end_time"]}  {a["detail"]}')
+        print(f'{len(anomalies)} anomalies')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(action='store',
+                        dest='input_file',
+                        help='camonitor (wfs) or coma log file')
+
+    parser.add_argument('-f', '--format',
+                        action='store',
+                        dest='format',
+                        choices=[FORMAT_WFS, FORMAT_COMA],
+                        default='',
+                        help='log format (guessed from the file contents by default)')
+
+    parser.add_argument('--csv',
+                        action='store_true',
+                        dest='csv',
+                        default=False,
+                        help='format output as csv')
+
+    parser.add_argument('--periodic',
+                        action='append',
+                        dest='periodic',
+                        default=None,
+                        metavar='SUFFIX',
+                        help='channel name suffix of a periodic channel checked for stalls (wfs logs, can be '
+                             'repeated, default is the interpol channels)')
+
+    args = parser.parse_args()
+
+    try:
+        log_format = args.format if args.format else detect_format(args.input_file)
+        if log_format == FORMAT_COMA:
+            anomaly_list = scan_coma(args.input_file)
+        else:
+            anomaly_list = scan_wfs(args.input_file, periodic=args.periodic if args.periodic else PERIODIC_CHANNELS)
+        print_anomalies(anomaly_list, csv_output=args.csv)
+    except OSError:
+        print(f'Cannot open file {args.input_file}')
+    except KeyboardInterrupt:
+        print('Aborted')
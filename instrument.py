@@ -0,0 +1,217 @@
+"""
+Lightweight instrumentation shared by the scripts in this directory.
+
+Stages are timed with the timer context manager and events are counted with count.
+Nothing is recorded until enable is called (normally through the --stats option),
+so the cost in normal runs is a flag check per call.
+
+Optional hooks:
+* cProfile: the whole run is profiled and the statistics are written to a file
+  (read them with python -m pstats <file>)
+* tracemalloc: the peak traced memory and the top allocation sites are added to the stats
+
+Usage in a script:
+* add_arguments(parser) adds --stats, --profile and --trace-memory
+* start(args) after parsing the command line
+* finish(args) at the end of the run. The stage breakdown is printed to the standard
+  error, or written as json if --stats is given a file name (for trend tracking)
+
+Stats collected in worker processes (e.g. log_reader chunks) are not merged.
+"""
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+
+# Number of allocation sites reported by tracemalloc
+TOP_ALLOCATIONS = 10
+
+enabled = False
+
+# Stage times: name -> [count, total seconds, maximum seconds]
+_timers = {}
+
+# Counters: name -> value
+_counters = {}
+
+_start_time = None
+_profiler = None
+
+
+class timer:
+    """
+    Context manager that adds the elapsed time of a block to a stage
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if enabled:
+            add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def add_time(name: str, seconds: float):
+    """
+    Add a time measurement to a stage
+    :param name: stage name
+    :param seconds: elapsed time (seconds)
+    """
+    if not enabled:
+        return
+    t = _timers.get(name)
+    if t is None:
+        _timers[name] = [1, seconds, seconds]
+    else:
+        t[0] += 1
+        t[1] += seconds
+        if seconds > t[2]:
+            t[2] = seconds
+
+
+def count(name: str, n=1):
+    """
+    Increment a counter
+    :param name: counter name
+    :param n: increment
+    """
+    if enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def enable(profile=False, trace_memory=False):
+    """
+    Start recording (and optionally profiling)
+    :param profile: run cProfile?
+    :param trace_memory: run tracemalloc?
+    """
+    global enabled, _start_time, _profiler
+    enabled = True
+    _start_time = time.perf_counter()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    if profile:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def reset():
+    """
+    Clear the recorded stats
+    """
+    global _start_time
+    _timers.clear()
+    _counters.clear()
+    _start_time = time.perf_counter()
+
+
+def stats() -> dict:
+    """
+    Return the recorded stats
+    :return: dictionary with the wall time, stage times, counters and memory (if traced)
+    """
+    d = {'time': datetime.now().isoformat(timespec='seconds'),
+         'argv': sys.argv,
+         'wall': time.perf_counter() - _start_time if _start_time is not None else 0.0,
+         'stages': {name: {'count': t[0], 'total': t[1], 'max': t[2]} for name, t in _timers.items()},
+         'counters': dict(_counters)}
+    try:
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:TOP_ALLOCATIONS]
+            d['memory'] = {'current': current, 'peak': peak,
+                           'top': [{'site': str(_.traceback), 'size': _.size, 'count': _.count} for _ in top]}
+    except ImportError:
+        pass
+    return d
+
+
+def print_stats(d: dict, file=sys.stderr):
+    """
+    Print the stage breakdown
+    :param d: stats dictionary
+    :param file: output stream
+    """
+    wall = d['wall']
+    print(f'{"stage":32}{"count":>10}{"total s":>10}{"mean ms":>10}{"max ms":>10}{"wall %":>8}', file=file)
+    for name, t in sorted(d['stages'].items(), key=lambda _: -_[1]['total']):
+        percent = t['total'] / wall * 100 if wall > 0 else 0
+        print(f'{name:32}{t["count"]:>10}{t["total"]:>10.3f}{t["total"] / t["count"] * 1000:>10.3f}'
+              f'{t["max"] * 1000:>10.3f}{percent:>8.1f}', file=file)
+    print(f'{"wall":32}{"":>10}{wall:>10.3f}', file=file)
+    for name in sorted(d['counters']):
+        print(f'{name:32}{d["counters"][name]:>10}', file=file)
+    if 'memory' in d:
+        print(f'traced memory peak {d["memory"]["peak"] / 1024 / 1024:.1f} MB', file=file)
+        for site in d['memory']['top']:
+            print(f'{site["size"] / 1024:>10.1f} kB {site["count"]:>8}  {site["site"]}', file=file)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """
+    Add the instrumentation options to a command line parser
+    :param parser: argument parser
+    """
+    parser.add_argument('--stats',
+                        action='store',
+                        dest='stats',
+                        nargs='?',
+                        const='-',
+                        default='',
+                        metavar='FILE',
+                        help='print a stage breakdown to the standard error, or write it to a json file')
+
+    parser.add_argument('--profile',
+                        action='store',
+                        dest='profile',
+                        default='',
+                        metavar='FILE',
+                        help='profile the run with cProfile and write the statistics to a file')
+
+    parser.add_argument('--trace-memory',
+                        action='store_true',
+                        dest='trace_memory',
+                        default=False,
+                        help='trace memory allocations (reported with --stats)')
+
+
+def start(args: argparse.Namespace):
+    """
+    Enable the instrumentation requested in the command line
+    :param args: parsed command line (see add_arguments)
+    """
+    if args.stats or args.profile or args.trace_memory:
+        enable(profile=bool(args.profile), trace_memory=args.trace_memory)
+
+
+def finish(args: argparse.Namespace):
+    """
+    Write the profile and the stats requested in the command line
+    :param args: parsed command line (see add_arguments)
+    """
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(args.profile)
+    if not enabled:
+        return
+    d = stats()
+    if args.stats == '-' or (args.trace_memory and not args.stats):
+        print_stats(d)
+    elif args.stats:
+        try:
+            with open(args.stats, 'w') as f:
+                json.dump(d, f, indent=2)
+        except OSError as e:
+            print(f'Cannot write stats: {e}', file=sys.stderr)
@@ -0,0 +1,469 @@
+"""
+Shared reader for the line oriented capture logs (camonitor, caget, coma logs).
+
+The file is memory mapped and split into chunks that always end at a newline.
+Each chunk is decoded and handed to a line handler in a separate process.
+The handler results are returned in file order, one per chunk.
+
+Line handlers receive a list of lines (without the trailing newline) and return
+any picklable object. They have to be defined at module level (or be a
+functools.partial of a module level function) so they can be sent to the
+worker processes.
+
+iter_chunks and iter_lines return the results as they are ready and only read a
+few chunks ahead, so the memory used does not depend on the file size (see
+budget_chunk_size for the --max-mem option of the scripts).
+
+Compressed logs (gzip or zstd, detected from the first bytes of the file) cannot be
+memory mapped. They are decompressed in a background thread, so the decompression
+overlaps with the parsing, and the chunks of lines are parsed in the calling process:
+sending the decoded lines to the workers costs about as much as parsing them.
+zstd requires the zstandard module.
+"""
+import os
+import sys
+import mmap
+import zlib
+from typing import Callable, Iterator, Union
+
+# Approximate size of each chunk (bytes)
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files smaller than this are processed in the calling process
+MIN_PARALLEL_SIZE = 2 * DEFAULT_CHUNK_SIZE
+
+# Encoding used to decode the log files
+ENCODING = 'utf-8'
+
+# Approximate memory used per byte of log text once it is decoded and parsed
+# into Python objects (lines, tuples and strings)
+MEMORY_PER_BYTE = 12
+
+# Smallest chunk size used with a memory budget (bytes)
+MIN_CHUNK_SIZE = 64 * 1024
+
+# Compression formats and their magic bytes
+GZIP = 'gzip'
+ZSTD = 'zstd'
+MAGIC_BYTES = {GZIP: b'\x1f\x8b', ZSTD: b'\x28\xb5\x2f\xfd'}
+
+# Size of the blocks read from compressed files (bytes)
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number of decompressed blocks the background thread can read ahead
+READ_AHEAD = 4
+
+
+def chunk_offsets(file_name: str, chunk_size=DEFAULT_CHUNK_SIZE) -> list:
+    """
+    Split a file in chunks of approximately chunk_size bytes.
+    The chunk boundaries are moved forward to the next newline so lines are never split.
+    :param file_name: input file name
+    :param chunk_size: approximate chunk size (bytes)
+    :return: list of (start, end) offset tuples
+    """
+    size = os.path.getsize(file_name)
+    if size == 0:
+        return []
+    output_list = []
+    with open(file_name, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = 0
+            while start < size:
+                end = min(start + chunk_size, size)
+                if end < size:
+                    n = m.find(b'\n', end - 1)
+                    end = size if n < 0 else n + 1
+                output_list.append((start, end))
+                start = end
+    return output_list
+
+
+def read_chunk(file_name: str, start: int, end: int) -> list:
+    """
+    Read the lines between two file offsets
+    :param file_name: input file name
+    :param start: starting offset
+    :param end: ending offset (not included)
+    :return: list of lines
+    """
+    with open(file_name, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            data = m[start:end]
+    return data.decode(ENCODING, errors='replace').splitlines()
+
+
+def _process_chunk(handler: Callable, file_name: str, start: int, end: int):
+    """
+    Worker entry point. Read a chunk and pass its lines to the handler.
+    :param handler: line handler
+    :param file_name: input file name
+    :param start: starting offset
+    :param end: ending offset
+    :return: handler output
+    """
+    return handler(read_chunk(file_name, start, end))
+
+
+def compression(file_name: str) -> str:
+    """
+    Detect the compression of a file from its first bytes
+    :param file_name: input file name
+    :return: GZIP, ZSTD or an empty string if the file is not compressed
+    """
+    with open(file_name, 'rb') as f:
+        magic = f.read(4)
+    for kind, magic_bytes in MAGIC_BYTES.items():
+        if magic.startswith(magic_bytes):
+            return kind
+    return ''
+
+
+def _plain_blocks(f, block_size: int) -> Iterator:
+    """
+    Read an uncompressed file in blocks
+    :param f: binary file object (closed at the end)
+    :param block_size: block size (bytes)
+    :return: iterator of byte blocks
+    """
+    with f:
+        block = f.read(block_size)
+        while block:
+            yield block
+            block = f.read(block_size)
+
+
+def _gzip_blocks(f, file_name: str, block_size: int) -> Iterator:
+    """
+    Decompress a gzip file (or several concatenated gzip files) in blocks.
+    Truncated files (e.g. an interrupted capture) are read up to the last complete line,
+    and invalid data (e.g. trailing garbage after the last member) is ignored.
+    :param f: binary file object (closed at the end)
+    :param file_name: input file name (for messages)
+    :param block_size: read size and maximum decompressed block size (bytes)
+    :return: iterator of decompressed byte blocks
+    """
+    with f:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        started = False
+        # The last block is held back, so it can be cut if the file is truncated
+        last = b''
+        raw = f.read(block_size)
+        while raw:
+            try:
+                block = d.decompress(raw, block_size)
+            except zlib.error as e:
+                print(f'{file_name}: invalid compressed data ({e}), the rest of the file is ignored',
+                      file=sys.stderr)
+                if started:
+                    last = last[:last.rfind(b'\n') + 1]
+                started = False
+                break
+            started = True
+            if block:
+                if last:
+                    yield last
+                last = block
+            if d.eof:
+                # Next member
+                raw = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                started = False
+            else:
+                raw = d.unconsumed_tail
+            if not raw:
+                raw = f.read(block_size)
+        if started:
+            last += d.flush()
+            if not d.eof:
+                print(f'{file_name}: compressed data ended unexpectedly (truncated file?), '
+                      f'the incomplete last line is ignored', file=sys.stderr)
+                last = last[:last.rfind(b'\n') + 1]
+        if last:
+            yield last
+
+
+def _zstd_blocks(f, file_name: str, block_size: int) -> Iterator:
+    """
+    Decompress a zstd file in blocks.
+    The decompressor does not report truncated files, so an incomplete last line
+    (the captures always end with a newline) is taken as a truncated file.
+    :param f: binary file object (closed at the end)
+    :param file_name: input file name (for messages)
+    :param block_size: read size and maximum decompressed block size (bytes)
+    :return: iterator of decompressed byte blocks
+    """
+    import zstandard
+    with f:
+        d = zstandard.ZstdDecompressor()
+        try:
+            reader = d.stream_reader(f, read_size=block_size, read_across_frames=True)
+        except TypeError:
+            # zstandard < 0.16 (only the first frame is read)
+            reader = d.stream_reader(f, read_size=block_size)
+        last = b''
+        try:
+            block = reader.read(block_size)
+            while block:
+                if last:
+                    yield last
+                last = block
+                block = reader.read(block_size)
+        except zstandard.ZstdError as e:
+            print(f'{file_name}: {e}', file=sys.stderr)
+        if last and not last.endswith(b'\n'):
+            print(f'{file_name}: incomplete last line (truncated file?), the line is ignored', file=sys.stderr)
+            last = last[:last.rfind(b'\n') + 1]
+        if last:
+            yield last
+
+
+def _read_ahead(blocks: Iterator) -> Iterator:
+    """
+    Run a block iterator in a background thread, so the file is read and decompressed
+    while the previous blocks are processed (zlib and zstandard release the GIL).
+    :param blocks: iterator of byte blocks
+    :return: iterator of byte blocks
+    """
+    import queue
+    import threading
+
+    q = queue.Queue(maxsize=READ_AHEAD)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for block in blocks:
+                if not put(block):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            blocks.close()
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def read_blocks(file_name: str, block_size=READ_BUFFER_SIZE) -> Iterator:
+    """
+    Read a file in blocks, decompressing it if needed (see compression).
+    The file is opened before returning, so OSError is raised by this call.
+    :param file_name: input file name
+    :param block_size: read size and maximum decompressed block size (bytes)
+    :return: iterator of (decompressed) byte blocks
+    """
+    kind = compression(file_name)
+    if kind == ZSTD:
+        try:
+            import zstandard
+        except ImportError:
+            raise OSError(f'{file_name} is zstd compressed (the zstandard module is not installed)')
+    f = open(file_name, 'rb')
+    if kind == GZIP:
+        return _read_ahead(_gzip_blocks(f, file_name, block_size))
+    elif kind == ZSTD:
+        return _read_ahead(_zstd_blocks(f, file_name, block_size))
+    return _plain_blocks(f, block_size)
+
+
+def _split_lines(blocks: Iterator) -> Iterator:
+    """
+    Split byte blocks into lines
+    :param blocks: iterator of byte blocks
+    :return: iterator of lines (bytes, including the newline)
+    """
+    rest = b''
+    for block in blocks:
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+
+def read_lines(file_name: str) -> Iterator:
+    """
+    Read the lines of a file, decompressing it if needed
+    :param file_name: input file name
+    :return: iterator of lines (bytes, including the newline)
+    """
+    return _split_lines(read_blocks(file_name))
+
+
+def _stream_chunks(blocks: Iterator, chunk_size: int) -> Iterator:
+    """
+    Group byte blocks into chunks of approximately chunk_size bytes that end at a newline
+    :param blocks: iterator of byte blocks
+    :param chunk_size: approximate chunk size (bytes)
+    :return: iterator of line lists (decoded, without the newline)
+    """
+    buffer = []
+    size = 0
+    rest = b''
+    for block in blocks:
+        data = rest + block
+        n = data.rfind(b'\n') + 1
+        rest = data[n:]
+        if n == 0:
+            continue
+        buffer.append(data[:n])
+        size += n
+        if size >= chunk_size:
+            yield b''.join(buffer).decode(ENCODING, errors='replace').splitlines()
+            buffer = []
+            size = 0
+    if rest:
+        buffer.append(rest)
+    if buffer:
+        yield b''.join(buffer).decode(ENCODING, errors='replace').splitlines()
+
+
+def _apply(tasks: Iterator, workers: int) -> Iterator:
+    """
+    Run (function, argument tuple) tasks in worker processes, keeping at most one task
+    per worker ahead of the one being returned. With workers=1, or a single task,
+    the tasks run in the calling process.
+    :param tasks: iterator of (function, argument tuple) tuples
+    :param workers: number of worker processes
+    :return: iterator with the function outputs, in task order
+    """
+    first = next(tasks, None)
+    second = next(tasks, None) if first is not None and workers > 1 else None
+    # The tasks are released as soon as they are done (they can hold a whole chunk)
+    if second is None:
+        if first is not None:
+            function, arguments = first
+            first = None
+            yield function(*arguments)
+        for function, arguments in tasks:
+            yield function(*arguments)
+        return
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque([executor.submit(first[0], *first[1]), executor.submit(second[0], *second[1])])
+        first = second = None
+        for function, arguments in tasks:
+            pending.append(executor.submit(function, *arguments))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def map_chunks(file_name: str, handler: Callable, workers: Union[int, None] = None,
+               chunk_size=DEFAULT_CHUNK_SIZE) -> list:
+    """
+    Apply a line handler to all the chunks in a file.
+    Small files (or workers=1) are processed in the calling process.
+    :param file_name: input file name
+    :param handler: function that takes a list of lines and returns the parsed data
+    :param workers: number of worker processes (None = number of cores)
+    :param chunk_size: approximate chunk size (bytes)
+    :return: list with the handler output for each chunk, in file order
+    """
+    if compression(file_name):
+        return list(iter_chunks(file_name, handler, workers=workers, chunk_size=chunk_size))
+    offsets = chunk_offsets(file_name, chunk_size=chunk_size)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(offsets) < 2 or os.path.getsize(file_name) < MIN_PARALLEL_SIZE:
+        return [_process_chunk(handler, file_name, start, end) for start, end in offsets]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(workers, len(offsets))) as executor:
+        futures = [executor.submit(_process_chunk, handler, file_name, start, end) for start, end in offsets]
+        return [_.result() for _ in futures]
+
+
+def map_lines(file_name: str, handler: Callable, workers: Union[int, None] = None,
+              chunk_size=DEFAULT_CHUNK_SIZE) -> list:
+    """
+    Same as map_chunks, but for handlers that return a list.
+    The per chunk lists are concatenated in file order.
+    :param file_name: input file name
+    :param handler: function that takes a list of lines and returns a list
+    :param workers: number of worker processes (None = number of cores)
+    :param chunk_size: approximate chunk size (bytes)
+    :return: concatenated handler output
+    """
+    output_list = []
+    for chunk in map_chunks(file_name, handler, workers=workers, chunk_size=chunk_size):
+        output_list.extend(chunk)
+    return output_list
+
+
+def iter_chunks(file_name: str, handler: Callable, workers: Union[int, None] = None,
+                chunk_size=DEFAULT_CHUNK_SIZE) -> Iterator:
+    """
+    Same as map_chunks, but the handler outputs are returned one at a time.
+    At most one chunk per worker is read ahead of the one being returned.
+    Compressed files are always parsed in the calling process (see the module documentation).
+    The file is opened before returning, so OSError is raised by this call.
+    :param file_name: input file name
+    :param handler: function that takes a list of lines and returns the parsed data
+    :param workers: number of worker processes (None = number of cores)
+    :param chunk_size: approximate chunk size (bytes)
+    :return: iterator with the handler output for each chunk, in file order
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if compression(file_name):
+        # Blocks smaller than the chunks, so the chunks are not much larger than chunk_size.
+        # Parsed in this process: pickling the lines to the workers and the results back costs
+        # more than the parsing, the decompression thread gives the overlap.
+        blocks = read_blocks(file_name, block_size=min(READ_BUFFER_SIZE, chunk_size // 4))
+        chunks = _stream_chunks(blocks, chunk_size)
+        return _apply(((handler, (lines,)) for lines in chunks), 1)
+    offsets = chunk_offsets(file_name, chunk_size=chunk_size)
+    return _apply(((_process_chunk, (handler, file_name, start, end)) for start, end in offsets), workers)
+
+
+def iter_lines(file_name: str, handler: Callable, workers: Union[int, None] = None,
+               chunk_size=DEFAULT_CHUNK_SIZE) -> Iterator:
+    """
+    Same as map_lines, but the handler output is returned one item at a time (see iter_chunks)
+    :param file_name: input file name
+    :param handler: function that takes a list of lines and returns a list
+    :param workers: number of worker processes (None = number of cores)
+    :param chunk_size: approximate chunk size (bytes)
+    :return: iterator with the handler output items, in file order
+    """
+    chunks = iter_chunks(file_name, handler, workers=workers, chunk_size=chunk_size)
+    return (item for chunk in chunks for item in chunk)
+
+
+def budget_chunk_size(max_memory: int, workers: Union[int, None] = None) -> int:
+    """
+    Chunk size that keeps the chunks being parsed within a memory budget.
+    Each worker and the calling process hold about two chunks at a time
+    (the decoded lines and the handler output).
+    :param max_memory: memory budget (bytes)
+    :param workers: number of worker processes (None = number of cores)
+    :return: chunk size (bytes)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return max(MIN_CHUNK_SIZE, min(DEFAULT_CHUNK_SIZE, max_memory // (MEMORY_PER_BYTE * 2 * (workers + 1))))
@@ -1,10 +1,13 @@
 #!/bin/csh
 
+# The channels are defined in the 'coma_capture' group of the channel catalog
+set dir = `dirname $0`
+set channels = (`$dir/catalog.py channels coma_capture`)
 
-while (1)
-	set ts = `date +"%Y%m%d-%H:%M:%S"`
-	echo "-- $ts --------------------"
-	caget -g 10 \
+# Copy of DEFAULT_GROUPS['coma_capture'], used when the catalog cannot be read
+# (e.g. no python3). Check it with: catalog.py groups
+if ($#channels == 0) then
+	set fallback = ( \
 		m2:xPos \
 		m2:yPos \
 		tcs:m2XUserOffset \
@@ -33,6 +36,14 @@ while (1)
 		tcs:drives:driveM2S.VALF \
 		tcs:drives:driveM2S.VALG \
 		tcs:drives:driveM2S.VALH \
-		tcs:drives:driveM2S.VALI
+		tcs:drives:driveM2S.VALI \
+		)
+	set channels = ($fallback)
+endif
+
+while (1)
+	set ts = `date +"%Y%m%d-%H:%M:%S"`
+	echo "-- $ts --------------------"
+	caget -g 10 $channels
 	sleep 2
 end
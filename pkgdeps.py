@@ -13,13 +13,30 @@ In general, the BuildRequires dependencies have a -devel.
 """
 import os
 import re
+import json
+import heapq
 import argparse
+import subprocess
+from itertools import chain
+from collections import deque
+from typing import Union
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 DEFAULT_PATH = os.getcwd()
 IGNORE = ['epics-base', 're2c', 'gemini-ade', 'rpcgen', 'libtirpc', 'tdct', 'psmisc', '%{name}']
 MATCH_REQ = '^Requires:'
 MATCH_BUILD = '^BuildRequires:'
 DEVEL = '-devel'
+PATTERN_REQ = re.compile(MATCH_REQ)
+PATTERN_BUILD = re.compile(MATCH_BUILD)
+PATTERN_IF = re.compile(r'^%if')
+PATTERN_ELIF = re.compile(r'^%elif')
+PATTERN_ELSE = re.compile(r'^%else')
+PATTERN_ENDIF = re.compile(r'^%endif')
+SPEC_WORKERS = 16
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'pkgdeps.json')
+CACHE_VERSION = 2
+DEFAULT_BUILD_TIME = 1.0
 
 
 def spec_file(name: str):
@@ -70,45 +87,173 @@ def filter_line(line: str) -> set:
     return {map_dependency(_) for _ in line.split()[1:] if _ not in IGNORE}
 
 
+def condition_value(line: str) -> Union[bool, None]:
+    """
+    Evaluate a %if or %elif conditional line.
+    Only constant numeric conditions (e.g. "%if 0") can be evaluated. The value
+    of anything else (macros, %ifarch, etc.) is unknown.
+    :param line: conditional line
+    :return: True, False or None if unknown
+    """
+    t = line.split()
+    if t[0] in ('%if', '%elif') and len(t) == 2 and re.match(r'^[0-9]+$', t[1]):
+        return int(t[1]) != 0
+    return None
+
+
+def either(a: Union[bool, None], b: Union[bool, None]) -> Union[bool, None]:
+    """
+    Three valued "or" of two conditions
+    :param a: True, False or None if unknown
+    :param b: True, False or None if unknown
+    :return: True, False or None if unknown
+    """
+    if a or b:
+        return True
+    return None if a is None or b is None else False
+
+
 def process_file(file_name: str) -> tuple:
     """
     Process spec file
     It returns the "Requires" and "BuildRequires" sets in a tuple
+    Lines ending with a backslash are joined with the next line.
+    Dependencies inside %if blocks that cannot be evaluated are included
+    (all the branches), since they are needed on some build.
     :param file_name: spec file name
     :return: tuple with dependencies
     """
     req_set = set()
     build_set = set()
+    # Conditional levels: [value of the current branch, was an earlier branch taken],
+    # with True, False or None if unknown
+    stack = []
     with open(file_name, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if re.search(MATCH_REQ, line):
-                req_set = req_set | filter_line(line)
-            elif re.search(MATCH_BUILD, line):
-                build_set = build_set | filter_line(line)
+        line = ''
+        # The empty line at the end flushes a continued last line
+        for next_line in chain(f, ['']):
+            line += next_line.strip()
+            if line.endswith('\\'):
+                line = line[:-1] + ' '
+                continue
+            if PATTERN_IF.search(line):
+                value = condition_value(line)
+                stack.append([value, value])
+            elif PATTERN_ELIF.search(line):
+                if stack:
+                    value, taken = condition_value(line), stack[-1][1]
+                    stack[-1] = [False if taken or value is False else (value if taken is False else None),
+                                 either(taken, value)]
+            elif PATTERN_ELSE.search(line):
+                if stack:
+                    taken = stack[-1][1]
+                    stack[-1] = [False if taken else (None if taken is None else True), True]
+            elif PATTERN_ENDIF.search(line):
+                if stack:
+                    stack.pop()
+            elif all(_[0] is not False for _ in stack):
+                if PATTERN_REQ.search(line):
+                    req_set.update(filter_line(line))
+                elif PATTERN_BUILD.search(line):
+                    build_set.update(filter_line(line))
+            line = ''
+    return req_set, build_set
+
+
+def load_cache(file_name: str) -> dict:
+    """
+    Load the spec file cache.
+    The cache is a dictionary indexed by the spec file name where each entry contains
+    the file modification time and size and the "Requires" and "BuildRequires" lists.
+    :param file_name: cache file name
+    :return: cache dictionary (empty if the file does not exist or is not valid)
+    """
+    try:
+        with open(file_name, 'r') as f:
+            d = json.load(f)
+        if d.get('version') == CACHE_VERSION:
+            return d['specs']
+    except (IOError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def save_cache(file_name: str, cache: dict):
+    """
+    Save the spec file cache.
+    The file is replaced atomically so concurrent runs do not see a partial file.
+    :param file_name: cache file name
+    :param cache: cache dictionary
+    """
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        tmp_file_name = f'{file_name}.{os.getpid()}'
+        with open(tmp_file_name, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'specs': cache}, f)
+        os.replace(tmp_file_name, file_name)
+    except IOError:
+        print(f'{file_name} could not be written')
+
+
+def process_cached_file(file_name: str, cache: dict) -> tuple:
+    """
+    Process a spec file, reusing the cached result if the file did not change
+    (same modification time and size). The cache is updated otherwise.
+    :param file_name: spec file name
+    :param cache: cache dictionary
+    :return: tuple with dependencies
+    """
+    key = os.path.abspath(file_name)
+    st = os.stat(key)
+    entry = cache.get(key)
+    if entry is not None and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+        return set(entry['requires']), set(entry['build'])
+    req_set, build_set = process_file(key)
+    cache[key] = {'mtime': st.st_mtime_ns, 'size': st.st_size,
+                  'requires': sorted(req_set), 'build': sorted(build_set)}
     return req_set, build_set
 
 
-def process_dependencies(path_name: str, file_name: str) -> dict:
+def process_dependencies(path_name: str, file_name: str, cache_file=DEFAULT_CACHE_FILE, workers=SPEC_WORKERS) -> dict:
     """
     Process package dependencies
     It returns a dictionary indexed by the package name where each entry
     is a tuple of two sets with the "Requires" and "BuildRequires" dependencies.
+    The spec files are read in a thread pool (they are normally on NFS), and the
+    results are cached by file name and modification time.
+    Packages whose spec file cannot be read are reported and skipped.
     :param path_name: directory where the package source is located
     :param file_name: file containing the list of packages to process
+    :param cache_file: spec file cache (no caching if empty)
+    :param workers: number of threads used to read the spec files
     :return: dictionary with dependencies
     """
-    d = {}
     try:
-        f = open(file_name, 'r')
-        for line in f:
-            package_name = line.strip()
-            spec_file_name = os.path.join(path_name, spec_file(package_name))
-            d[package_name] = process_file(spec_file_name)
-        f.close()
-        return d
+        with open(file_name, 'r') as f:
+            package_list = [_.strip() for _ in f if _.strip()]
     except IOError:
         print(f'{file_name} could not be processed')
+        return None
+
+    cache = load_cache(cache_file) if cache_file else {}
+
+    def process_package(package_name: str) -> Union[tuple, None]:
+        spec_file_name = os.path.join(path_name, spec_file(package_name))
+        try:
+            return process_cached_file(spec_file_name, cache)
+        except IOError:
+            print(f'{spec_file_name} could not be processed')
+            return None
+
+    d = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for package_name, deps in zip(package_list, executor.map(process_package, package_list)):
+            if deps is not None:
+                d[package_name] = deps
+
+    if cache_file:
+        save_cache(cache_file, cache)
+    return d
 
 
 def generate_dot_output(file_name: str, deps: dict):
@@ -129,35 +274,529 @@ def generate_dot_output(file_name: str, deps: dict):
     f.close()
 
 
+def build_graph(deps: dict) -> tuple:
+    """
+    Build the dependency graph used by the build order functions.
+    Only the BuildRequires dependencies that are in the dependency dictionary are
+    considered (dependencies outside the package list are already built).
+    A package that depends on itself keeps the edge, so it is reported as a cycle.
+    :param deps: dependency dictionary
+    :return: tuple with the dependency and dependent (reverse) dictionaries of sets
+    """
+    depends_on = {name: {_ for _ in deps[name][1] if _ in deps} for name in deps}
+    dependents = {name: set() for name in deps}
+    for name in depends_on:
+        for dep in depends_on[name]:
+            dependents[dep].add(name)
+    return depends_on, dependents
+
+
+def find_cycles(deps: dict) -> list:
+    """
+    Find the dependency cycles (strongly connected components with more than one
+    package, or packages that depend on themselves) using Tarjan's algorithm.
+    :param deps: dependency dictionary
+    :return: list of cycles, each one a sorted list of package names
+    """
+    depends_on = {name: {_ for _ in deps[name][1] if _ in deps} for name in deps}
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    output_list = []
+    counter = 0
+
+    for root in sorted(depends_on):
+        if root in index:
+            continue
+        # Iterative depth first search (avoids the recursion limit)
+        work = [(root, iter(sorted(depends_on[root])))]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            name, children = work[-1]
+            child = next(children, None)
+            if child is not None:
+                if child not in index:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(depends_on[child]))))
+                elif child in on_stack:
+                    low[name] = min(low[name], index[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[name])
+            if low[name] == index[name]:
+                component = []
+                while True:
+                    n = stack.pop()
+                    on_stack.discard(n)
+                    component.append(n)
+                    if n == name:
+                        break
+                if len(component) > 1 or name in depends_on[name]:
+                    output_list.append(sorted(component))
+    return output_list
+
+
+def topological_levels(deps: dict) -> dict:
+    """
+    Group the packages in build levels using Kahn's algorithm (linear in the number of dependencies).
+    Packages in a level only depend on packages in lower levels.
+    Packages that are part of (or depend on) a dependency cycle are not included.
+    :param deps: dependency dictionary
+    :return: dictionary of package sets indexed by level
+    """
+    depends_on, dependents = build_graph(deps)
+    pending = {name: len(depends_on[name]) for name in depends_on}
+
+    level = 0
+    order_dict = {}
+    current = {name for name in pending if pending[name] == 0}
+    while current:
+        order_dict[level] = current
+        next_level = set()
+        for name in current:
+            for dep in dependents[name]:
+                pending[dep] -= 1
+                if pending[dep] == 0:
+                    next_level.add(dep)
+        current = next_level
+        level += 1
+    return order_dict
+
+
 def build_order(deps: dict) -> dict:
     """
     Determine the package build order_dict based on the package dependencies
     It returns a dictionary where the key is a number starting from zero.
     The zero entry contains all the packages with no dependencies.
+    Packages that cannot be ordered because of dependency cycles are reported.
     :param deps: dependency dictionary
     :return: build order_dict dictionary
     """
-    level = 0
-    order_dict = {level: set()}
+    order_dict = topological_levels(deps)
+    ordered = {name for level in order_dict for name in order_dict[level]}
+    if len(ordered) < len(deps):
+        for cycle in find_cycles(deps):
+            print(f'dependency cycle: {", ".join(cycle)}')
+        print(f'not ordered (cycle): {sorted(set(deps) - ordered)}')
+    return order_dict
+
 
-    # Build the set of packages with no dependencies (level 0)
-    name_set = {_ for _ in deps}
-    for name in name_set:
+def reverse_dependencies(deps: dict) -> dict:
+    """
+    Build the reverse dependency index: for each package, the set of packages that
+    require it, either at run time (Requires) or at build time (BuildRequires).
+    :param deps: dependency dictionary
+    :return: dictionary of dependent package sets indexed by package name
+    """
+    d = {name: set() for name in deps}
+    for name in deps:
         r, b = deps[name]
-        if not b:
-            order_dict[level].add(name)
-    pending_set = name_set - order_dict[level]
+        for dep in r | b:
+            if dep in d and dep != name:
+                d[dep].add(name)
+    return d
 
-    while len(pending_set) > 0 and level < 20:
-        level += 1
-        order_dict[level] = set()
-        for name in pending_set:
-            r, b = deps[name]
-            if len(pending_set.intersection(b)) == 0:
-                order_dict[level].add(name)
-        pending_set = pending_set - order_dict[level]
 
-    return order_dict
+def affected_packages(deps: dict, changed: set) -> set:
+    """
+    Determine the packages that have to be rebuilt when some packages change:
+    the changed packages and everything that depends on them, directly or not.
+    :param deps: dependency dictionary
+    :param changed: set of changed package names
+    :return: set of packages to rebuild
+    """
+    reverse = reverse_dependencies(deps)
+    output_set = {_ for _ in changed if _ in deps}
+    pending = list(output_set)
+    while pending:
+        name = pending.pop()
+        for dep in reverse[name]:
+            if dep not in output_set:
+                output_set.add(dep)
+                pending.append(dep)
+    return output_set
+
+
+def rebuild_order(deps: dict, changed: set) -> dict:
+    """
+    Determine the build order of the packages affected by a change.
+    Packages in the same level can be built in parallel.
+    :param deps: dependency dictionary
+    :param changed: set of changed package names
+    :return: build order dictionary (see build_order)
+    """
+    return build_order({name: deps[name] for name in affected_packages(deps, changed)})
+
+
+def changed_from_git(path_name: str, packages: list, ref: str) -> set:
+    """
+    Find the packages whose source directory differs from a git reference,
+    or has uncommitted or untracked changes.
+    :param path_name: directory where the package source is located
+    :param packages: package names
+    :param ref: git reference (commit, tag or branch)
+    :return: set of changed package names
+    """
+    def changed(name: str) -> bool:
+        cwd = os.path.join(path_name, name)
+        for cmd in (['git', 'diff', '--name-only', ref, '--', '.'],
+                    ['git', 'status', '--porcelain', '--', '.']):
+            try:
+                p = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   universal_newlines=True)
+            except OSError:
+                return False
+            if p.returncode != 0:
+                print(f'{cwd}: git {cmd[1]} failed')
+                return False
+            if p.stdout.strip():
+                return True
+        return False
+
+    with ThreadPoolExecutor(max_workers=SPEC_WORKERS) as executor:
+        return {name for name, flag in zip(packages, executor.map(changed, packages)) if flag}
+
+
+def changed_from_mtime(path_name: str, packages: list, stamp_file: str) -> set:
+    """
+    Find the packages with files modified after a stamp file (as in find -newer).
+    :param path_name: directory where the package source is located
+    :param packages: package names
+    :param stamp_file: reference file
+    :return: set of changed package names
+    """
+    since = os.stat(stamp_file).st_mtime
+
+    def changed(name: str) -> bool:
+        for root, dirs, files in os.walk(os.path.join(path_name, name)):
+            dirs[:] = [_ for _ in dirs if _ != '.git']
+            for f in files:
+                try:
+                    if os.stat(os.path.join(root, f)).st_mtime > since:
+                        return True
+                except OSError:
+                    pass
+        return False
+
+    with ThreadPoolExecutor(max_workers=SPEC_WORKERS) as executor:
+        return {name for name, flag in zip(packages, executor.map(changed, packages)) if flag}
+
+
+class DependencyIndex:
+    """
+    Transitive dependency index over the dependency dictionary.
+    Dependencies are the union of Requires and BuildRequires, restricted to the packages
+    in the dictionary. Each package is given a bit number, and the transitive closure of
+    every package (and of its dependents) is precomputed as an integer bit set, so
+    "does X depend on Y" is a single bit test.
+    """
+
+    def __init__(self, deps: dict):
+        """
+        :param deps: dependency dictionary
+        """
+        self.names = sorted(deps)
+        self.bit = {name: 1 << i for i, name in enumerate(self.names)}
+        self.direct = {name: {_ for _ in deps[name][0] | deps[name][1] if _ in deps and _ != name}
+                       for name in self.names}
+        self.reverse = reverse_dependencies(deps)
+        self.closure = self._closure(self.direct)
+        self.reverse_closure = self._closure(self.reverse)
+
+    def _closure(self, graph: dict) -> dict:
+        """
+        Compute the transitive closure of a graph as bit sets.
+        Packages are processed in topological order so each closure is computed once
+        from the closures of its direct dependencies. Packages in cycles are
+        iterated until the bit sets do not change.
+        :param graph: dictionary of sets (package -> direct dependencies)
+        :return: dictionary of bit sets indexed by package name
+        """
+        closure = {name: 0 for name in graph}
+        order_dict = topological_levels({name: (set(), graph[name]) for name in graph})
+        ordered = [name for level in sorted(order_dict) for name in order_dict[level]]
+        for name in ordered:
+            for dep in graph[name]:
+                closure[name] |= self.bit[dep] | closure[dep]
+        pending = [_ for _ in self.names if _ not in set(ordered)]
+        changed = True
+        while changed:
+            changed = False
+            for name in pending:
+                value = closure[name]
+                for dep in graph[name]:
+                    value |= self.bit[dep] | closure[dep]
+                if value != closure[name]:
+                    closure[name] = value
+                    changed = True
+        return closure
+
+    def decode(self, bits: int) -> list:
+        """
+        Convert a bit set into a sorted list of package names
+        :param bits: bit set
+        :return: list of package names
+        """
+        return [name for name in self.names if bits & self.bit[name]]
+
+    def depends(self, name: str, dep: str) -> bool:
+        """
+        :param name: package name
+        :param dep: dependency name
+        :return: True if the package depends on dep, directly or not
+        """
+        return bool(self.closure[name] & self.bit[dep])
+
+    def all_dependencies(self, name: str) -> list:
+        """
+        :param name: package name
+        :return: sorted list of all the (transitive) dependencies of a package
+        """
+        return self.decode(self.closure[name])
+
+    def all_dependents(self, name: str) -> list:
+        """
+        :param name: package name
+        :return: sorted list of all the packages that depend on a package, directly or not
+        """
+        return self.decode(self.reverse_closure[name])
+
+    def why(self, name: str, dep: str) -> list:
+        """
+        Explain why a package depends on another one with the shortest dependency chain.
+        The search only visits packages that also depend on dep.
+        :param name: package name
+        :param dep: dependency name
+        :return: list of packages from name to dep (empty if there is no dependency)
+        """
+        if not self.depends(name, dep):
+            return []
+        previous = {name: None}
+        queue = deque([name])
+        while queue:
+            n = queue.popleft()
+            if n == dep:
+                break
+            for d in sorted(self.direct[n]):
+                if d not in previous and (d == dep or self.depends(d, dep)):
+                    previous[d] = n
+                    queue.append(d)
+        path = [dep]
+        while previous[path[-1]] is not None:
+            path.append(previous[path[-1]])
+        return path[::-1]
+
+    def droppable(self, keep: list) -> list:
+        """
+        Determine the packages that can be dropped.
+        If a list of packages to keep is given, these are the packages that are not needed
+        by any of them. Otherwise, they are the packages no other package depends on.
+        :param keep: list of packages to keep (can be empty)
+        :return: sorted list of package names
+        """
+        if keep:
+            needed = 0
+            for name in keep:
+                needed |= self.bit[name] | self.closure[name]
+            return [name for name in self.names if not needed & self.bit[name]]
+        return [name for name in self.names if not self.reverse[name]]
+
+    def write_subgraph(self, file_name: str, name: str, dependents=False):
+        """
+        Write the DOT graph of a package and its transitive dependencies (or dependents)
+        :param file_name: output file name
+        :param name: package name
+        :param dependents: include the dependents instead of the dependencies?
+        """
+        bits = self.bit[name] | (self.reverse_closure[name] if dependents else self.closure[name])
+        with open(file_name, 'w') as f:
+            f.write('digraph dependencies {\n')
+            for n in self.decode(bits):
+                edges = sorted(_ for _ in self.direct[n] if bits & self.bit[_])
+                if edges:
+                    for dep in edges:
+                        f.write(f'{n} -> {dep};\n')
+                else:
+                    f.write(f'{n};\n')
+            f.write('}\n')
+
+
+def read_build_times(file_name: str) -> dict:
+    """
+    Read the build time estimates.
+    Each line contains a package name and its build time (any unit, normally seconds).
+    Empty lines and lines starting with # are ignored.
+    :param file_name: input file name
+    :return: dictionary with build times indexed by package name
+    """
+    d = {}
+    try:
+        with open(file_name, 'r') as f:
+            for line in f:
+                t = line.split()
+                if len(t) < 2 or t[0].startswith('#'):
+                    continue
+                try:
+                    d[t[0]] = float(t[1])
+                except ValueError:
+                    print(f'invalid build time for {t[0]}: {t[1]}')
+    except IOError:
+        print(f'{file_name} could not be processed')
+    return d
+
+
+def build_time(name: str, times: dict) -> float:
+    """
+    Return the estimated build time of a package.
+    Packages without an estimate take one unit of time.
+    :param name: package name
+    :param times: build time dictionary
+    :return: build time
+    """
+    return times.get(name, DEFAULT_BUILD_TIME)
+
+
+def remaining_times(deps: dict, times: dict) -> dict:
+    """
+    Compute, for each package, the longest build time from the start of the package build to the
+    end of the build of everything that depends on it (the package "bottom level").
+    This is the priority used to schedule builds. Packages in cycles are not included.
+    :param deps: dependency dictionary
+    :param times: build time dictionary
+    :return: dictionary with the remaining time indexed by package name
+    """
+    _, dependents = build_graph(deps)
+    order_dict = topological_levels(deps)
+    d = {}
+    for level in sorted(order_dict, reverse=True):
+        for name in order_dict[level]:
+            after = [d[_] for _ in dependents[name] if _ in d]
+            d[name] = build_time(name, times) + (max(after) if after else 0)
+    return d
+
+
+def critical_path(deps: dict, times: dict) -> tuple:
+    """
+    Determine the critical path, the chain of dependencies with the longest total build time.
+    No schedule can finish before the critical path time, whatever the number of workers.
+    :param deps: dependency dictionary
+    :param times: build time dictionary
+    :return: tuple with the total time and the list of packages in build order
+    """
+    depends_on, dependents = build_graph(deps)
+    remaining = remaining_times(deps, times)
+    if not remaining:
+        return 0, []
+    roots = [_ for _ in remaining if not depends_on[_]]
+    name = max(sorted(roots), key=lambda _: remaining[_])
+    total = remaining[name]
+    path = [name]
+    while True:
+        after = [_ for _ in dependents[name] if _ in remaining]
+        if not after:
+            break
+        name = max(sorted(after), key=lambda _: remaining[_])
+        path.append(name)
+    return total, path
+
+
+def build_schedule(deps: dict, workers: int, times: dict) -> list:
+    """
+    Compute a parallel build schedule for a number of workers (list scheduling).
+    When a worker is free, it starts the ready package with the longest remaining
+    time (see remaining_times), so the critical path is started as early as possible.
+    :param deps: dependency dictionary
+    :param workers: number of workers
+    :param times: build time dictionary
+    :return: list of (start, end, worker, package) tuples sorted by start time
+    """
+    depends_on, dependents = build_graph(deps)
+    remaining = remaining_times(deps, times)
+    pending = {name: len(depends_on[name]) for name in remaining}
+
+    # Ready packages, ordered by priority (longest remaining time first)
+    ready = [(-remaining[_], _) for _ in remaining if pending[_] == 0]
+    heapq.heapify(ready)
+    idle = list(range(max(workers, 1)))
+    running = []   # (end, package, worker)
+    output_list = []
+    t = 0.0
+
+    while ready or running:
+        # Start as many builds as possible
+        while ready and idle:
+            worker = heapq.heappop(idle)
+            _, name = heapq.heappop(ready)
+            end = t + build_time(name, times)
+            output_list.append((t, end, worker, name))
+            heapq.heappush(running, (end, name, worker))
+
+        # Wait for the next build to finish
+        t, name, worker = heapq.heappop(running)
+        heapq.heappush(idle, worker)
+        for dep in dependents[name]:
+            if dep in pending:
+                pending[dep] -= 1
+                if pending[dep] == 0:
+                    heapq.heappush(ready, (-remaining[dep], dep))
+
+    return sorted(output_list)
+
+
+def run_builds(deps: dict, command: str, workers: int, times: dict, path_name=DEFAULT_PATH) -> dict:
+    """
+    Run the package builds in parallel, starting a package only after all its dependencies
+    were built successfully. The ready package with the longest remaining time is started first.
+    The command is a shell command template where {name} is replaced by the package name
+    and {path} by the package source directory.
+    Packages that depend on a failed build are not built.
+    :param deps: dependency dictionary
+    :param command: command template
+    :param workers: number of parallel builds
+    :param times: build time dictionary
+    :param path_name: directory where the package source is located
+    :return: dictionary with the command exit status indexed by package name (None if not built)
+    """
+    depends_on, dependents = build_graph(deps)
+    remaining = remaining_times(deps, times)
+    pending = {name: len(depends_on[name]) for name in remaining}
+    status = {name: None for name in deps}
+    ready = [(-remaining[_], _) for _ in remaining if pending[_] == 0]
+    heapq.heapify(ready)
+
+    def build(name: str) -> int:
+        cmd = command.format(name=name, path=os.path.join(path_name, name))
+        print(f'start: {name}: {cmd}')
+        return subprocess.run(cmd, shell=True).returncode
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        running = {}
+        while ready or running:
+            while ready and len(running) < max(workers, 1):
+                _, name = heapq.heappop(ready)
+                running[executor.submit(build, name)] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                status[name] = future.result()
+                print(f'done: {name}: {status[name]}')
+                if status[name] != 0:
+                    continue
+                for dep in dependents[name]:
+                    if dep in pending:
+                        pending[dep] -= 1
+                        if pending[dep] == 0:
+                            heapq.heappush(ready, (-remaining[dep], dep))
+    return status
 
 
 def print_build_order(order_dict: dict):
@@ -171,6 +810,29 @@ def print_build_order(order_dict: dict):
             print(f'{level}: {dep}')
 
 
+def print_critical_path(total: float, path: list):
+    """
+    Print the critical path to the terminal
+    :param total: critical path build time
+    :param path: packages in the critical path
+    """
+    print(f'Critical path ({total:g}):')
+    for name in path:
+        print(f'  {name}')
+
+
+def print_schedule(schedule: list):
+    """
+    Print a parallel build schedule to the terminal
+    :param schedule: list of (start, end, worker, package) tuples
+    """
+    print('Build schedule (start, end, worker, package):')
+    for start, end, worker, name in schedule:
+        print(f'{start:10g} {end:10g} {worker:4} {name}')
+    if schedule:
+        print(f'Total time: {max(_[1] for _ in schedule):g}')
+
+
 def print_dependencies(deps: dict):
     """
     Print a dependency dictionary is format easy to read
@@ -217,13 +879,144 @@ if __name__ == '__main__':
                         default='output.dot',
                         help='dot file name')
 
+    parser.add_argument('-c', '--changed',
+                        action='store',
+                        dest='changed',
+                        nargs='+',
+                        default=[],
+                        help='print the rebuild order of the packages affected by these changed packages')
+
+    parser.add_argument('--git',
+                        action='store',
+                        dest='git',
+                        default='',
+                        help='add the packages that changed since this git reference to --changed')
+
+    parser.add_argument('--newer',
+                        action='store',
+                        dest='newer',
+                        default='',
+                        help='add the packages with files newer than this file to --changed')
+
+    parser.add_argument('--all-deps',
+                        action='store',
+                        dest='all_deps',
+                        default='',
+                        help='print all the (transitive) dependencies of a package')
+
+    parser.add_argument('--rdeps',
+                        action='store',
+                        dest='rdeps',
+                        default='',
+                        help='print all the packages that depend on a package')
+
+    parser.add_argument('--why',
+                        action='store',
+                        dest='why',
+                        nargs=2,
+                        metavar=('PACKAGE', 'DEPENDENCY'),
+                        default=None,
+                        help='print the shortest dependency chain between two packages')
+
+    parser.add_argument('--droppable',
+                        action='store',
+                        dest='droppable',
+                        nargs='*',
+                        metavar='KEEP',
+                        default=None,
+                        help='print the packages not needed by the packages to keep (or not needed by any package)')
+
+    parser.add_argument('--subgraph',
+                        action='store',
+                        dest='subgraph',
+                        default='',
+                        help='write the dot graph of a package and its dependencies to the dot file')
+
+    parser.add_argument('--reverse',
+                        action='store_true',
+                        dest='reverse',
+                        default=False,
+                        help='use the dependents instead of the dependencies in --subgraph')
+
+    parser.add_argument('--cache',
+                        action='store',
+                        dest='cache',
+                        default=DEFAULT_CACHE_FILE,
+                        help='spec file cache (use an empty string to disable it)')
+
+    parser.add_argument('-j', '--workers',
+                        action='store',
+                        dest='workers',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='number of parallel builds (schedule and build)')
+
+    parser.add_argument('-t', '--times',
+                        action='store',
+                        dest='times',
+                        default='',
+                        help='file with build time estimates (package time, one per line)')
+
+    parser.add_argument('--schedule',
+                        action='store_true',
+                        dest='schedule',
+                        default=False,
+                        help='print the critical path and the parallel build schedule')
+
+    parser.add_argument('--build',
+                        action='store',
+                        dest='build',
+                        default='',
+                        help='build the packages with this shell command ({name} and {path} are replaced)')
+
     # args = parser.parse_args(['pkglist.txt', '--deps', '--path', '/home/pgigoux/work/ade2/support', '--dot'])
     args = parser.parse_args()
 
     if len(args.input_file):
-        dep_dict = process_dependencies(args.path, args.input_file)
-        if args.deps:
+        dep_dict = process_dependencies(args.path, args.input_file, cache_file=args.cache)
+        if dep_dict is None:
+            exit(1)
+        time_dict = read_build_times(args.times) if args.times else {}
+        changed_set = set(args.changed)
+        if args.git:
+            changed_set |= changed_from_git(args.path, sorted(dep_dict), args.git)
+        if args.newer:
+            changed_set |= changed_from_mtime(args.path, sorted(dep_dict), args.newer)
+        query_list = [args.all_deps, args.rdeps, args.subgraph] + (args.why if args.why else []) + \
+            (args.droppable if args.droppable else [])
+        unknown = sorted(_ for _ in changed_set.union(query_list) if _ and _ not in dep_dict)
+        if unknown:
+            print(f'unknown packages: {unknown}')
+            exit(1)
+        if args.all_deps or args.rdeps or args.why or args.droppable is not None or args.subgraph:
+            index = DependencyIndex(dep_dict)
+            if args.all_deps:
+                print(f'{args.all_deps}: {index.all_dependencies(args.all_deps)}')
+            if args.rdeps:
+                print(f'{args.rdeps}: {index.all_dependents(args.rdeps)}')
+            if args.why:
+                path = index.why(*args.why)
+                print(' -> '.join(path) if path else f'{args.why[0]} does not depend on {args.why[1]}')
+            if args.droppable is not None:
+                print(f'droppable: {index.droppable(args.droppable)}')
+            if args.subgraph:
+                index.write_subgraph(args.dotfile, args.subgraph, dependents=args.reverse)
+        elif args.changed or args.git or args.newer:
+            print(f'Changed: {sorted(changed_set)}')
+            print_build_order(rebuild_order(dep_dict, changed_set))
+        elif args.deps:
             print_dependencies(dep_dict)
+        elif args.build:
+            build_order(dep_dict)
+            status_dict = run_builds(dep_dict, args.build, args.workers, time_dict, path_name=args.path)
+            failed = sorted(_ for _ in status_dict if status_dict[_] != 0)
+            if failed:
+                print(f'not built: {failed}')
+                exit(1)
+        elif args.schedule:
+            build_order(dep_dict)
+            print_critical_path(*critical_path(dep_dict, time_dict))
+            print_schedule(build_schedule(dep_dict, args.workers, time_dict))
         else:
             build_dict = build_order(dep_dict)
             print_build_order(build_dict)
@@ -11,9 +11,15 @@ Running:
 * conda activate py36
 * ./process_alarms.py [options] <file>
 """
+import os
 import sys
 import argparse
+from datetime import datetime
+from typing import Iterable, Iterator
 from common import print_line, print_title, ignore_alarms, numeric_field_list
+from log_reader import map_lines, iter_lines, budget_chunk_size
+from alarm_history import HISTORY_FILE, add_sweep
+import instrument
 
 
 def missing_fields(d: dict) -> list:
@@ -36,49 +42,105 @@ def missing_fields(d: dict) -> list:
     return output_list
 
 
+def parse_alarm_lines(lines: list) -> list:
+    """
+    Line handler used by process_file.
+    Split the record.field,value lines into their components.
+    :param lines: input lines
+    :return: list of (record name, field name, value) tuples
+    """
+    output_list = []
+    for line in lines:
+        t = line.strip().split(',')
+        pv_name, pv_val = t[0], t[1]
+        record_name, field_name = pv_name.split('.')
+        output_list.append((record_name, field_name, pv_val))
+    return output_list
+
+
+def merge_records(items: Iterable) -> Iterator:
+    """
+    Group the record fields into alarm dictionaries. The fields of a record are
+    consecutive in the capture, so only the current record is kept in memory.
+    Records with missing fields are reported to the standard error and skipped.
+    :param items: (record name, field name, value) tuples in file order (see parse_alarm_lines)
+    :return: iterator of (record name, alarm dictionary) tuples
+    """
+    d = {}
+    last_record_name = ''
+    for record_name, field_name, pv_val in items:
+        if record_name != last_record_name:
+            if d:
+                field_list = missing_fields(d)
+                if field_list:
+                    print(f'missing fields {last_record_name}: {field_list}', file=sys.stderr)
+                else:
+                    yield last_record_name, d
+                d = {}
+            last_record_name = record_name
+        d[field_name] = pv_val
+    # Last record in the file
+    if d:
+        field_list = missing_fields(d)
+        if field_list:
+            print(f'missing fields {last_record_name}: {field_list}', file=sys.stderr)
+        else:
+            yield last_record_name, d
+
+
 def process_file(file_name: str) -> dict:
     """
     Read the file generated using a bash script, containing the different
     alarms record.field values, one per line.
+    The file is parsed in parallel chunks (see log_reader).
     :param file_name: input file name
     :return: dictionary with alarm values
     """
-    output_dict = {}
-    record_list = []
-    d = {}
-    last_record_name = ''
-    with open(file_name, 'r') as f:
-        for line in f:
-            t = line.strip().split(',')
-            pv_name, pv_val = t[0], t[1]
-            # print(pv_name, pv_val)
-            record_name, field_name = pv_name.split('.')
-            if record_name not in record_list:
-                record_list.append(record_name)
-                if d:
-                    field_list = missing_fields(d)
-                    if field_list:
-                        print(f'missing fields {last_record_name}: {field_list}', file=sys.stderr)
-                    else:
-                        output_dict[last_record_name] = d
-                        d = {}
-                last_record_name = record_name
-            d[field_name] = pv_val
+    with instrument.timer('alarms parse'):
+        items = map_lines(file_name, parse_alarm_lines)
+    instrument.count('alarm lines', len(items))
+    with instrument.timer('alarms merge'):
+        output_dict = dict(merge_records(items))
+    instrument.count('records', len(output_dict))
     return output_dict
 
 
-def print_data(alarms: dict, include_udf=False, csv_output=False):
+def iter_file(file_name: str, max_memory: int) -> Iterator:
+    """
+    Memory bounded version of process_file. The file is read in chunks sized from
+    the memory budget, and the records are returned as soon as they are complete.
+    :param file_name: input file name
+    :param max_memory: memory budget (bytes)
+    :return: iterator of (record name, alarm dictionary) tuples, in file order
+    """
+    return merge_records(iter_lines(file_name, parse_alarm_lines, chunk_size=budget_chunk_size(max_memory)))
+
+
+def keep_states(records: Iterable, states: dict) -> Iterator:
+    """
+    Pass the records through, keeping only their alarm state fields (for add_sweep)
+    :param records: iterator of (record name, alarm dictionary) tuples
+    :param states: dictionary where the states are stored, indexed by record name
+    :return: iterator of (record name, alarm dictionary) tuples
+    """
+    for record_name, d in records:
+        states[record_name] = {_: d[_] for _ in numeric_field_list}
+        yield record_name, d
+
+
+def print_data(alarms: Iterable, include_udf=False, csv_output=False):
     """
     Print the alarm data to the standard output
-    :param alarms:
+    :param alarms: (record name, alarm dictionary) tuples
     :param csv_output:
     :param include_udf:
     :return:
     """
     print_title(csv_output=csv_output)
-    for record_name in alarms:
-        if not ignore_alarms(alarms[record_name], include_udf=include_udf):
-            print_line(record_name, alarms[record_name], csv_output=csv_output)
+    with instrument.timer('output'):
+        for record_name, d in alarms:
+            if not ignore_alarms(d, include_udf=include_udf):
+                print_line(record_name, d, csv_output=csv_output)
 
 
 if __name__ == '__main__':
@@ -105,11 +167,47 @@ if __name__ == '__main__':
                         default=False,
                         help='format output as csv')
 
+    parser.add_argument('--history',
+                        action='store',
+                        dest='history',
+                        nargs='?',
+                        const=HISTORY_FILE,
+                        default='',
+                        help='add the alarm states to the alarm history, using the file modification time '
+                             '(see alarm_history.py)')
+
+    parser.add_argument('--max-mem',
+                        action='store',
+                        dest='max_mem',
+                        type=int,
+                        default=0,
+                        metavar='MB',
+                        help='memory budget: read the file in bounded chunks and print the records '
+                             'as they are parsed (default is no limit)')
+
+    instrument.add_arguments(parser)
+
     args = parser.parse_args()
+    instrument.start(args)
 
     try:
-        alarm_dict = process_file(args.input_file)
-        print_data(alarm_dict, include_udf=args.include_udf, csv_output=args.csv)
+        if args.max_mem > 0:
+            # Only the alarm states are kept (for the history)
+            alarm_dict = {}
+            alarm_records = iter_file(args.input_file, args.max_mem * 1024 * 1024)
+            if args.history:
+                alarm_records = keep_states(alarm_records, alarm_dict)
+        else:
+            alarm_dict = process_file(args.input_file)
+            alarm_records = alarm_dict.items()
+        print_data(alarm_records, include_udf=args.include_udf, csv_output=args.csv)
+        if args.history and alarm_dict:
+            add_sweep(alarm_dict, sweep_time=datetime.fromtimestamp(os.path.getmtime(args.input_file)),
+                      source=f'capture {os.path.abspath(args.input_file)}', file_name=args.history)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        exit(1)
     except KeyboardInterrupt:
         print('Aborted', file=sys.stderr)
+    instrument.finish(args)
 
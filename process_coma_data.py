@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 import argparse
 import datetime
+from typing import Iterable, Iterator
+from log_reader import map_lines, iter_lines, budget_chunk_size
+from catalog import channel_group
+import instrument
 
 # Keys used to index the value dictionary
 KEY_TIMESTAMP = 'timestamp'
@@ -34,32 +38,8 @@ KEY_LIST = [KEY_TIMESTAMP,
 
 # Dictionary used to map EPICS channels to data keys
 # The data keys are used to access the data in the value dictionary
-channel_dictionary = {
-    # redundant
-    # 'm2:xPos': None, # m2 xpos
-    # 'm2:yPos': None, # m2 ypos
-    'tcs:om:m2RawXPos': KEY_M2XPOS,
-    'tcs:om:m2RawYPos': KEY_M2YPOS,
-    'tcs:m2XUserOffset': KEY_USERX,
-    'tcs:m2YUserOffset': KEY_USERY,
-    'tcs:m2XYOffset.VALA': KEY_USERX,
-    'tcs:m2XYOffset.VALB': KEY_USERY,
-    # redundant
-    # 'tcs:om:m2XYErr.VALA': None, # z5
-    # 'tcs:om:m2XYErr.VALB': None, # z6
-    'tcs:m2XErrorCorr.VAL': KEY_Z5,
-    'tcs:m2YErrorCorr.VAL': KEY_Z6,
-    'tcs:om:m2XY.VALA': KEY_TEMPX,
-    'tcs:om:m2XY.VALB': KEY_TEMPY,
-    'tcs:om:m2XY.VALC': KEY_MODELX,
-    'tcs:om:m2XY.VALD': KEY_MODELY,
-    'tcs:om:m2XY.VALG': KEY_NOMINALX,
-    'tcs:om:m2XY.VALH': KEY_NOMINALY,
-    'tcs:om:m2XY.VALI': KEY_CURRENTX,
-    'tcs:om:m2XY.VALJ': KEY_CURRENTY,
-    'tcs:om:m2XY.VALE': KEY_DEMANDX,
-    'tcs:om:m2XY.VALF': KEY_DEMANDY
-}
+# The channels are defined in the 'coma' group of the channel catalog
+channel_dictionary = {channel: key for key, channel, _ in channel_group('coma')}
 
 
 def get_timestamp(line: str) -> datetime.datetime:
@@ -105,49 +85,30 @@ def format_data(values: dict) -> str:
     return s[:-1]
 
 
-def write_data(data: list):
+def write_data(data: Iterable):
     """
     Write data to standard output in csv format (with colum titles)
     The data is stored in a list where each entry is a dictionary with the data columns.
-    :param data: list of data "points"
+    :param data: list (or iterator) of data "points"
     """
     print(get_title())
     for p in data:
         print(format_data(p))
 
 
-def process_follow_file(file_name: str, start_date: datetime.datetime, end_date: datetime.datetime):
+def parse_follow_lines(lines: list) -> list:
     """
-    Process the file with coma data caputured
-    :param file_name: input file name
-    :param start_date: stating date
-    :param end_date: ending date
-
+    Line handler used by process_follow_file.
+    Time stamp lines are returned as (KEY_TIMESTAMP, datetime) tuples, and
+    channels in the channel dictionary as (key, value) tuples.
+    :param lines: input lines
+    :return: list of (key, value) tuples
     """
-    try:
-        f = open(file_name, 'r')
-    except OSError:
-        print(f'Cannot open file {file_name}')
-        return
-
-    # Initialize variables
-    first_time = True
-    values = new_values()
     output_list = []
-
-    for line in f:
+    for line in lines:
         line = line.strip()
         if '---' in line:
-            ts = get_timestamp(line)
-            values[KEY_TIMESTAMP] = ts
-            if first_time:
-                first_time = False
-            else:
-                if start_date < ts < end_date:
-                    # print('=', values)
-                    output_list.append(values)
-                    # format_data(values)
-                    values = new_values()
+            output_list.append((KEY_TIMESTAMP, get_timestamp(line)))
         elif 'drives:driveM2S.VALA' in line:
             continue
         else:
@@ -160,13 +121,72 @@ def process_follow_file(file_name: str, start_date: datetime.datetime, end_date:
             except IndexError:
                 pass
             if channel in channel_dictionary:
-                key = channel_dictionary[channel]
-                values[key] = value
-                # print(values)
+                output_list.append((channel_dictionary[channel], value))
+    return output_list
 
-    write_data(output_list)
 
-    f.close()
+def merge_samples(items: Iterable, start_date: datetime.datetime, end_date: datetime.datetime) -> Iterator:
+    """
+    Group the channel values into samples (one per time stamp)
+    :param items: (key, value) tuples in file order (see parse_follow_lines)
+    :param start_date: stating date
+    :param end_date: ending date
+    :return: iterator of value dictionaries
+    """
+    first_time = True
+    values = new_values()
+    for key, value in items:
+        if key == KEY_TIMESTAMP:
+            values[KEY_TIMESTAMP] = value
+            if first_time:
+                first_time = False
+            else:
+                if start_date < value < end_date:
+                    # print('=', values)
+                    yield values
+                    # format_data(values)
+                    values = new_values()
+        else:
+            values[key] = value
+            # print(values)
+
+
+def process_follow_file(file_name: str, start_date: datetime.datetime, end_date: datetime.datetime, max_memory=0):
+    """
+    Process the file with coma data caputured
+    The file is parsed in parallel chunks (see log_reader).
+    With a memory budget the file is read in bounded chunks and the samples are
+    written as soon as they are complete, instead of being kept until the end.
+    :param file_name: input file name
+    :param start_date: stating date
+    :param end_date: ending date
+    :param max_memory: memory budget (bytes, 0 = no limit)
+    """
+    if max_memory > 0:
+        # The file is opened by iter_lines, the lines are read while the samples are written
+        try:
+            items = iter_lines(file_name, parse_follow_lines, chunk_size=budget_chunk_size(max_memory))
+        except OSError:
+            print(f'Cannot open file {file_name}')
+            return
+        with instrument.timer('output'):
+            write_data(merge_samples(items, start_date, end_date))
+        return
+
+    try:
+        with instrument.timer('coma parse'):
+            items = map_lines(file_name, parse_follow_lines)
+    except OSError:
+        print(f'Cannot open file {file_name}')
+        return
+
+    with instrument.timer('coma merge'):
+        output_list = list(merge_samples(items, start_date, end_date))
+    instrument.count('coma values', len(items))
+    instrument.count('coma samples', len(output_list))
+
+    with instrument.timer('output'):
+        write_data(output_list)
 
 
 if __name__ == '__main__':
@@ -190,7 +210,19 @@ if __name__ == '__main__':
                         default='',
                         help='ending date (YYYYMMDD-HHMMSS)')
 
+    parser.add_argument('--max-mem',
+                        action='store',
+                        dest='max_mem',
+                        type=int,
+                        default=0,
+                        metavar='MB',
+                        help='memory budget: read the file in bounded chunks and write the samples '
+                             'as they are parsed (default is no limit)')
+
+    instrument.add_arguments(parser)
+
     args = parser.parse_args()
+    instrument.start(args)
 
     try:
         sd = datetime.datetime.strptime(args.start_date, '%Y%m%d-%H%M%S')
@@ -201,4 +233,5 @@ if __name__ == '__main__':
     except ValueError:
         ed = datetime.datetime(2050, 1, 1, 0, 0, 0)
 
-    process_follow_file(args.input_file, sd, ed)
+    process_follow_file(args.input_file, sd, ed, max_memory=args.max_mem * 1024 * 1024)
+    instrument.finish(args)
@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Sharded alarm sweep. Same report as check_alarms.py, but the record list is split
+into shards that are checked by several worker processes at the same time.
+
+Records are grouped by IOC prefix. Prefixes with more records than a shard are split
+by a hash of the record name, and the groups are assigned to the shards largest first
+so the shards have about the same number of records. The sharding is stable between runs.
+
+Shards with records of problem IOCs (timeouts in the previous sweep, or listed in the
+--priority file) are scheduled first, and these records are checked first in each shard.
+
+Each shard runs in a separate process, on the local host (-j) or on remote hosts
+(--ssh host, --docker container, e.g. a container started with docker-run).
+Remote hosts must see this directory at the same path (e.g. /home).
+Results are streamed back one record at a time, so a failing shard only loses the
+records that were not checked yet. A host whose worker fails before returning any
+result (e.g. ssh or docker cannot connect) is not used for the rest of the sweep,
+and its shard is checked by another host. The progress is reported on the standard error,
+and the report is printed in the input file order when all the shards are done.
+
+Running:
+* conda activate py36
+* ./sweep_alarms.py [options] <file>
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import heapq
+import queue
+import shlex
+import argparse
+import threading
+import subprocess
+from math import ceil, inf
+from common import print_title, print_line, ignore_alarms
+from catalog import record_prefix
+from alarm_history import HISTORY_FILE, add_sweep
+import instrument
+
+# Default number of local worker processes
+DEFAULT_WORKERS = 4
+
+# Default number of shards per worker (more shards give a better balance with slow IOCs)
+SHARDS_PER_WORKER = 4
+
+# Problem IOCs found in the previous sweeps
+DEFAULT_STATE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'sweep_alarms.json')
+STATE_VERSION = 1
+
+
+def stable_hash(s: str) -> int:
+    """
+    Hash that does not change between runs (unlike hash())
+    :param s: input string
+    :return: hash value
+    """
+    return zlib.crc32(s.encode())
+
+
+def shard_records(record_names: list, shard_count: int) -> list:
+    """
+    Split a list of records into shards by IOC prefix.
+    :param record_names: record names
+    :param shard_count: number of shards
+    :return: list of shards (lists of record names), empty shards are not returned
+    """
+    groups = {}
+    for record_name in record_names:
+        groups.setdefault(record_prefix(record_name), []).append(record_name)
+
+    # Split the prefixes that do not fit in a shard
+    target = max(1, ceil(len(record_names) / shard_count))
+    group_list = []
+    for prefix, names in groups.items():
+        if len(names) <= target:
+            group_list.append((prefix, names))
+            continue
+        parts = ceil(len(names) / target)
+        sub_groups = {}
+        for record_name in names:
+            sub_groups.setdefault(stable_hash(record_name) % parts, []).append(record_name)
+        group_list += [(f'{prefix}#{n}', sub_groups[n]) for n in sorted(sub_groups)]
+
+    # Largest group first, into the shard with the fewest records
+    group_list.sort(key=lambda _: (-len(_[1]), stable_hash(_[0])))
+    heap = [(0, n) for n in range(shard_count)]
+    shards = [[] for _ in range(shard_count)]
+    for _, names in group_list:
+        load, n = heapq.heappop(heap)
+        shards[n] += names
+        heapq.heappush(heap, (load + len(names), n))
+    return [_ for _ in shards if _]
+
+
+def prioritize_shards(shards: list, problems: set) -> list:
+    """
+    Order the shards (and the records in each shard) so the problem IOCs are checked first
+    :param shards: list of shards
+    :param problems: set of problem IOC prefixes
+    :return: list of (priority, shard) tuples, highest priority first
+    """
+    output_list = []
+    for shard in shards:
+        first = [_ for _ in shard if record_prefix(_) in problems]
+        rest = [_ for _ in shard if record_prefix(_) not in problems]
+        output_list.append((len(first), first + rest))
+    output_list.sort(key=lambda _: -_[0])
+    return output_list
+
+
+def load_state(file_name: str) -> dict:
+    """
+    Read the problem IOCs found in the previous sweep
+    :param file_name: state file name
+    :return: dictionary of timeout counts indexed by IOC prefix
+    """
+    try:
+        with open(file_name, 'r') as f:
+            d = json.load(f)
+        if d.get('version') == STATE_VERSION:
+            return d['timeouts']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def save_state(file_name: str, timeouts: dict):
+    """
+    Save the problem IOCs found in this sweep
+    :param file_name: state file name
+    :param timeouts: dictionary of timeout counts indexed by IOC prefix
+    """
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        tmp_file_name = f'{file_name}.{os.getpid()}'
+        with open(tmp_file_name, 'w') as f:
+            json.dump({'version': STATE_VERSION, 'timeouts': timeouts}, f, indent=2)
+        os.replace(tmp_file_name, file_name)
+    except OSError as e:
+        print(f'Cannot write state file {file_name}: {e}', file=sys.stderr)
+
+
+def worker_command(host: str, use_pv: bool, timeout: float, remote_python: str) -> list:
+    """
+    Return the command used to check a shard on a host
+    :param host: 'local', 'ssh:<host>' or 'docker:<container>'
+    :param use_pv: use PV interface for channel access?
+    :param timeout: channel access timeout (seconds)
+    :param remote_python: python interpreter on the remote hosts
+    :return: command (list of arguments)
+    """
+    script = os.path.abspath(__file__)
+    options = ['--worker', '--timeout', str(timeout)] + (['--pv'] if use_pv else [])
+    if host == 'local':
+        return [sys.executable, script] + options
+    kind, name = host.split(':', 1)
+    if kind == 'ssh':
+        remote = f'cd {shlex.quote(os.getcwd())} && {remote_python} {shlex.quote(script)} {" ".join(options)}'
+        return ['ssh', '-o', 'BatchMode=yes', name, remote]
+    return ['docker', 'exec', '-i', f'--user={os.getuid()}:{os.getgid()}', '-w', os.getcwd(), name,
+            remote_python, script] + options
+
+
+def run_shard(command: list, shard: list, results: queue.Queue, shard_id: int) -> tuple:
+    """
+    Check a shard with a worker process. The results are put in the results queue
+    as (shard id, record name, alarm dictionary or None) tuples as they arrive.
+    :param command: worker command
+    :param shard: record names
+    :param results: results queue
+    :param shard_id: shard number
+    :return: (True if the worker finished normally, number of results) tuple
+    """
+    try:
+        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError as e:
+        print(f'Cannot start worker {command[0]}: {e}', file=sys.stderr)
+        return False, 0
+    try:
+        p.stdin.write(''.join(f'{_}\n' for _ in shard))
+        p.stdin.close()
+    except OSError:
+        pass
+    count = 0
+    for line in p.stdout:
+        try:
+            d = json.loads(line)
+            results.put((shard_id, d['record'], d['alarms']))
+            count += 1
+        except (ValueError, KeyError, TypeError):
+            continue
+    return p.wait() == 0, count
+
+
+def run_host(host: str, command: list, shards: queue.PriorityQueue, results: queue.Queue):
+    """
+    Take shards from the queue and check them on a host until a stop entry (records = None) is found.
+    The host waits for more shards while the queue is empty, since a shard can be put back by a failed host.
+    The end of each shard is signaled with a (shard id, None, (host, ok flag, elapsed time)) tuple
+    in the results queue, and the end of the host with a (None, None, host) tuple.
+    If the worker fails without returning any result (the host cannot be reached), the shard
+    is put back in the queue for the other hosts and no more shards are taken.
+    :param host: host name (used in the messages)
+    :param command: worker command
+    :param shards: queue of (-priority, shard id, records) tuples
+    :param results: results queue
+    """
+    try:
+        while True:
+            priority, shard_id, shard = shards.get()
+            if shard is None:
+                return
+            t = time.monotonic()
+            ok, count = run_shard(command, shard, results, shard_id)
+            if not ok and count == 0 and shard:
+                shards.put((priority, shard_id, shard))
+                print(f'worker {host} failed, no more shards are sent to it', file=sys.stderr)
+                return
+            results.put((shard_id, None, (host, ok, time.monotonic() - t)))
+    finally:
+        results.put((None, None, host))
+
+
+def sweep(record_names: list, hosts: list, shard_count: int, problems: set, use_pv=False,
+          timeout=5.0, remote_python='python3') -> dict:
+    """
+    Check the alarms of a list of records using several workers
+    :param record_names: record names
+    :param hosts: one entry per worker ('local', 'ssh:<host>' or 'docker:<container>')
+    :param shard_count: number of shards
+    :param problems: problem IOC prefixes (checked first)
+    :param use_pv: use PV interface for channel access?
+    :param timeout: channel access timeout (seconds)
+    :param remote_python: python interpreter on the remote hosts
+    :return: dictionary of alarm dictionaries (None on timeout) indexed by record name.
+             Records that were not checked are not included.
+    """
+    shard_list = prioritize_shards(shard_records(record_names, shard_count), problems)
+    shards = queue.PriorityQueue()
+    for shard_id, (priority, shard) in enumerate(shard_list):
+        shards.put((-priority, shard_id, shard))
+    results = queue.Queue()
+
+    threads = [threading.Thread(target=run_host, daemon=True,
+                                args=(host, worker_command(host, use_pv, timeout, remote_python), shards, results))
+               for host in hosts]
+    for thread in threads:
+        thread.start()
+
+    output_dict = {}
+    counts = {_: [0, 0, 0] for _ in range(len(shard_list))}
+    done = 0
+    running = len(threads)
+    while done < len(shard_list):
+        if running == 0:
+            # All the hosts failed: the shards left are not checked
+            while not shards.empty():
+                _, shard_id, shard = shards.get_nowait()
+                done += 1
+                print(f'shard {done}/{len(shard_list)}: no worker left ({len(shard)} records not checked)',
+                      file=sys.stderr)
+            break
+        shard_id, record_name, value = results.get()
+        if shard_id is None:
+            running -= 1
+            continue
+        if record_name is not None:
+            output_dict[record_name] = value
+            counts[shard_id][0] += 1
+            if value is None:
+                counts[shard_id][2] += 1
+            elif not ignore_alarms(value):
+                counts[shard_id][1] += 1
+            continue
+        done += 1
+        host, ok, elapsed = value
+        records, alarms, timeouts = counts[shard_id]
+        missing = len(shard_list[shard_id][1]) - records
+        instrument.add_time('shard', elapsed)
+        print(f'shard {done}/{len(shard_list)} {host}: {records} records, {alarms} alarms, {timeouts} timeouts, '
+              f'{elapsed:.1f} s'
+              + ('' if ok and not missing else f', failed ({missing} records not checked)'), file=sys.stderr)
+
+    # Stop the hosts waiting for shards (the stop entries are sorted after any shard)
+    for n in range(len(threads)):
+        shards.put((inf, n, None))
+    return output_dict
+
+
+def print_report(record_names: list, results: dict, include_udf=False, csv_output=False):
+    """
+    Print the records with alarms in the input order (as check_alarms.py)
+    :param record_names: record names
+    :param results: sweep output
+    :param include_udf: include undefined alarms?
+    :param csv_output: output in csv format?
+    """
+    print_title(csv_output=csv_output)
+    for record_name in record_names:
+        if record_name not in results:
+            print(f'not checked {record_name}')
+            continue
+        d = results[record_name]
+        if d is None:
+            print(f'connection timeout {record_name}')
+        elif not ignore_alarms(d, include_udf=include_udf):
+            print_line(record_name, d, csv_output=csv_output)
+
+
+def timeouts_by_prefix(results: dict) -> dict:
+    """
+    :param results: sweep output
+    :return: dictionary of timeout counts indexed by IOC prefix
+    """
+    output_dict = {}
+    for record_name, d in results.items():
+        if d is None:
+            prefix = record_prefix(record_name)
+            output_dict[prefix] = output_dict.get(prefix, 0) + 1
+    return output_dict
+
+
+def run_worker(use_pv: bool, timeout: float):
+    """
+    Check the records read from the standard input and write one json line per record
+    to the standard output. The check_alarms messages go to the standard error.
+    :param use_pv: use PV interface for channel access?
+    :param timeout: channel access timeout (seconds)
+    """
+    import check_alarms
+    check_alarms.GET_TIMEOUT = timeout
+    record_names = [_.strip() for _ in sys.stdin if _.strip()]
+    out, sys.stdout = sys.stdout, sys.stderr
+    msg_flag = True
+    for record_name in record_names:
+        d, msg_flag = check_alarms.get_record_alarms(record_name, msg_flag=msg_flag, use_pv=use_pv)
+        out.write(json.dumps({'record': record_name, 'alarms': d}) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    # Process command line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(action='store',
+                        dest='input_file',
+                        nargs='?',
+                        help='file with record names',
+                        default='')
+
+    parser.add_argument('--udf',
+                        action='store_true',
+                        dest='include_udf',
+                        default=False,
+                        help='include undefined records in the report (UDF)')
+
+    parser.add_argument('--csv',
+                        action='store_true',
+                        dest='csv',
+                        default=False,
+                        help='format output as csv')
+
+    parser.add_argument('--pv',
+                        action='store_true',
+                        dest='pv',
+                        default=False,
+                        help='use the high level channel interface interface')
+
+    parser.add_argument('-j', '--workers',
+                        action='store',
+                        dest='workers',
+                        type=int,
+                        default=None,
+                        help=f'number of local worker processes (default {DEFAULT_WORKERS}, '
+                             f'or 0 when --ssh or --docker are used)')
+
+    parser.add_argument('--ssh',
+                        action='append',
+                        dest='ssh',
+                        default=[],
+                        metavar='HOST',
+                        help='run a worker on a remote host using ssh (can be repeated)')
+
+    parser.add_argument('--docker',
+                        action='append',
+                        dest='docker',
+                        default=[],
+                        metavar='CONTAINER',
+                        help='run a worker in a docker container (can be repeated)')
+
+    parser.add_argument('--shards',
+                        action='store',
+                        dest='shards',
+                        type=int,
+                        default=0,
+                        help=f'number of shards (default is {SHARDS_PER_WORKER} per worker)')
+
+    parser.add_argument('--priority',
+                        action='store',
+                        dest='priority',
+                        default='',
+                        help='file with IOC prefixes to check first (e.g. tag:), one per line')
+
+    parser.add_argument('--state',
+                        action='store',
+                        dest='state',
+                        default=DEFAULT_STATE_FILE,
+                        help='file with the problem IOCs of the previous sweep (use an empty string to disable it)')
+
+    parser.add_argument('--timeout',
+                        action='store',
+                        dest='timeout',
+                        type=float,
+                        default=5.0,
+                        help='channel access timeout (seconds)')
+
+    parser.add_argument('--remote-python',
+                        action='store',
+                        dest='remote_python',
+                        default='python3',
+                        help='python interpreter on the remote hosts')
+
+    parser.add_argument('--history',
+                        action='store',
+                        dest='history',
+                        nargs='?',
+                        const=HISTORY_FILE,
+                        default='',
+                        help='add the alarm states to the alarm history (see alarm_history.py)')
+
+    parser.add_argument('--worker',
+                        action='store_true',
+                        default=False,
+                        help=argparse.SUPPRESS)
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.pv, args.timeout)
+        exit(0)
+
+    instrument.start(args)
+
+    try:
+        with open(args.input_file, 'r') as f:
+            record_list = [_.strip() for _ in f if _.strip()]
+    except OSError:
+        print(f'file {args.input_file} does not exist')
+        exit(1)
+
+    problem_set = set(load_state(args.state)) if args.state else set()
+    if args.priority:
+        try:
+            with open(args.priority, 'r') as f:
+                problem_set |= set(_.strip() for _ in f if _.strip())
+        except OSError:
+            print(f'file {args.priority} does not exist')
+            exit(1)
+
+    if args.workers is None:
+        args.workers = 0 if args.ssh or args.docker else DEFAULT_WORKERS
+    host_list = ['local'] * args.workers + [f'ssh:{_}' for _ in args.ssh] + [f'docker:{_}' for _ in args.docker]
+    if not host_list:
+        print('no workers')
+        exit(1)
+    shard_total = args.shards if args.shards > 0 else SHARDS_PER_WORKER * len(host_list)
+
+    # Trap keyboard exceptions (CTR-C).
+    try:
+        result_dict = sweep(record_list, host_list, shard_total, problem_set, use_pv=args.pv,
+                            timeout=args.timeout, remote_python=args.remote_python)
+    except KeyboardInterrupt:
+        print('Aborted')
+        exit(1)
+
+    print_report(record_list, result_dict, include_udf=args.include_udf, csv_output=args.csv)
+    if args.state:
+        save_state(args.state, timeouts_by_prefix(result_dict))
+    if args.history and result_dict:
+        add_sweep(result_dict, source=f'sweep_alarms {os.path.abspath(args.input_file)}', file_name=args.history)
+    instrument.count('records', len(result_dict))
+    instrument.finish(args)